@@ -110,6 +110,30 @@ class TestMetatile(unittest.TestCase):
         self.assertTrue(metatiles_are_equal(
             metatile_1[0]['tile'], metatile_2[0]['tile']))
 
+    def test_metatile_contents_hash(self):
+        from time import gmtime, time
+        from tilequeue.metatile import metatile_contents_hash
+
+        json = "{\"json\":true}"
+        tiles = [dict(tile=json, coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+
+        # the hash should only depend on the contents, not the timestamps.
+        t = time()
+        metatile_1 = make_metatiles(1, tiles, gmtime(t - 10)[0:6])
+        metatile_2 = make_metatiles(1, tiles, gmtime(t)[0:6])
+        hash_1 = metatile_contents_hash(metatile_1[0]['tile'])
+        self.assertIsNotNone(hash_1)
+        self.assertEqual(
+            hash_1, metatile_contents_hash(metatile_2[0]['tile']))
+
+        tiles[0]['tile'] = "{\"json\":false}"
+        metatile_3 = make_metatiles(1, tiles)
+        self.assertNotEqual(
+            hash_1, metatile_contents_hash(metatile_3[0]['tile']))
+
+        self.assertIsNone(metatile_contents_hash('not a zip'))
+
     def test_metatile_common_parent(self):
         from tilequeue.metatile import common_parent
 
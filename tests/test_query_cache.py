@@ -0,0 +1,172 @@
+import unittest
+
+
+class TestQueryResultCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _cache(self, **kwargs):
+        from tilequeue.query.cache import QueryResultCache
+        return QueryResultCache(self.path, 9, 60, **kwargs)
+
+    def _bounds(self, z, x, y):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.tile import coord_to_mercator_bounds
+        return coord_to_mercator_bounds(Coordinate(zoom=z, column=x, row=y))
+
+    def test_bounds_coord(self):
+        from tilequeue.query.cache import bounds_coord
+        for z, x, y in ((0, 0, 0), (5, 3, 17), (12, 4095, 0)):
+            coord = bounds_coord(self._bounds(z, x, y))
+            self.assertEqual((z, x, y), (coord.zoom, coord.column, coord.row))
+        minx, miny, maxx, maxy = self._bounds(5, 3, 17)
+        self.assertIsNone(bounds_coord((minx, miny, maxx + 1, maxy)))
+
+    def test_put_get(self):
+        cache = self._cache()
+        bounds = self._bounds(3, 1, 2)
+        key = cache.key('osm', 5, bounds, 'SELECT 1')
+        self.assertIsNone(cache.get('osm', key))
+        rows = [{'__id__': 1, '__geometry__': 'wkb', 'tags': {'a': 'b'}}]
+        cache.put(key, rows)
+        self.assertEqual(rows, cache.get('osm', key))
+        # empty results are cached too.
+        other_key = cache.key('osm', 5, bounds, 'SELECT 2')
+        cache.put(other_key, [])
+        self.assertEqual([], cache.get('osm', other_key))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertTrue(stats['bytes_saved'] > 0)
+
+    def test_bytes_saved_uncompressed(self):
+        import cPickle
+        cache = self._cache()
+        key = cache.key('osm', 5, self._bounds(3, 1, 2), 'SELECT 1')
+        rows = [{'__id__': 1, '__geometry__': 'x' * 1000}]
+        cache.put(key, rows)
+        cache.get('osm', key)
+        self.assertEqual(
+            len(cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL)),
+            cache.stats()['bytes_saved'])
+
+    def test_max_bytes(self):
+        import os
+        import time
+        cache = self._cache(source_ttls=dict(ne=3600))
+        rows = [{'__id__': 1, '__geometry__': os.urandom(1000)}]
+        now = time.time()
+        keys = []
+        for i in xrange(5):
+            key = cache.key('ne', 5, self._bounds(3, i, 0), 'SELECT 1')
+            cache.put(key, rows)
+            os.utime(key, (now - 100 + i, now - 100 + i))
+            keys.append(key)
+        expired_key = cache.key('osm', 5, self._bounds(3, 0, 1), 'SELECT 1')
+        cache.put(expired_key, rows)
+        os.utime(expired_key, (now - 120, now - 120))
+        size = os.path.getsize(keys[0])
+
+        # the expired entry is removed, and then the oldest until the total
+        # is back under the budget, less the evict_fraction.
+        cache.max_bytes = 3 * size
+        new_key = cache.key('ne', 5, self._bounds(3, 9, 0), 'SELECT 1')
+        cache.put(new_key, rows)
+        self.assertFalse(os.path.exists(expired_key))
+        self.assertEqual([False, False, False, False, True],
+                         map(os.path.exists, keys))
+        self.assertTrue(os.path.exists(new_key))
+        self.assertEqual(5, cache.stats()['evictions'])
+
+    def test_not_cached(self):
+        cache = self._cache(source_ttls=dict(live=0))
+        bounds = self._bounds(3, 1, 2)
+        self.assertIsNone(cache.key('osm', 10, bounds, 'SELECT 1'))
+        self.assertIsNone(cache.key('live', 5, bounds, 'SELECT 1'))
+        self.assertIsNone(cache.key('osm', 5, (0, 0, 1, 2), 'SELECT 1'))
+
+    def test_ttl(self):
+        import os
+        import time
+        cache = self._cache(source_ttls=dict(ne=3600))
+        bounds = self._bounds(3, 1, 2)
+        keys = dict((source, cache.key(source, 5, bounds, 'SELECT 1'))
+                    for source in ('osm', 'ne'))
+        old = time.time() - 120
+        for key in keys.values():
+            cache.put(key, [{'__id__': 1}])
+            os.utime(key, (old, old))
+        self.assertIsNone(cache.get('osm', keys['osm']))
+        self.assertFalse(os.path.exists(keys['osm']))
+        self.assertEqual([{'__id__': 1}], cache.get('ne', keys['ne']))
+
+    def test_invalidate(self):
+        from tilequeue.tile import deserialize_coord
+        cache = self._cache()
+        keys = {}
+        for tile in ((2, 0, 0), (2, 1, 1), (4, 4, 4), (4, 8, 8)):
+            for source in ('osm', 'ne'):
+                key = cache.key(source, 8, self._bounds(*tile), 'SELECT 1')
+                cache.put(key, [])
+                keys[tile + (source,)] = key
+
+        # an expired z16 tile under 2/1/1 and 4/4/4, and a z1 tile over
+        # 2/0/0, 2/1/1 and 4/4/4.
+        coords = [deserialize_coord('16/%d/%d' % (4 << 12, 4 << 12)),
+                  deserialize_coord('1/0/0')]
+        self.assertEqual(3, cache.invalidate(coords, ['osm']))
+        gone = set(k for k, key in keys.items()
+                   if cache.get(k[3], key) is None)
+        self.assertEqual(set([(2, 0, 0, 'osm'), (2, 1, 1, 'osm'),
+                              (4, 4, 4, 'osm')]), gone)
+
+        self.assertEqual(3, cache.invalidate(coords))
+        self.assertIsNotNone(cache.get('ne', keys[(4, 8, 8, 'ne')]))
+
+
+class _FakeQueriesGenerator(object):
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def source_queries(self, zoom, bounds):
+        return self.queries
+
+
+class TestDataFetcherCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def test_cached_sources_skip_queries(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.cache import QueryResultCache
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        cache = QueryResultCache(self.path, 9, 60)
+        bounds = coord_to_mercator_bounds(Coordinate(zoom=2, column=1, row=1))
+        for name in ('osm', 'ne'):
+            key = cache.key(name, 4, bounds, 'SELECT %s' % name)
+            cache.put(key, [{'__id__': name}])
+
+        queries = _FakeQueriesGenerator(
+            [('osm', 'SELECT osm'), ('ne', 'SELECT ne')])
+        fetcher = DataFetcher(dict(dbnames=['osm']), queries, None, cache)
+        # no queries need to be run, so neither the pool nor any connections
+        # are used.
+        rows = fetcher(4, bounds)
+        self.assertEqual(['osm', 'ne'], [row['__id__'] for row in rows])
+        self.assertEqual(2, cache.stats()['hits'])
@@ -116,3 +116,47 @@ class TestCommon(unittest.TestCase):
 
         self.assertEquals(['road', 'US:I:Business:Loop', '70'],
                           layer_props.get('mz_networks'))
+
+
+class TestWkbEnvelope(unittest.TestCase):
+
+    def _shapes(self):
+        from shapely.geometry import GeometryCollection
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        square = Polygon([(0, 0), (10, 0), (10, 10), (0, 10)],
+                         [[(2, 2), (3, 2), (3, 3)]])
+        return [
+            Point(1.5, -2),
+            Point(1, 2, 3),
+            LineString([(-5, 1), (3, -7), (2, 2)]),
+            square,
+            MultiPolygon([square, Polygon([(20, 20), (21, 20), (21, 25)])]),
+            GeometryCollection([Point(-1, -1), LineString([(4, 4), (5, 9)])]),
+        ]
+
+    def test_matches_shapely(self):
+        from shapely import wkb
+        from tilequeue.query.common import wkb_envelope
+        from tilequeue.query.common import wkb_geom_type
+        for shape in self._shapes():
+            for big_endian in (False, True):
+                shape_wkb = wkb.dumps(shape, big_endian=big_endian)
+                self.assertEqual(shape.bounds, wkb_envelope(shape_wkb))
+                self.assertEqual(shape.geom_type, wkb_geom_type(shape_wkb))
+
+    def test_ewkb_srid(self):
+        import struct
+        from tilequeue.query.common import wkb_envelope
+        # a linestring with the EWKB SRID flag, as PostGIS would write it.
+        shape_wkb = struct.pack(
+            '<BIII4d', 1, 2 | 0x20000000, 3857, 2, 0, 1, 2, 3)
+        self.assertEqual((0, 1, 2, 3), wkb_envelope(shape_wkb))
+
+    def test_empty(self):
+        from tilequeue.query.common import wkb_envelope
+        from shapely import wkb
+        from shapely.geometry import LineString
+        self.assertIsNone(wkb_envelope(wkb.dumps(LineString())))
@@ -0,0 +1,203 @@
+import unittest
+
+
+class _FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def execute(self, query):
+        import psycopg2
+        self.conn.queries.append(query)
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection')
+
+
+class _FakeConn(object):
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.last_used = 0
+        self.closed = False
+        self.broken = False
+        self.queries = []
+
+    def get_transaction_status(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class TestDBConnectionPool(unittest.TestCase):
+
+    def _make_pool(self, dbnames, **kwargs):
+        from tilequeue.query.pool import DBConnectionPool
+
+        class _Pool(DBConnectionPool):
+            made = []
+
+            def _make_conn(self, dbname):
+                conn = _FakeConn(dbname)
+                self.made.append(conn)
+                return conn
+
+        return _Pool(dbnames, {}, **kwargs)
+
+    def test_reuse(self):
+        pool = self._make_pool(['a', 'b'])
+        with pool.get_conns(2) as conns:
+            first_conns = list(conns)
+            self.assertEqual(['a', 'b'], [c.dbname for c in conns])
+        with pool.get_conns(2) as conns:
+            self.assertEqual(set(first_conns), set(conns))
+
+        stats = pool.stats()
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(2, stats['reused'])
+        self.assertEqual(2, stats['open'])
+        self.assertEqual(2, stats['idle'])
+
+    def test_closed_conns_are_replaced(self):
+        pool = self._make_pool(['a'])
+        with pool.get_conns(1) as conns:
+            # e.g: execute_query closes the connection after an error
+            conns[0].close()
+        self.assertEqual(1, pool.stats()['discarded'])
+        self.assertEqual(0, pool.stats()['open'])
+
+        with pool.get_conns(1) as conns:
+            self.assertFalse(conns[0].closed)
+        self.assertEqual(2, len(pool.made))
+
+    def test_health_check(self):
+        pool = self._make_pool(['a'], health_check_interval=0)
+        with pool.get_conns(1) as conns:
+            conn = conns[0]
+        conn.broken = True
+
+        with pool.get_conns(1) as conns:
+            self.assertIsNot(conn, conns[0])
+        self.assertTrue(conn.closed)
+        self.assertEqual(['SELECT 1'], conn.queries)
+        self.assertEqual(1, pool.stats()['health_check_failures'])
+        self.assertEqual(1, pool.stats()['open'])
+
+    def test_bounded(self):
+        import threading
+        pool = self._make_pool(['a'], max_conns_per_db=2)
+        ctx = pool.get_conns(2)
+        got_conns = threading.Event()
+
+        def get_conn():
+            with pool.get_conns(1):
+                got_conns.set()
+
+        thread = threading.Thread(target=get_conn)
+        thread.start()
+        # the pool is exhausted, so the thread must wait.
+        self.assertFalse(got_conns.wait(0.1))
+        with ctx:
+            pass
+        thread.join()
+        self.assertTrue(got_conns.is_set())
+        self.assertEqual(2, len(pool.made))
+        self.assertEqual(1, pool.stats()['waits'])
+
+    def test_connect_failure_releases_slots(self):
+        from tilequeue.query.pool import DBConnectionPool
+
+        class _FailingPool(DBConnectionPool):
+
+            def _make_conn(self, dbname):
+                raise RuntimeError('cannot connect')
+
+        pool = _FailingPool(['a'], {}, max_conns_per_db=1)
+        for _ in xrange(2):
+            with self.assertRaises(RuntimeError):
+                pool.get_conns(1)
+        self.assertEqual(0, pool.stats()['open'])
+
+    def test_make_db_conn_pool_pops_options(self):
+        from tilequeue.query.pool import make_db_conn_pool
+        conn_info = {'dbnames': ['a'], 'user': 'osm', 'max-conns-per-db': 4,
+                     'health-check-interval': 5}
+        pool = make_db_conn_pool(conn_info)
+        self.assertEqual({'user': 'osm'}, pool.conn_info)
+        self.assertEqual(4, pool.max_conns_per_db)
+        self.assertEqual(5, pool.health_check_interval)
+        # the config itself shouldn't be modified.
+        self.assertEqual(4, conn_info['max-conns-per-db'])
+
+    def test_prefers_fast_databases(self):
+        import random
+        random.seed(1)
+        pool = self._make_pool(['a', 'b', 'c'])
+        for _ in xrange(10):
+            pool.observe('a', 0.01)
+            pool.observe('b', 2.0)
+            pool.observe('c', 0.01, error=True)
+        # each choice is between two random databases, so the slow one is
+        # never chosen and the failing one only when the other is the slow
+        # one.
+        chosen = []
+        for _ in xrange(30):
+            with pool.get_conns(1) as conns:
+                chosen.append(conns[0].dbname)
+        self.assertNotIn('b', chosen)
+        self.assertTrue(chosen.count('a') > chosen.count('c'))
+
+    def test_avoid_and_non_blocking(self):
+        pool = self._make_pool(['a', 'b'], max_conns_per_db=1)
+        with pool.get_conns(1, avoid=('a',)) as conns:
+            self.assertEqual('b', conns[0].dbname)
+            ctx = pool.get_conns(1, avoid=('b',), block=False)
+            self.assertEqual('a', ctx.conns[0].dbname)
+            # the pool is exhausted.
+            self.assertIsNone(pool.get_conns(1, block=False))
+            pool.put_conns(ctx.conns)
+
+    def test_exclude(self):
+        pool = self._make_pool(['a', 'b'])
+        for _ in xrange(10):
+            with pool.get_conns(2, exclude=('a',)) as conns:
+                self.assertEqual(['b', 'b'], [c.dbname for c in conns])
+        # no database is left to use.
+        self.assertIsNone(pool.get_conns(1, exclude=('a', 'b')))
+
+    def test_capped_per_database(self):
+        pool = self._make_pool(['a', 'b', 'c'], max_conns_per_db=2)
+        for _ in xrange(20):
+            # however the databases are scored, each can only take two.
+            pool.observe('a', 0.001)
+            with pool.get_conns(6) as conns:
+                dbnames = sorted(conn.dbname for conn in conns)
+            self.assertEqual(['a', 'a', 'b', 'b', 'c', 'c'], dbnames)
+
+        for _ in xrange(20):
+            with pool.get_conns(2):
+                # the four free slots are used, wherever they are, without
+                # waiting.
+                ctx = pool.get_conns(4, block=False)
+                self.assertIsNotNone(ctx)
+                self.assertIsNone(pool.get_conns(1, block=False))
+                pool.put_conns(ctx.conns)
+
+        with self.assertRaises(AssertionError):
+            pool.get_conns(7)
+
+    def test_statement_timeout_popped(self):
+        from tilequeue.query.pool import make_db_conn_pool
+        pool = make_db_conn_pool({'dbnames': ['a'], 'statement-timeout': 500})
+        self.assertEqual({}, pool.conn_info)
+        self.assertEqual(500, pool.statement_timeout)
@@ -0,0 +1,565 @@
+import unittest
+
+
+class _TemplatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.template_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.template_path)
+
+    def _write(self, name, text):
+        import os
+        with open(os.path.join(self.template_path, name), 'w') as fh:
+            fh.write(text)
+
+    def _generator(self, parameterize=True):
+        from tilequeue.query.postgres import make_jinja_environment
+        from tilequeue.query.postgres import TemplateFinder
+        from tilequeue.query.postgres import TemplateQueryGenerator
+        env = make_jinja_environment(self.template_path)
+        return TemplateQueryGenerator(
+            TemplateFinder(env, True), parameterize=parameterize)
+
+
+class TestCompileTemplate(_TemplatesTestCase):
+
+    bounds = (-20037508.342789244, 1.5, 2.25, 20037508.342789244)
+
+    def _literal_sql(self, query):
+        # substitute the parameters back in the way the bbox filters do.
+        values = iter(query.params)
+        return ''.join('%.12f' % next(values) if part is None else part
+                       for part in query.parts)
+
+    def test_bbox_filters(self):
+        from tilequeue.query.postgres import BoundQuery
+        self._write('t.jinja2', """
+SELECT {{ 'way'|geometry }}, {{ zoom }} AS zoom,
+  {{ bounds['polygon']|bbox_padded_intersection('way') }} AS clipped
+FROM planet_osm_polygon
+WHERE {{ bounds['polygon']|bbox_filter('way') }}
+  AND {{ bounds['line']|bbox_overlaps('way', 900913) }}
+  AND name LIKE 'a%'
+""")
+        gen = self._generator()
+        query = gen('t.jinja2', self.bounds, 10)
+        self.assertIsInstance(query, BoundQuery)
+        self.assertEqual(
+            gen.render('t.jinja2', self.bounds, 10), self._literal_sql(query))
+        self.assertEqual(16, len(query.params))
+
+        # percent signs are escaped for psycopg2, but not for PREPARE.
+        self.assertIn("LIKE 'a%%'", query.sql())
+        self.assertIn("LIKE 'a%'", query.prepared_sql())
+        self.assertIn('$16', query.prepared_sql())
+
+        # the compiled query is reused for other bounds at the same zoom.
+        other_bounds = (1, 2, 3, 4)
+        query = gen('t.jinja2', other_bounds, 10)
+        self.assertEqual(
+            gen.render('t.jinja2', other_bounds, 10),
+            self._literal_sql(query))
+        self.assertEqual(1, len(gen.compiled))
+
+    def test_fallback(self):
+        # templates which use the bounds other than through the filters are
+        # rendered every time.
+        self._write('t.jinja2', """
+SELECT * FROM t WHERE x > {{ bounds['point'][0] }}
+""")
+        gen = self._generator()
+        query = gen('t.jinja2', self.bounds, 10)
+        self.assertEqual(gen.render('t.jinja2', self.bounds, 10), query)
+        self.assertIsNone(gen.compiled[('t.jinja2', 10)])
+
+    def test_sources_union(self):
+        from tilequeue.query.postgres import BoundQuery
+        from tilequeue.query.postgres import DataSource
+        from tilequeue.query.postgres import SourcesQueriesGenerator
+        from tilequeue.query.postgres import TemplateSpec
+        self._write('a.jinja2', "SELECT 1 WHERE {{ bounds.point|bbox }}")
+        self._write('b.jinja2', "SELECT {{ bounds.point[0] }}")
+        sources = [DataSource('s', [TemplateSpec('a.jinja2', 0, 21),
+                                    TemplateSpec('b.jinja2', 0, 21)])]
+        queries = SourcesQueriesGenerator(sources, self._generator())(
+            10, self.bounds)
+        self.assertEqual(1, len(queries))
+        query = queries[0]
+        self.assertIsInstance(query, BoundQuery)
+        self.assertEqual(4, len(query.params))
+        self.assertEqual(
+            'SELECT 1 WHERE ST_SetSrid(ST_MakeBox2D(ST_MakePoint(%s, %s), '
+            'ST_MakePoint(%s, %s)), 3857)\nUNION ALL\nSELECT '
+            '-20037508.3428', query.sql())
+
+
+class _FakeCursor(object):
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+        self.itersize = None
+        self.description = [('__id__',), ('__geometry__',), ('name',)]
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+
+    def __iter__(self):
+        return iter(self.conn.rows)
+
+    def close(self):
+        pass
+
+
+class _FakeConn(object):
+
+    def __init__(self, rows=()):
+        self.executed = []
+        self.rows = rows
+        self.prepared_statements = None
+        self.autocommit = True
+        self.cursors = []
+        self.commits = 0
+
+    def cursor(self, name=None):
+        cursor = _FakeCursor(self, name)
+        self.cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestExecuteQuery(unittest.TestCase):
+
+    def test_prepared(self):
+        from tilequeue.query.postgres import BoundQuery
+        from tilequeue.query.postgres import execute_query
+        query = BoundQuery(['SELECT ', None, ', ', None], [1.5, 2.5])
+        name = query.statement_name()
+        conn = _FakeConn()
+        execute_query(conn, query, prepare=True)
+        execute_query(conn, query, prepare=True)
+        self.assertEqual([
+            ('PREPARE %s (float8, float8) AS SELECT $1, $2' % name, None),
+            ('EXECUTE %s (%%s, %%s)' % name, [1.5, 2.5]),
+            ('EXECUTE %s (%%s, %%s)' % name, [1.5, 2.5]),
+        ], conn.executed)
+
+    def test_not_prepared(self):
+        from tilequeue.query.postgres import BoundQuery
+        from tilequeue.query.postgres import execute_query
+        conn = _FakeConn()
+        execute_query(conn, BoundQuery(["SELECT '%', ", None], [1.5]))
+        execute_query(conn, 'SELECT 1')
+        self.assertEqual([("SELECT '%%', %s", [1.5]), ('SELECT 1', None)],
+                         conn.executed)
+
+    def test_read_rows(self):
+        from tilequeue.query.postgres import execute_query
+        conn = _FakeConn([(1, buffer('wkb'), None), (2, buffer('wkb2'), 'a')])
+        rows = execute_query(conn, 'SELECT 1')
+        self.assertEqual([(1, 'wkb', None), (2, 'wkb2', 'a')], rows)
+        self.assertIs(bytes, type(rows[0][1]))
+        self.assertEqual(['wkb', 'wkb2'], rows.column('__geometry__'))
+        self.assertIsNone(rows.column('missing'))
+        self.assertEqual([
+            {'__id__': 1, '__geometry__': 'wkb'},
+            {'__id__': 2, '__geometry__': 'wkb2', 'name': 'a'},
+        ], rows.dicts())
+
+    def test_server_side_cursor(self):
+        from tilequeue.query.postgres import BoundQuery
+        from tilequeue.query.postgres import execute_query
+        conn = _FakeConn([(1, buffer('wkb'), 'a')])
+        query = BoundQuery(['SELECT ', None], [1.5])
+        rows = execute_query(
+            conn, query, prepare=True, server_side_cursor=True, itersize=10)
+        self.assertEqual(
+            [{'__id__': 1, '__geometry__': 'wkb', 'name': 'a'}], rows.dicts())
+        # named cursors can't run prepared statements.
+        self.assertEqual([('SELECT %s', [1.5])], conn.executed)
+        cursor, = conn.cursors
+        self.assertIsNotNone(cursor.name)
+        self.assertEqual(10, cursor.itersize)
+        self.assertEqual(1, conn.commits)
+        self.assertTrue(conn.autocommit)
+
+
+class TestBatchFetch(unittest.TestCase):
+
+    def _row(self, fid, minx, miny, maxx, maxy):
+        from shapely.geometry import box
+        return {'__id__': fid,
+                '__geometry__': box(minx, miny, maxx, maxy).wkb}
+
+    def test_partition(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.postgres import BatchFetch
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coords = [Coordinate(zoom=1, column=x, row=y)
+                  for x in (0, 1) for y in (0, 1)]
+        calls = []
+
+        def fetch(zoom, bounds):
+            calls.append((zoom, bounds))
+            # one row in the top left, one spanning the whole world and one
+            # touching the edge between the two bottom tiles.
+            return [
+                self._row(1, -1e7, 1e7, -1e7 + 1, 1e7 + 1),
+                self._row(2, -2e7, -2e7, 2e7, 2e7),
+                self._row(3, -1, -1e7, 0, -1e7 + 1),
+            ]
+
+        batch = BatchFetch(fetch, coords)
+        rows = {}
+        for coord in coords:
+            fetcher = batch.fetcher_for(coord)
+            rows[(coord.column, coord.row)] = sorted(
+                row['__id__'] for row in fetcher(
+                    3, coord_to_mercator_bounds(coord)))
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(3, calls[0][0])
+        self.assertEqual(coord_to_mercator_bounds(Coordinate(0, 0, 0)),
+                         calls[0][1])
+        self.assertEqual({(0, 0): [1, 2], (1, 0): [2],
+                          (0, 1): [2, 3], (1, 1): [2, 3]}, rows)
+
+    def test_padding(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.postgres import BatchFetch
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coords = [Coordinate(zoom=1, column=x, row=0) for x in (0, 1)]
+
+        def fetch(zoom, bounds):
+            # a row just to the right of the edge between the tiles, which
+            # is in the left tile's buffer, and an empty geometry.
+            from shapely.geometry import Point
+            return [self._row(1, 1e5, 1e7, 1e5 + 1, 1e7 + 1),
+                    {'__id__': 2, '__geometry__': Point().wkb}]
+
+        for pad_factor, expected in ((1.0, [[], [1]]), (1.1, [[1], [1]])):
+            batch = BatchFetch(fetch, coords, pad_factor)
+            rows = [[row['__id__'] for row in batch.fetcher_for(coord)(
+                        1, coord_to_mercator_bounds(coord))]
+                    for coord in coords]
+            self.assertEqual(expected, rows)
+
+    def test_same_as_per_tile(self):
+        from ModestMaps.Core import Coordinate
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.query.postgres import DataSource
+        from tilequeue.query.postgres import SourcesQueriesGenerator
+        from tilequeue.query.postgres import TemplateSpec
+        from tilequeue.query.postgres import TemplateQueryGenerator
+        from tilequeue.query.postgres import TemplateFinder
+        from tilequeue.query.postgres import make_jinja_environment
+        from tilequeue.tile import coord_to_mercator_bounds
+        import os
+        import shutil
+        import tempfile
+
+        # rows next to, on and across the edges between the tiles.
+        rows = []
+        for i, dx in enumerate((-1e5, -1, 0, 1, 1e5, -9e6)):
+            for j, dy in enumerate((-1e5, 0, 1e5)):
+                x, y = 1e7 + dx, -1e7 + dy
+                rows.append(self._row(i * 3 + j, x, y, x + 1, y + 1))
+        rows.append(self._row(100, 1e7 - 2e5, -1e7 - 2e5, 1e7 + 2e5,
+                              -1e7 + 2e5))
+        conn = _BboxFilterConn('a', rows)
+
+        template_path = tempfile.mkdtemp()
+        io_pool = ThreadPool(2)
+        try:
+            for name, template in (
+                    ('plain.jinja2', "SELECT * FROM t WHERE "
+                     "{{ bounds['polygon']|bbox_filter('way') }}"),
+                    ('padded.jinja2', "SELECT {{ bounds['polygon']|"
+                     "bbox_padded_intersection('way') }} FROM t WHERE "
+                     "{{ bounds['polygon']|bbox_filter('way') }}")):
+                with open(os.path.join(template_path, name), 'w') as fh:
+                    fh.write(template)
+            env = make_jinja_environment(template_path)
+
+            def fetch_all(template, batch_max_tiles):
+                sources = [DataSource('osm', [TemplateSpec(template, 0, 21)])]
+                generator = SourcesQueriesGenerator(sources, (
+                    TemplateQueryGenerator(TemplateFinder(env, True), True)))
+                fetcher = DataFetcher(
+                    {'dbnames': ['a'], 'batch-max-tiles': batch_max_tiles},
+                    generator, io_pool)
+                fetcher.sql_conn_pool = _ObservingPool([conn])
+                coords = [Coordinate(zoom=2, column=x, row=y)
+                          for x in (2, 3) for y in (2, 3)]
+                del conn.executed[:]
+                result = {}
+                for fetch, data in fetcher.fetch_tiles(
+                        [dict(coord=c) for c in coords]):
+                    coord = data['coord']
+                    result[(coord.column, coord.row)] = sorted(
+                        row['__id__'] for row in fetch(
+                            coord.zoom, coord_to_mercator_bounds(coord)))
+                return result, len(conn.executed)
+
+            per_tile, n_queries = fetch_all('plain.jinja2', None)
+            self.assertEqual(4, n_queries)
+            batched, n_queries = fetch_all('plain.jinja2', 4)
+            self.assertEqual(1, n_queries)
+            self.assertEqual(per_tile, batched)
+
+            # the padded intersection would be clipped to the whole batch.
+            _, n_queries = fetch_all('padded.jinja2', 4)
+            self.assertEqual(4, n_queries)
+        finally:
+            io_pool.close()
+            io_pool.join()
+            shutil.rmtree(template_path)
+
+    def test_batch_coords(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.postgres import batch_coords
+        from tilequeue.tile import coord_children_range
+        parent = Coordinate(zoom=10, column=0, row=0)
+        coords = [parent] + list(coord_children_range(parent, 13))
+        batches = batch_coords([dict(coord=c) for c in coords], 16)
+        sizes = sorted((b[0]['coord'].zoom, len(b)) for b in batches)
+        self.assertEqual(
+            [(10, 1), (11, 4), (12, 16)] + [(13, 16)] * 4, sizes)
+
+
+class _StallingConn(_FakeConn):
+
+    def __init__(self, dbname, rows=(), stall=False):
+        import threading
+        super(_StallingConn, self).__init__(rows)
+        self.dbname = dbname
+        self.stall = stall
+        self.cancelled = threading.Event()
+        self.closed = False
+
+    def cursor(self, name=None):
+        conn = self
+
+        class _Cursor(_FakeCursor):
+            def execute(self, sql, params=None):
+                super(_Cursor, self).execute(sql, params)
+                if conn.stall:
+                    conn.cancelled.wait(5)
+                    raise Exception('canceling statement due to user request')
+
+        return _Cursor(self, name)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def close(self):
+        self.closed = True
+
+
+class _BboxFilterConn(_StallingConn):
+
+    # returns the rows, as dicts of __id__ and __geometry__, whose bounding
+    # box overlaps the last four parameters of the query, as the bbox filter
+    # does.
+
+    def cursor(self, name=None):
+        from shapely import wkb
+        conn = self
+
+        class _Cursor(_FakeCursor):
+            def execute(self, sql, params=None):
+                super(_Cursor, self).execute(sql, params)
+                minx, miny, maxx, maxy = params[-4:]
+                self.matched = []
+                for row in conn.rows:
+                    bounds = wkb.loads(row['__geometry__']).bounds
+                    if bounds[0] <= maxx and bounds[2] >= minx and \
+                       bounds[1] <= maxy and bounds[3] >= miny:
+                        self.matched.append(
+                            (row['__id__'], buffer(row['__geometry__']),
+                             None))
+
+            def __iter__(self):
+                return iter(self.matched)
+
+        return _Cursor(self, name)
+
+
+class _ObservingPool(object):
+
+    def __init__(self, conns):
+        self.conns = conns
+        self.observed = []
+        self.latencies = {}
+        self.returned = []
+
+    def observe(self, dbname, latency, error=False):
+        self.observed.append((dbname, error))
+        self.latencies[dbname] = latency
+
+    def get_conns(self, n_conn, avoid=(), block=True, exclude=()):
+        from tilequeue.query.pool import ConnectionsContextManager
+        conns = [c for c in self.conns
+                 if c.dbname not in avoid and c.dbname not in exclude]
+        if not conns:
+            return None
+        return ConnectionsContextManager(conns[:n_conn], self)
+
+    def put_conns(self, conns):
+        self.returned.extend(conns)
+
+
+class TestHedgedQueries(unittest.TestCase):
+
+    def test_straggler_is_hedged_and_cancelled(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+
+        slow = _StallingConn('a', stall=True)
+        fast = _StallingConn('b', rows=[(1, buffer('wkb'), 'x')])
+        io_pool = ThreadPool(4)
+
+        class _Generator(object):
+            def source_queries(self, zoom, bounds):
+                return [('osm', 'SELECT 1')]
+
+        fetcher = DataFetcher(
+            {'dbnames': ['a', 'b'], 'hedge-percentile': 95,
+             'hedge-min-delay': 0}, _Generator(), io_pool)
+        fetcher.hedge_min_samples = 1
+        fetcher.latencies[('osm', 10)] = [0.01]
+        fetcher.sql_conn_pool = _ObservingPool([slow, fast])
+
+        rows = fetcher(10, (0, 0, 1, 1))
+        self.assertEqual([{'__id__': 1, '__geometry__': 'wkb', 'name': 'x'}],
+                         rows)
+        self.assertTrue(slow.cancelled.is_set())
+        # the cancelled query isn't counted as an error, but its latency is
+        # still recorded, at more than the winner's, and both connections
+        # went back to the pool.
+        pool = fetcher.sql_conn_pool
+        self.assertEqual([('a', False), ('b', False)], sorted(pool.observed))
+        self.assertTrue(pool.latencies['a'] > pool.latencies['b'])
+        self.assertEqual(set([slow, fast]),
+                         set(fetcher.sql_conn_pool.returned))
+        io_pool.close()
+        io_pool.join()
+
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_stats_and_slow_query_log(self):
+        import json
+        import logging
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+
+        conn = _StallingConn('a', rows=[(1, buffer('wkb'), 'x'),
+                                        (2, None, 'y')])
+        io_pool = ThreadPool(2)
+
+        class _Generator(object):
+            def source_queries(self, zoom, bounds):
+                return [('osm', 'SELECT 1')]
+
+        class _Handler(logging.Handler):
+            records = []
+
+            def emit(self, record):
+                self.records.append(json.loads(record.getMessage()))
+
+        fetcher = DataFetcher({'dbnames': ['a'], 'slow-query-ms': 0},
+                              _Generator(), io_pool)
+        fetcher.sql_conn_pool = _ObservingPool([conn])
+        handler = _Handler()
+        fetcher.slow_query_logger.addHandler(handler)
+        try:
+            rows = fetcher(10, (0, 0, 1, 1))
+        finally:
+            fetcher.slow_query_logger.removeHandler(handler)
+            io_pool.close()
+            io_pool.join()
+
+        stats = rows.query_stats['osm']
+        self.assertEqual(2, stats['rows'])
+        self.assertEqual(3, stats['bytes'])
+        self.assertFalse(stats['hedged'])
+
+        slow_query, = handler.records
+        self.assertEqual('osm', slow_query['source'])
+        self.assertEqual('SELECT 1', slow_query['sql'])
+        self.assertEqual([0, 0, 1, 1], slow_query['bounds'])
+
+    def test_slow_query_explained_off_io_pool(self):
+        import json
+        import logging
+        import threading
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.postgres import DataFetcher
+
+        conn = _StallingConn('a', rows=[(1, buffer('wkb'), 'x')])
+        io_pool = ThreadPool(1)
+
+        class _Generator(object):
+            def source_queries(self, zoom, bounds):
+                return [('osm', 'SELECT 1')]
+
+        class _Handler(logging.Handler):
+            records = []
+
+            def emit(self, record):
+                self.records.append(json.loads(record.getMessage()))
+
+        fetcher = DataFetcher(
+            {'dbnames': ['a'], 'slow-query-ms': 0,
+             'slow-query-explain': True}, _Generator(), io_pool)
+        fetcher.sql_conn_pool = _ObservingPool([conn])
+        handler = _Handler()
+        fetcher.slow_query_logger.addHandler(handler)
+        release = threading.Event()
+        try:
+            fetcher(10, (0, 0, 1, 1))
+            # the plan is captured even while the io pool is busy.
+            io_pool.apply_async(release.wait, (5,))
+            fetcher.explain_pool.close()
+            fetcher.explain_pool.join()
+        finally:
+            release.set()
+            fetcher.slow_query_logger.removeHandler(handler)
+            io_pool.close()
+            io_pool.join()
+
+        slow_query, = handler.records
+        self.assertTrue('explain' in slow_query or
+                        'explain_error' in slow_query)
+        self.assertFalse(fetcher.explaining)
+
+    def test_batch_stats_counted_once(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.query.postgres import BatchFetch
+        from tilequeue.query.postgres import SourceRows
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        def fetch(zoom, bounds):
+            rows = SourceRows()
+            rows.query_stats = dict(osm=dict(time=5, rows=0, bytes=0))
+            return rows
+
+        coords = [Coordinate(zoom=1, column=x, row=0) for x in (0, 1)]
+        batch = BatchFetch(fetch, coords)
+        all_stats = [
+            batch.fetcher_for(coord)(
+                3, coord_to_mercator_bounds(coord)).query_stats
+            for coord in coords]
+        self.assertEqual(
+            [dict(osm=dict(time=5, rows=0, bytes=0, batched=2)), None],
+            all_stats)
@@ -732,3 +732,509 @@ class TestTileFootprint(unittest.TestCase):
                 expected.add(Tile(tile.z, tile.x + dx, tile.y + dy))
 
         self.assertEquals(expected, tiles)
+
+
+class VersionedStorage(ConstantStorage):
+
+    def __init__(self, tables, version):
+        super(VersionedStorage, self).__init__(tables)
+        self.current_version = version
+        self.calls = 0
+        self.checks = 0
+
+    def __call__(self, top_tile):
+        from tilequeue.rawr import RawrTables
+        self.calls += 1
+        return RawrTables(self.tables, self.current_version)
+
+    def if_changed(self, top_tile, version):
+        self.checks += 1
+        if version == self.current_version:
+            return None
+        return self(top_tile)
+
+
+class TestRawrTileCache(unittest.TestCase):
+
+    def _fetcher(self, storage, tile_cache):
+        from tilequeue.query.common import LayerInfo
+        from tilequeue.query.rawr import make_rawr_data_fetcher
+
+        def min_zoom_fn(shape, props, fid, meta):
+            return 10
+
+        layers = {'testlayer': LayerInfo(min_zoom_fn, None)}
+        return make_rawr_data_fetcher(
+            10, 16, storage, layers, [dict(type='osm')],
+            tile_cache=tile_cache)
+
+    def test_reuse_by_version(self):
+        from shapely.geometry import Point
+        from tilequeue.query.rawr import RawrTileCache
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = Point(0, 0)
+        tables = TestGetTable({'planet_osm_point': [(0, shape.wkb, {})]})
+        storage = VersionedStorage(tables, '"etag1"')
+        tile_cache = RawrTileCache(1024 * 1024)
+        fetch = self._fetcher(storage, tile_cache)
+        coord = mercator_point_to_coord(10, shape.x, shape.y)
+
+        fetchers = []
+        for _ in xrange(2):
+            for fetcher, _ in fetch.fetch_tiles(_wrap(coord)):
+                fetchers.append(fetcher.rawr_tile)
+        self.assertIs(fetchers[0], fetchers[1])
+        # the second job only checked that the tile hadn't changed.
+        self.assertEqual(1, storage.calls)
+        self.assertEqual(1, storage.checks)
+
+        # a new version of the RAWR tile is fetched and indexed again.
+        storage.current_version = '"etag2"'
+        for fetcher, _ in fetch.fetch_tiles(_wrap(coord)):
+            self.assertIsNot(fetchers[0], fetcher.rawr_tile)
+        self.assertEqual(2, storage.calls)
+        self.assertEqual(2, storage.checks)
+
+        stats = tile_cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+        self.assertTrue(stats['bytes'] > 0)
+
+    def test_work_per_job(self):
+        from shapely.geometry import Point
+        from tilequeue.query.rawr import RawrTileCache
+        from tilequeue.tile import coord_to_mercator_bounds
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = Point(0, 0)
+        tables = TestGetTable({'planet_osm_point': [(0, shape.wkb, {})]})
+        storage = VersionedStorage(tables, '"etag1"')
+        tile_cache = RawrTileCache(1024 * 1024)
+        fetch = self._fetcher(storage, tile_cache)
+        coord = mercator_point_to_coord(10, shape.x, shape.y)
+
+        # jobs running at the same time on the cached tile each have their
+        # own memo, and don't leave it behind in the cached tile.
+        jobs = []
+        for _ in xrange(2):
+            fetcher, _ = next(fetch.fetch_tiles(_wrap(coord)))
+            jobs.append(fetcher)
+        self.assertIs(jobs[0].rawr_tile, jobs[1].rawr_tile)
+        for fetcher in jobs:
+            rows = fetcher(10, coord_to_mercator_bounds(coord))
+            self.assertEqual(1, len(rows))
+            self.assertTrue(fetcher._work)
+        self.assertIsNot(jobs[0]._work, jobs[1]._work)
+        self.assertEqual({}, jobs[0].rawr_tile._work)
+
+    def test_tables_closed_after_indexing(self):
+        from shapely.geometry import Point
+        from tilequeue.query.rawr import RawrTileCache
+        from tilequeue.rawr import RawrTables
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = Point(0, 0)
+        closed = []
+        tables = RawrTables(
+            TestGetTable({'planet_osm_point': [(0, shape.wkb, {})]}),
+            '"etag1"', lambda: closed.append(True))
+        fetch = self._fetcher(ConstantStorage(tables), RawrTileCache(1 << 20))
+        coord = mercator_point_to_coord(10, shape.x, shape.y)
+        list(fetch.fetch_tiles(_wrap(coord)))
+        self.assertEqual([True], closed)
+
+    def test_unversioned_storage_not_cached(self):
+        from tilequeue.query.rawr import RawrTileCache
+        from tilequeue.tile import mercator_point_to_coord
+        storage = ConstantStorage(TestGetTable({}))
+        tile_cache = RawrTileCache(1024)
+        fetch = self._fetcher(storage, tile_cache)
+        coord = mercator_point_to_coord(10, 0, 0)
+        for _ in xrange(2):
+            list(fetch.fetch_tiles(_wrap(coord)))
+        self.assertEqual(0, tile_cache.stats()['entries'])
+
+    def test_eviction(self):
+        from tilequeue.query.rawr import RawrTileCache
+        tile_cache = RawrTileCache(100)
+        tile_cache.put('a', object(), 60)
+        tile_cache.put('b', object(), 30)
+        self.assertIsNotNone(tile_cache.get('a'))
+        # 'b' is the least recently used now.
+        tile_cache.put('c', object(), 30)
+        self.assertIsNone(tile_cache.get('b'))
+        self.assertIsNotNone(tile_cache.get('a'))
+        # too big to cache at all.
+        tile_cache.put('d', object(), 101)
+        self.assertIsNone(tile_cache.get('d'))
+        self.assertEqual(1, tile_cache.stats()['evictions'])
+
+
+class TestTileIndex(unittest.TestCase):
+
+    def test_csr_lookup(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import TilePyramid
+        from tilequeue.query.rawr import _TileIndex
+
+        index = _TileIndex(TilePyramid(10, 4, 6, 12))
+        a = index.add_feature('a')
+        b = index.add_feature('b')
+        index.add(12, 17, 25, b)
+        index.add(12, 17, 25, a)
+        index.add(12, 16, 24, a)
+        index.add(11, 8, 12, a)
+        # outside the pyramid, so ignored.
+        index.add(12, 15, 24, b)
+        index.freeze()
+
+        self.assertEqual(['b', 'a'], index(Tile(12, 17, 25)))
+        self.assertEqual([0], list(index.feature_ids(Tile(12, 16, 24))))
+        self.assertEqual(['a'], index(Tile(11, 8, 12)))
+        self.assertEqual([], index(Tile(11, 9, 13)))
+        self.assertEqual([], index(Tile(10, 4, 6)))
+        self.assertEqual([], index(Tile(12, 15, 24)))
+
+
+class TestParallelIndex(unittest.TestCase):
+
+    def _fetch_all(self, fetcher, zoom, tile_pyramid):
+        from raw_tiles.tile import Tile
+        from tilequeue.tile import coord_to_mercator_bounds
+        from ModestMaps.Core import Coordinate
+
+        dz = zoom - tile_pyramid.z
+        rows = []
+        for x in xrange(tile_pyramid.x << dz, (tile_pyramid.x + 1) << dz):
+            for y in xrange(tile_pyramid.y << dz, (tile_pyramid.y + 1) << dz):
+                bounds = coord_to_mercator_bounds(
+                    Coordinate(zoom=zoom, column=x, row=y))
+                for row in fetcher(zoom, bounds):
+                    rows.append((Tile(zoom, x, y), row['__id__'],
+                                 sorted(k for k in row if k.endswith('s__'))))
+        return rows
+
+    def test_same_as_serial(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        from tilequeue.query.common import LayerInfo
+        from tilequeue.query.rawr import RawrTile
+        from tilequeue.query.rawr import TilePyramid
+        from tilequeue.query.rawr import make_index_pool
+        from tilequeue.tile import coord_to_mercator_bounds
+        from tilequeue.tile import mercator_point_to_coord
+
+        def min_zoom_fn(shape, props, fid, meta):
+            # gates on a highway appear earlier, which needs the ways from
+            # the OSM lookup.
+            if meta.ways:
+                return 11
+            return 10 + fid % 3
+
+        def props_fn(shape, props, fid, meta):
+            return dict(props)
+
+        layers = {
+            'pois': LayerInfo(min_zoom_fn, props_fn),
+            'water': LayerInfo(min_zoom_fn, props_fn),
+        }
+        coord = mercator_point_to_coord(10, 0, 0)
+        tile_pyramid = TilePyramid(
+            10, int(coord.column), int(coord.row), 12)
+        minx, miny, maxx, maxy = coord_to_mercator_bounds(coord)
+        width = maxx - minx
+
+        points = []
+        for i in xrange(40):
+            shape = Point(minx + width * (i % 7 + 0.5) / 7.0,
+                          miny + width * (i % 5 + 0.5) / 5.0)
+            points.append((i, shape.wkb, {'barrier': 'gate'}))
+        way = LineString([(minx, miny), (maxx, maxy)])
+        tables = TestGetTable({
+            'planet_osm_point': points,
+            'planet_osm_line': [(100, way.wkb, {'highway': 'primary'})],
+            'planet_osm_ways': [(100, [3, 4], ['highway', 'primary'])],
+            'water_polygons': [(200 + i, wkb, {}) for i, wkb, _ in points],
+        })
+        indexes_cfg = [
+            dict(type='osm'),
+            dict(type='simple', table='water_polygons', layer='water'),
+        ]
+
+        serial = RawrTile(layers, tables, tile_pyramid, {}, indexes_cfg)
+        pool = make_index_pool(2, layers)
+        try:
+            RawrTile.index_chunk_size = 7
+            parallel = RawrTile(layers, tables, tile_pyramid, {}, indexes_cfg,
+                                pool)
+        finally:
+            del RawrTile.index_chunk_size
+            pool.terminate()
+
+        for zoom in (10, 11, 12):
+            expected = self._fetch_all(serial, zoom, tile_pyramid)
+            self.assertTrue(expected)
+            self.assertEqual(
+                expected, self._fetch_all(parallel, zoom, tile_pyramid))
+
+
+class TestFeatureWork(RawrTestCase):
+
+    def test_zoomless_work_done_once(self):
+        from shapely.geometry import LineString
+        from tilequeue.query import rawr
+        from tilequeue.query.rawr import TilePyramid
+        from tilequeue.tile import coord_to_mercator_bounds
+        from tilequeue.tile import mercator_point_to_coord
+
+        shape = LineString([(1, -1), (2, -2)])
+        tables = TestGetTable({
+            'planet_osm_line': [(1, shape.wkb, {'highway': 'primary'})],
+            'planet_osm_rels': [
+                (2, 0, 1, [1], [''],
+                 ['type', 'route', 'route', 'bus', 'ref', '7'])],
+        })
+        coord = mercator_point_to_coord(10, 1, -1)
+        tile_pyramid = TilePyramid(
+            10, int(coord.column), int(coord.row), 16)
+        fetch = self._make(lambda *args: 10, None, tables, tile_pyramid,
+                           layer_name='roads')
+
+        calls = []
+        zoomless_layer_properties = rawr.zoomless_layer_properties
+
+        def counting(*args):
+            calls.append(args)
+            return zoomless_layer_properties(*args)
+
+        rawr.zoomless_layer_properties = counting
+        try:
+            props_by_zoom = {}
+            for fetcher, _ in fetch.fetch_tiles(_wrap(coord)):
+                for zoom in (11, 12, 12):
+                    feature_coord = mercator_point_to_coord(zoom, 1.5, -1.5)
+                    rows = fetcher(
+                        zoom, coord_to_mercator_bounds(feature_coord))
+                    self.assertEquals(1, len(rows))
+                    props_by_zoom[zoom] = rows[0]['__roads_properties__']
+        finally:
+            rawr.zoomless_layer_properties = zoomless_layer_properties
+
+        self.assertEquals(1, len(calls))
+        self.assertNotIn('is_bus_route', props_by_zoom[11])
+        self.assertTrue(props_by_zoom[12].get('is_bus_route'))
+        self.assertEquals(['bus', None, '7'],
+                          props_by_zoom[12]['mz_networks'])
+
+
+class _BlockingStorage(object):
+
+    def __init__(self):
+        import threading
+        self.calls = []
+        self.release = threading.Event()
+        self.fail = set()
+
+    def __call__(self, tile):
+        self.release.wait()
+        self.calls.append(tile)
+        if tile in self.fail:
+            self.fail.discard(tile)
+            raise IOError('transient')
+        return 'tables %r' % (tile,)
+
+
+class TestPrefetchingStorage(unittest.TestCase):
+
+    def _wait_for(self, storage, n):
+        import time
+        for _ in xrange(200):
+            if len(storage.calls) >= n:
+                return
+            time.sleep(0.01)
+
+    def test_prefetch_bounded(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import PrefetchingStorage
+
+        storage = _BlockingStorage()
+        prefetching = PrefetchingStorage(storage, 2)
+        tiles = [Tile(10, i, 0) for i in xrange(4)]
+        for tile in tiles:
+            prefetching.prefetch(tile)
+        self.assertEqual(2, prefetching.stats()['started'])
+        self.assertEqual(2, prefetching.stats()['upcoming'])
+
+        storage.release.set()
+        self._wait_for(storage, 2)
+        self.assertEqual(set(tiles[:2]), set(storage.calls))
+
+        # taking a prefetched tile starts the next one.
+        self.assertEqual('tables %r' % (tiles[0],), prefetching(tiles[0]))
+        self._wait_for(storage, 3)
+        self.assertEqual(tiles[2], storage.calls[2])
+
+        # a cancelled tile is fetched again if it's still needed.
+        prefetching.cancel(tiles[1])
+        self.assertEqual('tables %r' % (tiles[1],), prefetching(tiles[1]))
+        self.assertEqual(2, storage.calls.count(tiles[1]))
+
+        stats = prefetching.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['cancelled'])
+
+    def test_cancelled_fetch_keeps_slot(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import PrefetchingStorage
+
+        storage = _BlockingStorage()
+        prefetching = PrefetchingStorage(storage, 1)
+        tiles = [Tile(10, i, 0) for i in xrange(2)]
+        for tile in tiles:
+            prefetching.prefetch(tile)
+
+        # the first tile is still downloading, so the next can't start yet.
+        prefetching.cancel(tiles[0])
+        stats = prefetching.stats()
+        self.assertEqual(0, stats['started'])
+        self.assertEqual(1, stats['abandoned'])
+        self.assertEqual(1, stats['upcoming'])
+
+        storage.release.set()
+        self._wait_for(storage, 2)
+        self.assertEqual(tiles, storage.calls)
+        self.assertEqual('tables %r' % (tiles[1],), prefetching(tiles[1]))
+        stats = prefetching.stats()
+        self.assertEqual(0, stats['abandoned'])
+        self.assertEqual(1, stats['hits'])
+
+    def test_failed_prefetch_retried(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import PrefetchingStorage
+
+        storage = _BlockingStorage()
+        storage.release.set()
+        tile = Tile(10, 1, 1)
+        storage.fail.add(tile)
+        prefetching = PrefetchingStorage(storage, 1)
+        prefetching.prefetch(tile)
+        self.assertEqual('tables %r' % (tile,), prefetching(tile))
+        self.assertEqual(1, prefetching.stats()['failed'])
+
+    def test_if_changed(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import PrefetchingStorage
+
+        storage = VersionedStorage(TestGetTable({}), '"etag1"')
+        prefetching = PrefetchingStorage(storage, 1)
+        tile = Tile(10, 1, 1)
+
+        # a prefetched tile is compared with the version.
+        prefetching.prefetch(tile)
+        self.assertIsNone(prefetching.if_changed(tile, '"etag1"'))
+        self.assertEqual(1, storage.calls)
+        self.assertEqual(0, storage.checks)
+
+        # otherwise the storage checks it.
+        self.assertIsNone(prefetching.if_changed(tile, '"etag1"'))
+        tables = prefetching.if_changed(tile, '"etag0"')
+        self.assertEqual('"etag1"', tables.version)
+        self.assertEqual(2, storage.checks)
+
+    def test_fetcher_prefetches_parent(self):
+        from ModestMaps.Core import Coordinate
+        from raw_tiles.tile import Tile
+        from tilequeue.query.rawr import PrefetchingStorage
+        from tilequeue.query.rawr import make_rawr_data_fetcher
+
+        storage = _BlockingStorage()
+        prefetching = PrefetchingStorage(storage, 2)
+        fetcher = make_rawr_data_fetcher(10, 16, prefetching, {}, [])
+        # only parents at the RAWR tile zoom are prefetched.
+        fetcher.prefetch(Coordinate(zoom=9, column=1, row=1))
+        fetcher.prefetch(Coordinate(zoom=10, column=3, row=4))
+        self.assertEqual(1, prefetching.stats()['started'])
+        fetcher.cancel_prefetch(Coordinate(zoom=10, column=3, row=4))
+        self.assertEqual(0, prefetching.stats()['started'])
+        storage.release.set()
+        self.assertEqual('tables %r' % (Tile(10, 3, 4),),
+                         prefetching(Tile(10, 3, 4)))
+
+
+class TestOsmRawrLookup(unittest.TestCase):
+
+    def test_reverse_lookups(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        from tilequeue.query.rawr import OsmRawrLookup
+
+        osm = OsmRawrLookup()
+        osm.add_row(1, Point(0, 0).wkb, {'barrier': 'gate'})
+        for way_id in (11, 10):
+            osm.add_row(way_id, LineString([(0, 0), (1, 1)]).wkb,
+                        {'highway': 'primary'})
+            osm.add_row(way_id, [1, 2], ['highway', 'primary'])
+        # a way which isn't interesting isn't indexed.
+        osm.add_row(12, [1], ['building', 'yes'])
+        tags = ['type', 'route', 'route', 'bus', 'ref', '1']
+        osm.add_row(20, 1, 2, [1, 10, 30], [], list(tags))
+        osm.add_row(21, 1, 2, [1, 11], [], list(tags))
+        osm.freeze()
+
+        self.assertEqual([11, 10], osm.ways_using_node(1))
+        self.assertEqual([], osm.ways_using_node(2))
+        self.assertEqual([20, 21], osm.relations_using_node(1))
+        self.assertEqual([20], osm.relations_using_way(10))
+        self.assertEqual([21], osm.relations_using_way(11))
+        self.assertEqual([20], osm.relations_using_rel(30))
+        self.assertEqual(set([20]), osm.transit_relations(30))
+
+        rel = osm.relation(20)
+        self.assertEqual([1], list(rel.node_ids))
+        self.assertEqual([10], list(rel.way_ids))
+        self.assertEqual([30], list(rel.rel_ids))
+        self.assertEqual('bus', rel.tags['route'])
+        # tags are shared between relations.
+        self.assertIs(rel.tags['route'], osm.relation(21).tags['route'])
+        self.assertFalse(hasattr(rel, '__dict__'))
+
+    def test_transit_cache(self):
+        from shapely.geometry import Point
+        from tilequeue.query.common import \
+            mz_calculate_transit_routes_and_score
+        from tilequeue.query.rawr import OsmRawrLookup
+
+        osm = OsmRawrLookup()
+        for node_id in (1, 2):
+            osm.add_row(node_id, Point(0, 0).wkb, {'railway': 'station'})
+        # a stop area with both stations, and subway and train routes which
+        # stop at one or the other.
+        osm.add_row(30, 2, 2, [1, 2], [],
+                    ['type', 'public_transport',
+                     'public_transport', 'stop_area'])
+        osm.add_row(40, 1, 1, [1], [],
+                    ['type', 'route', 'route', 'subway', 'ref', 'A'])
+        osm.add_row(41, 1, 1, [2], [],
+                    ['type', 'route', 'route', 'train', 'ref', 'X'])
+        osm.freeze()
+
+        for node_id in (1, 2, 1):
+            expected = mz_calculate_transit_routes_and_score(
+                osm, node_id, None, None)
+            transit = mz_calculate_transit_routes_and_score(
+                osm, node_id, None, None, osm.transit_cache)
+            self.assertEqual(expected, transit)
+            self.assertEqual(['A'], transit.subways)
+            self.assertEqual(['X'], transit.trains)
+            self.assertEqual(30, transit.root_relation_id)
+
+        # both stations share the stop area's graph and routes.
+        self.assertEqual(1, len(osm.transit_cache.relations))
+        self.assertEqual(1, len(osm.transit_cache.transits))
+        # each result has its own lists.
+        transit.trains.append('Y')
+        self.assertEqual(['X'], mz_calculate_transit_routes_and_score(
+            osm, 1, None, None, osm.transit_cache).trains)
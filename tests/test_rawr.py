@@ -0,0 +1,753 @@
+import unittest
+
+
+class _FakeS3Client(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+        self.gets = []
+
+    def head_object(self, Bucket, Key):
+        data = self.objects[Key]
+        return dict(ContentLength=len(data), ETag=self._etag(data))
+
+    def _etag(self, data):
+        import hashlib
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None,
+                   IfNoneMatch=None):
+        from botocore.exceptions import ClientError
+        from io import BytesIO
+        data = self.objects[Key]
+        etag = self._etag(data)
+        self.gets.append(IfNoneMatch)
+        if IfNoneMatch == etag:
+            raise ClientError(dict(
+                Error=dict(Code='304', Message='Not Modified'),
+                ResponseMetadata=dict(HTTPStatusCode=304)), 'GetObject')
+        if Range is not None:
+            assert IfMatch == etag
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            self.ranges.append((start, end))
+            data = data[start:end + 1]
+        return dict(Body=BytesIO(data), ETag=etag)
+
+
+class TestRawrS3RangeReads(unittest.TestCase):
+
+    def _payload(self, tables):
+        from cStringIO import StringIO
+        import msgpack
+        import zipfile
+
+        buf = StringIO()
+        with zipfile.ZipFile(buf, mode='w') as z:
+            for name, rows in tables:
+                data = ''.join(msgpack.packb(row) for row in rows)
+                z.writestr(name, data, zipfile.ZIP_DEFLATED)
+        return buf.getvalue()
+
+    def test_reads_only_used_tables(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.process import Source
+        from tilequeue.rawr import RawrS3Source
+        from tilequeue.rawr import make_rawr_s3_path
+        import os
+
+        tile = Tile(10, 1, 2)
+        points = [[i, 'wkb', {'name': str(i)}] for i in xrange(100)]
+        # random bytes don't compress, so this table is large and must be
+        # skipped rather than downloaded.
+        unused = [[0, os.urandom(1 << 20), {}]]
+        payload = self._payload([
+            ('planet_osm_point', points), ('unused', unused)])
+        key = make_rawr_s3_path(tile, 'prefix', '.zip')
+        s3_client = _FakeS3Client({key: payload})
+
+        osm = Source('osm', 'openstreetmap.org')
+        table_sources = dict(planet_osm_point=osm)
+        source = RawrS3Source(s3_client, 'bucket', 'prefix', '.zip',
+                              table_sources, range_reads=True)
+        source.range_block_size = 64 << 10
+        tables = source(tile)
+
+        table = tables('planet_osm_point')
+        self.assertEqual(osm, table.source)
+        self.assertEqual(points, list(table.rows))
+
+        n_bytes = sum(end + 1 - start for start, end in s3_client.ranges)
+        self.assertTrue(n_bytes < len(payload) / 2)
+
+    def test_range_file_reads(self):
+        from tilequeue.rawr import _S3RangeFile
+
+        data = ''.join(chr(i % 256) for i in xrange(1000))
+        s3_client = _FakeS3Client({'key': data})
+        etag = s3_client.head_object('bucket', 'key')['ETag']
+        fh = _S3RangeFile(s3_client, 'bucket', 'key', len(data), etag,
+                          block_size=64)
+
+        fh.seek(-10, 2)
+        self.assertEqual(data[-10:], fh.read())
+        # served from the last block, which was fetched whole.
+        fh.seek(950)
+        self.assertEqual(data[950:960], fh.read(10))
+        self.assertEqual(1, len(s3_client.ranges))
+
+        fh.seek(100)
+        self.assertEqual(data[100:300], fh.read(200))
+        self.assertEqual(300, fh.tell())
+        self.assertEqual('', fh.read(0))
+        fh.seek(0)
+        self.assertEqual(data, fh.read())
+
+
+class TestRawrDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _payload(self, rows):
+        from cStringIO import StringIO
+        import msgpack
+        import zipfile
+
+        buf = StringIO()
+        with zipfile.ZipFile(buf, mode='w') as z:
+            data = ''.join(msgpack.packb(row) for row in rows)
+            z.writestr('planet_osm_point', data, zipfile.ZIP_DEFLATED)
+        return buf.getvalue()
+
+    def test_revalidate(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.process import Source
+        from tilequeue.rawr import RawrDiskCache
+        from tilequeue.rawr import RawrS3Source
+        from tilequeue.rawr import make_rawr_s3_path
+
+        tile = Tile(10, 1, 2)
+        key = make_rawr_s3_path(tile, 'prefix', '.zip')
+        s3_client = _FakeS3Client({key: self._payload([[1, 'wkb', {}]])})
+        table_sources = dict(planet_osm_point=Source('osm', 'osm'))
+
+        def rows():
+            # a separate process on the same host, sharing the cache.
+            cache = RawrDiskCache(self.path, 1 << 20)
+            source = RawrS3Source(s3_client, 'bucket', 'prefix', '.zip',
+                                  table_sources, disk_cache=cache)
+            return list(source(tile)('planet_osm_point').rows), cache
+
+        # downloaded, then revalidated from the cache.
+        self.assertEqual([[1, 'wkb', {}]], rows()[0])
+        result, cache = rows()
+        self.assertEqual([[1, 'wkb', {}]], result)
+        etag = s3_client.head_object('bucket', key)['ETag']
+        self.assertEqual([None, etag], s3_client.gets)
+        self.assertEqual(1, cache.stats()['hits'])
+
+        # a changed tile replaces the cached version.
+        s3_client.objects[key] = self._payload([[2, 'wkb', {}]])
+        result, cache = rows()
+        self.assertEqual([[2, 'wkb', {}]], result)
+        self.assertEqual(1, cache.stats()['stale'])
+        self.assertEqual(1, len(cache._entries(tile)))
+
+    def test_mapped_payload_closed(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.process import Source
+        from tilequeue.rawr import RawrDiskCache
+        from tilequeue.rawr import RawrS3Source
+        from tilequeue.rawr import make_rawr_s3_path
+
+        tile = Tile(10, 1, 2)
+        key = make_rawr_s3_path(tile, 'prefix', '.zip')
+        s3_client = _FakeS3Client({key: self._payload([[1, 'wkb', {}]])})
+        table_sources = dict(planet_osm_point=Source('osm', 'osm'))
+        cache = RawrDiskCache(self.path, 1 << 20)
+        source = RawrS3Source(s3_client, 'bucket', 'prefix', '.zip',
+                              table_sources, disk_cache=cache)
+
+        source(tile)
+        # revalidated, and read from the mapped file.
+        tables = source(tile)
+        self.assertEqual(1, cache.stats()['hits'])
+        self.assertEqual(
+            [[1, 'wkb', {}]], list(tables('planet_osm_point').rows))
+        tables.close()
+        with self.assertRaises(ValueError):
+            tables('planet_osm_point')
+
+    def test_unsafe_etag_not_cached(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrDiskCache
+
+        cache = RawrDiskCache(self.path, 1 << 20)
+        tile = Tile(10, 1, 2)
+        cache.put(tile, '"abc"', 'x' * 10)
+        # would be read back as a different ETag, so it isn't cached, and
+        # the older version is removed.
+        cache.put(tile, '"a/b"', 'y' * 10)
+        self.assertEqual([], cache._entries(tile))
+        self.assertIsNone(cache.get(tile))
+        self.assertEqual(1, cache.stats()['unsafe'])
+
+    def test_if_changed(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.process import Source
+        from tilequeue.rawr import RawrDiskCache
+        from tilequeue.rawr import RawrS3Source
+        from tilequeue.rawr import make_rawr_s3_path
+
+        tile = Tile(10, 1, 2)
+        key = make_rawr_s3_path(tile, 'prefix', '.zip')
+        table_sources = dict(planet_osm_point=Source('osm', 'osm'))
+
+        for cache in (None, RawrDiskCache(self.path, 1 << 20)):
+            s3_client = _FakeS3Client({key: self._payload([[1, 'wkb', {}]])})
+            source = RawrS3Source(s3_client, 'bucket', 'prefix', '.zip',
+                                  table_sources, disk_cache=cache)
+            version = source(tile).version
+            etag = s3_client.head_object('bucket', key)['ETag']
+            self.assertEqual(etag, version)
+
+            # an unchanged tile is only revalidated.
+            self.assertIsNone(source.if_changed(tile, version))
+            self.assertEqual([None, etag], s3_client.gets)
+
+            s3_client.objects[key] = self._payload([[2, 'wkb', {}]])
+            tables = source.if_changed(tile, version)
+            self.assertNotEqual(version, tables.version)
+            self.assertEqual(
+                [[2, 'wkb', {}]], list(tables('planet_osm_point').rows))
+
+    def test_eviction(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrDiskCache
+        import os
+        import time
+
+        cache = RawrDiskCache(self.path, 350)
+        now = time.time()
+        for i in xrange(3):
+            tile = Tile(10, i, 0)
+            cache.put(tile, '"%d"' % i, 'x' * 100)
+            path = cache._entries(tile)[0][1]
+            os.utime(path, (now - 100 + i, now - 100 + i))
+        # reading tile 0 makes tile 1 the least recently used.
+        self.assertEqual('"0"', cache.get(Tile(10, 0, 0))[0])
+        cache.put(Tile(10, 3, 0), '"3"', 'x' * 100)
+
+        self.assertIsNone(cache.get(Tile(10, 1, 0)))
+        self.assertEqual(1, cache.stats()['evictions'])
+        for x in (0, 2, 3):
+            etag, data = cache.get(Tile(10, x, 0))
+            self.assertEqual('"%d"' % x, etag)
+            self.assertEqual('x' * 100, data.read())
+
+    def test_scans_only_when_needed(self):
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrDiskCache
+
+        cache = RawrDiskCache(self.path, 350)
+        cache.scan_interval = 5
+        scans = []
+        cleanup = cache._cleanup
+
+        def counting_cleanup():
+            scans.append(cache._bytes)
+            cleanup()
+        cache._cleanup = counting_cleanup
+
+        # the first put scans, then the size is tracked from the writes.
+        for i in xrange(3):
+            cache.put(Tile(10, i, 0), '"%d"' % i, 'x' * 100)
+        self.assertEqual([None], scans)
+        self.assertEqual(300, cache._bytes)
+
+        # replacing a tile's version doesn't add to the size.
+        cache.put(Tile(10, 0, 0), '"new"', 'x' * 100)
+        self.assertEqual([None], scans)
+        self.assertEqual(300, cache._bytes)
+
+        # going over the budget scans and evicts.
+        cache.put(Tile(10, 3, 0), '"3"', 'x' * 100)
+        self.assertEqual([None, 400], scans)
+        self.assertEqual(300, cache._bytes)
+        self.assertEqual(1, cache.stats()['evictions'])
+
+        # another process's writes are picked up every scan_interval puts.
+        other = RawrDiskCache(self.path, 350)
+        other.put(Tile(10, 4, 0), '"4"', 'x' * 100)
+        for _ in xrange(5):
+            cache.put(Tile(10, 3, 0), '"3"', 'x' * 100)
+        self.assertEqual(3, len(scans))
+        self.assertEqual(300, cache._bytes)
+
+
+class TestColumnarTables(unittest.TestCase):
+
+    def test_round_trip(self):
+        from tilequeue.rawr import pack_columnar_table
+        from tilequeue.rawr import unpack_columnar_table
+
+        rows = [
+            (1, 'wkb one', {'name': 'a', 'kind': 'x'}),
+            (-2, '', {}),
+            (1 << 40, 'wkb three', {'kind': 'x', 'height': 3.5,
+                                    'list': [1, 2]}),
+        ]
+        data = pack_columnar_table(rows)
+        self.assertEqual(rows, list(unpack_columnar_table(data)))
+        self.assertEqual([], list(unpack_columnar_table(
+            pack_columnar_table([]))))
+
+    def test_not_features(self):
+        from tilequeue.rawr import pack_columnar_table
+        self.assertIsNone(pack_columnar_table([(1, [2, 3], ['a', 'b'])]))
+        # fids which don't fit in 8 bytes.
+        self.assertIsNone(pack_columnar_table([(1 << 63, 'wkb', {})]))
+
+    def test_fixed_fid_size(self):
+        from array import array
+        from tilequeue.rawr import pack_columnar_table
+        from tilequeue.rawr import unpack_columnar_table
+        import msgpack
+        import struct
+
+        rows = [(-2, 'wkb', {}), (1 << 40, 'wkb two', {})]
+        data = pack_columnar_table(rows)
+        self.assertEqual(2, ord(data[7]))
+        header_len, = struct.unpack_from('<I', data, 8)
+        offset = 12 + header_len
+        self.assertEqual(struct.pack('<2q', -2, 1 << 40),
+                         data[offset:offset + 16])
+
+        # version 1 tables, with platform-sized fids, are still read.
+        fids = array('l', [1, 2])
+        header = msgpack.packb(dict(n=2, keys=[], values=[],
+                                    fid_size=fids.itemsize))
+        v1 = ''.join([
+            'RAWRCOL', chr(1), struct.pack('<I', len(header)), header,
+            fids.tostring(), array('I', [0, 3, 5]).tostring(),
+            array('I', [0, 0, 0]).tostring(), 'wkbab'])
+        self.assertEqual([(1, 'wkb', {}), (2, 'ab', {})],
+                         list(unpack_columnar_table(v1)))
+
+    def test_unknown_version(self):
+        from tilequeue.rawr import pack_columnar_table
+        from tilequeue.rawr import unpack_columnar_table
+        data = pack_columnar_table([(1, 'wkb', {})])
+        data = data[:7] + chr(99) + data[8:]
+        with self.assertRaises(ValueError):
+            unpack_columnar_table(data)
+
+    def test_zip_payload_mixed(self):
+        from collections import namedtuple
+        from tilequeue.process import Source
+        from tilequeue.rawr import make_rawr_zip_payload
+        from tilequeue.rawr import unpack_rawr_zip_payload
+        import msgpack
+        import zipfile
+        from io import BytesIO
+
+        FormattedData = namedtuple('FormattedData', 'name data')
+        RawrTile = namedtuple('RawrTile', 'all_formatted_data')
+        points = [[1, 'wkb', {'name': 'a'}], [2, 'wkb2', {'name': 'b'}]]
+        ways = [[3, [1, 2], ['highway', 'primary']]]
+        rawr_tile = RawrTile([
+            FormattedData(name, ''.join(msgpack.packb(r) for r in rows))
+            for name, rows in (('planet_osm_point', points),
+                               ('planet_osm_ways', ways))])
+
+        osm = Source('osm', 'openstreetmap.org')
+        table_sources = dict(planet_osm_point=osm, planet_osm_ways=osm)
+        for columnar in (False, True):
+            payload = make_rawr_zip_payload(rawr_tile, columnar=columnar)
+            point_data = zipfile.ZipFile(BytesIO(payload)).read(
+                'planet_osm_point')
+            self.assertEqual(columnar, point_data.startswith('RAWRCOL'))
+
+            tables = unpack_rawr_zip_payload(table_sources, payload)
+            self.assertEqual(
+                points, [list(r) for r in tables('planet_osm_point').rows])
+            self.assertEqual(ways, list(tables('planet_osm_ways').rows))
+
+
+class _FakeSqsClient(object):
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.deleted = []
+        self.extended = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, AttributeNames,
+                        WaitTimeSeconds, VisibilityTimeout=None):
+        msgs = []
+        while self.bodies and len(msgs) < MaxNumberOfMessages:
+            body = self.bodies.pop(0)
+            msgs.append(dict(Body=body, ReceiptHandle='handle-' + body,
+                             Attributes=dict(SentTimestamp='0')))
+        return dict(Messages=msgs,
+                    ResponseMetadata=dict(HTTPStatusCode=200))
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle,
+                                  VisibilityTimeout):
+        self.extended.append(ReceiptHandle)
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.deleted.append(ReceiptHandle)
+
+
+class _FakeConn(object):
+
+    closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def cursor(self):
+        return self
+
+    def get_transaction_status(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return TRANSACTION_STATUS_IDLE
+
+
+class _FakeLogger(object):
+
+    def __init__(self):
+        self.errors = []
+        self.n_processed = 0
+
+    def error(self, msg, exception, stacktrace, parent_coord):
+        self.errors.append((msg, parent_coord))
+
+    def processed(self, *args):
+        self.n_processed += 1
+
+
+class _FakeQueueWriter(object):
+
+    def enqueue_batch(self, coords):
+        return len(coords), 0
+
+
+class TestRawrTileGenerationPipeline(unittest.TestCase):
+
+    def _pipeline(self, sqs_client, rawr_gen, conns, n_threads=1):
+        from tilequeue.queue.message import SingleMessageMarshaller
+        from tilequeue.rawr import RawrTileGenerationPipeline
+        from tilequeue.rawr import SqsQueue
+        from tilequeue.rawr import ThreadConnections
+
+        def connect():
+            conn = _FakeConn()
+            conns.append(conn)
+            return conn
+
+        rawr_queue = SqsQueue(sqs_client, 'queue', 0)
+        return RawrTileGenerationPipeline(
+            rawr_queue, SingleMessageMarshaller(), 10, rawr_gen,
+            _FakeQueueWriter(), lambda *args: None, _FakeLogger(),
+            ThreadConnections(connect), n_threads, 10)
+
+    def test_batch_done_per_message(self):
+        import threading
+
+        sqs_client = _FakeSqsClient(
+            ['10/1/1', '10/2/2', '10/3/3', '10/4/4', '5/1/1'])
+        lock = threading.Lock()
+        generated = []
+
+        def rawr_gen(table_reader, tile):
+            if tile.x == 2:
+                raise Exception('failed to generate')
+            with lock:
+                generated.append((tile.z, tile.x, tile.y))
+            return {}
+
+        conns = []
+        pipeline = self._pipeline(sqs_client, rawr_gen, conns, n_threads=3)
+        msg_handles = pipeline._read()
+        self.assertEqual(5, len(msg_handles))
+        pipeline.process_batch(msg_handles)
+
+        self.assertEqual(
+            set([(10, 1, 1), (10, 3, 3), (10, 4, 4)]), set(generated))
+        # the message whose tile failed isn't deleted, so that it's retried,
+        # but all the others are.
+        self.assertEqual(
+            set(['handle-10/1/1', 'handle-10/3/3', 'handle-10/4/4',
+                 'handle-5/1/1']),
+            set(sqs_client.deleted))
+        self.assertEqual(1, len(pipeline.rawr_proc_logger.errors))
+        self.assertEqual(4, pipeline.rawr_proc_logger.n_processed)
+        self.assertEqual(set(), pipeline.in_progress)
+        # connections are kept, at most one per worker thread.
+        self.assertTrue(1 <= len(conns) <= 3)
+
+    def test_connections_reused(self):
+        sqs_client = _FakeSqsClient(['10/1/1', '10/2/2'])
+        conns = []
+        pipeline = self._pipeline(
+            sqs_client, lambda table_reader, tile: {}, conns)
+        pipeline.process_batch(pipeline._read())
+        self.assertEqual(1, len(conns))
+        self.assertEqual(2, len(sqs_client.deleted))
+
+    def test_extend_in_progress(self):
+        from tilequeue.queue import make_visibility_manager
+
+        sqs_client = _FakeSqsClient(['10/1/1', '10/2/2'])
+        conns = []
+        pipeline = self._pipeline(
+            sqs_client, lambda table_reader, tile: {}, conns)
+        pipeline.rawr_queue.visibility_mgr = make_visibility_manager(
+            600, 3600, 900)
+        msg_handles = pipeline._read()
+        pipeline.in_progress.add(msg_handles[0])
+        pipeline.extend_in_progress()
+        self.assertEqual(['handle-10/1/1'], sqs_client.extended)
+        # not extended again until extend-seconds have passed.
+        pipeline.extend_in_progress()
+        self.assertEqual(['handle-10/1/1'], sqs_client.extended)
+
+    def test_no_extend_after_done(self):
+        from tilequeue.queue import make_visibility_manager
+
+        sqs_client = _FakeSqsClient(['10/1/1', '10/2/2'])
+        pipeline = self._pipeline(
+            sqs_client, lambda table_reader, tile: {}, [])
+        visibility_mgr = make_visibility_manager(600, 3600, 900)
+        pipeline.rawr_queue.visibility_mgr = visibility_mgr
+        msg_handles = pipeline._read()
+
+        # the jobs finish after the progress thread has listed them.
+        pipeline.process_batch(msg_handles)
+        for msg_handle in msg_handles:
+            pipeline.rawr_queue.job_progress(msg_handle)
+        self.assertEqual([], sqs_client.extended)
+        self.assertEqual({}, visibility_mgr.handle_state_map)
+        self.assertEqual(set(), pipeline.rawr_queue.in_flight)
+
+    def test_failed_message_released(self):
+        from tilequeue.queue import make_visibility_manager
+
+        def rawr_gen(table_reader, tile):
+            raise Exception('failed to generate')
+
+        sqs_client = _FakeSqsClient(['10/1/1'])
+        pipeline = self._pipeline(sqs_client, rawr_gen, [])
+        visibility_mgr = make_visibility_manager(600, 3600, 900)
+        pipeline.rawr_queue.visibility_mgr = visibility_mgr
+        msg_handles = pipeline._read()
+        pipeline.rawr_queue.job_progress(msg_handles[0])
+        pipeline.process_batch(msg_handles)
+
+        self.assertEqual([], sqs_client.deleted)
+        self.assertEqual({}, visibility_mgr.handle_state_map)
+        self.assertEqual(set(), pipeline.rawr_queue.in_flight)
+
+
+def _client_error(status, code):
+    from botocore.exceptions import ClientError
+    return ClientError(dict(
+        Error=dict(Code=code, Message=code),
+        ResponseMetadata=dict(HTTPStatusCode=status)), 'GetObject')
+
+
+class TestRawrFetchPolicy(unittest.TestCase):
+
+    def test_retry(self):
+        from tilequeue.rawr import RawrFetchPolicy
+
+        errors = [_client_error(503, 'SlowDown'), IOError('reset')]
+
+        def fetch():
+            if errors:
+                raise errors.pop(0)
+            return 'tile'
+
+        policy = RawrFetchPolicy(max_attempts=3, backoff=0)
+        self.assertEqual('tile', policy(fetch))
+        self.assertEqual(2, policy.stats()['retries'])
+
+        # errors which would only happen again aren't retried.
+        errors = [_client_error(403, 'AccessDenied')]
+        with self.assertRaises(Exception):
+            policy(fetch)
+        self.assertEqual(2, policy.stats()['retries'])
+        self.assertEqual(1, policy.stats()['failures'])
+
+    def test_attempt_timeout(self):
+        from tilequeue.rawr import RawrFetchPolicy
+        from tilequeue.rawr import RawrFetchTimeout
+        import threading
+
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+            return 'tile'
+
+        policy = RawrFetchPolicy(attempt_timeout=0.05, max_attempts=2,
+                                 backoff=0)
+        try:
+            self.assertEqual('tile', policy(fetch))
+            self.assertEqual(1, policy.stats()['timeouts'])
+
+            policy.max_attempts = 1
+            del calls[:]
+            with self.assertRaises(RawrFetchTimeout):
+                policy(fetch)
+        finally:
+            release.set()
+
+    def test_deadline_from_start(self):
+        from tilequeue.rawr import RawrFetchPolicy
+        import threading
+
+        policy = RawrFetchPolicy(attempt_timeout=0.1, n_threads=2,
+                                 max_abandoned=1)
+        self.assertEqual('tile', policy(lambda: 'tile'))
+
+        # time spent waiting for a thread doesn't count against the attempt.
+        release = threading.Event()
+        for _ in xrange(2):
+            policy.pool.apply_async(release.wait, (5,))
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+        try:
+            self.assertEqual('tile', policy(lambda: 'tile'))
+        finally:
+            release.set()
+            timer.cancel()
+        self.assertEqual(0, policy.stats()['timeouts'])
+
+    def test_hedge(self):
+        from tilequeue.rawr import RawrFetchPolicy
+        import threading
+
+        policy = RawrFetchPolicy(hedge_percentile=90, hedge_min_samples=5)
+        for _ in xrange(5):
+            self.assertEqual('tile', policy(lambda: 'tile'))
+        # no hedges until there are enough samples.
+        self.assertEqual(0, policy.stats()['hedges'])
+
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            if len(calls) == 1:
+                release.wait(5)
+                return 'slow'
+            return 'fast'
+
+        try:
+            self.assertEqual('fast', policy(fetch))
+        finally:
+            release.set()
+        stats = policy.stats()
+        self.assertEqual(1, stats['hedges'])
+        self.assertEqual(1, stats['hedge_wins'])
+        self.assertIsNotNone(stats['get_p99'])
+
+    def test_latency_per_kind(self):
+        from tilequeue.rawr import RawrFetchPolicy
+        from tilequeue.rawr import RawrFetchTimeout
+        import threading
+
+        policy = RawrFetchPolicy(attempt_timeout=0.05, hedge_percentile=90,
+                                 hedge_min_samples=2)
+        for _ in xrange(2):
+            policy(lambda: 'head', 'head')
+        self.assertIsNotNone(policy.latency_percentile(50, 'head'))
+        self.assertIsNone(policy.latency_percentile(50, 'get'))
+
+        # quick HEADs don't make GETs hedge, and a timed out GET counts as
+        # taking the whole deadline.
+        release = threading.Event()
+        try:
+            with self.assertRaises(RawrFetchTimeout):
+                policy(lambda: release.wait(5), 'get')
+        finally:
+            release.set()
+        self.assertEqual(0, policy.stats()['hedges'])
+        self.assertEqual(0.05, policy.latency_percentile(50, 'get'))
+
+    def test_abandoned_capped(self):
+        from tilequeue.rawr import RawrFetchPolicy
+        from tilequeue.rawr import RawrFetchTimeout
+        import threading
+        import time
+
+        policy = RawrFetchPolicy(attempt_timeout=0.05, n_threads=2,
+                                 max_abandoned=1)
+        release = threading.Event()
+        started = []
+
+        def slow():
+            started.append(time.time())
+            release.wait(5)
+            return 'slow'
+
+        with self.assertRaises(RawrFetchTimeout):
+            policy(slow)
+        self.assertEqual(1, policy.stats()['abandoned'])
+
+        # the next attempt waits for the abandoned one to finish.
+        threading.Timer(0.2, release.set).start()
+        start = time.time()
+        self.assertEqual('fast', policy(lambda: 'fast'))
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(0, policy.stats()['abandoned'])
+
+    def test_s3_source(self):
+        from tilequeue.process import Source
+        from tilequeue.rawr import RawrFetchPolicy
+        from tilequeue.rawr import make_rawr_s3_path
+        from tilequeue.rawr import RawrS3Source
+        from raw_tiles.tile import Tile
+        from cStringIO import StringIO
+        import msgpack
+        import zipfile
+
+        buf = StringIO()
+        with zipfile.ZipFile(buf, mode='w') as z:
+            z.writestr('planet_osm_point', msgpack.packb([1, 'wkb', {}]))
+
+        class _FlakyS3Client(_FakeS3Client):
+            failures = 1
+
+            def get_object(self, *args, **kwargs):
+                if self.failures:
+                    self.failures -= 1
+                    raise _client_error(500, 'InternalError')
+                return super(_FlakyS3Client, self).get_object(
+                    *args, **kwargs)
+
+        tile = Tile(10, 1, 2)
+        location = make_rawr_s3_path(tile, 'prefix', '.zip')
+        s3_client = _FlakyS3Client({location: buf.getvalue()})
+        table_sources = dict(planet_osm_point=Source('osm', 'osm'))
+        policy = RawrFetchPolicy(max_attempts=2, backoff=0)
+        source = RawrS3Source(s3_client, 'bucket', 'prefix', '.zip',
+                              table_sources, fetch_policy=policy)
+        tables = source(tile)
+        self.assertEqual([[1, 'wkb', {}]],
+                         [list(r) for r in tables('planet_osm_point').rows])
+        self.assertEqual(1, policy.stats()['retries'])
@@ -56,6 +56,147 @@ class TestTileDirectory(unittest.TestCase):
 
             os.remove(expected_path)
 
+    def test_delete_tiles(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue import store
+        tile_dir = store.TileDirectory(self.dir_path, delete_n_threads=2)
+        coords = [Coordinate(zoom=10, column=x, row=1) for x in xrange(2500)]
+        for coord in coords[:2000]:
+            tile_dir.write_tile('data', coord, json_format, 'all')
+
+        # deleting tiles which don't exist is not an error, but they
+        # shouldn't be counted.
+        n_deleted = tile_dir.delete_tiles(iter(coords), json_format, 'all')
+        self.assertEqual(2000, n_deleted)
+        self.assertEqual([], list(tile_dir.list_tiles(json_format, 'all')))
+
+
+class TestSqliteStore(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        from tilequeue.store import SqliteStore
+        self.dir_path = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir_path, 'tiles.mbtiles')
+        self.store = SqliteStore(self.path)
+
+    def tearDown(self):
+        import shutil
+        self.store.close()
+        shutil.rmtree(self.dir_path)
+
+    def _count(self, table):
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        try:
+            row = conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()
+            return row[0]
+        finally:
+            conn.close()
+
+    def test_write_read(self):
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        from tilequeue.tile import deserialize_coord
+        coord = deserialize_coord('8/72/105')
+        self.assertIsNone(self.store.read_tile(coord, json_format, 'all'))
+        self.store.write_tile('json data', coord, json_format, 'all')
+        self.store.write_tile('zip data', coord, zip_format, 'all')
+        self.assertEqual(
+            'json data', self.store.read_tile(coord, json_format, 'all'))
+        self.assertEqual(
+            'zip data', self.store.read_tile(coord, zip_format, 'all'))
+        self.assertIsNone(self.store.read_tile(coord, json_format, 'rawr'))
+
+    def test_format_metadata(self):
+        import sqlite3
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        from tilequeue.store import SqliteStore
+        from tilequeue.tile import deserialize_coord
+        coord = deserialize_coord('8/72/105')
+        self.assertFalse(self.store._has_format)
+        self.store.write_tile('json data', coord, json_format, 'all')
+        self.store.write_tile('zip data', coord, zip_format, 'all')
+        self.assertTrue(self.store._has_format)
+
+        # the first format written is kept, and isn't written again.
+        other_store = SqliteStore(self.path)
+        try:
+            self.assertTrue(other_store._has_format)
+        finally:
+            other_store.close()
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute("SELECT value FROM metadata "
+                                "WHERE name = 'format'").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual([(json_format.extension,)], rows)
+
+    def test_mbtiles_view(self):
+        import sqlite3
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+        self.store.write_tile(
+            'data', deserialize_coord('2/1/0'), json_format, 'all')
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute('SELECT zoom_level, tile_column, tile_row, '
+                                'tile_data FROM tiles').fetchall()
+        finally:
+            conn.close()
+        # rows are flipped, as in the TMS scheme.
+        self.assertEqual([(2, 1, 3, 'data')],
+                         [(z, x, y, str(d)) for z, x, y, d in rows])
+
+    def test_dedupe_and_delete(self):
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+        coords = [deserialize_coord(x) for x in ('10/1/2', '10/1/3', '10/1/4')]
+        for coord in coords:
+            self.store.write_tile('ocean', coord, json_format, 'all')
+        self.assertEqual(3, self._count('map'))
+        self.assertEqual(1, self._count('images'))
+
+        # overwriting one tile keeps the shared body around.
+        self.store.write_tile('land', coords[0], json_format, 'all')
+        self.assertEqual(2, self._count('images'))
+        self.assertEqual(
+            'land', self.store.read_tile(coords[0], json_format, 'all'))
+
+        n_deleted = self.store.delete_tiles(
+            coords[1:] + [deserialize_coord('10/9/9')], json_format, 'all')
+        self.assertEqual(2, n_deleted)
+        self.assertEqual(1, self._count('map'))
+        self.assertEqual(1, self._count('images'))
+        self.assertEqual(
+            [coords[0]], list(self.store.list_tiles(json_format, 'all')))
+
+    def test_concurrent_writes(self):
+        from multiprocessing.pool import ThreadPool
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        coords = [Coordinate(zoom=12, column=x, row=7) for x in xrange(200)]
+
+        def write(coord):
+            self.store.write_tile(
+                'data %d' % coord.column, coord, json_format, 'all')
+
+        pool = ThreadPool(8)
+        try:
+            pool.map(write, coords)
+        finally:
+            pool.terminate()
+
+        self.assertEqual(sorted(coords), sorted(
+            self.store.list_tiles(json_format, 'all')))
+        for coord in coords[::37]:
+            self.assertEqual('data %d' % coord.column, self.store.read_tile(
+                coord, json_format, 'all'))
+
 
 class TestStoreKey(unittest.TestCase):
 
@@ -84,6 +225,456 @@ class TestStoreKey(unittest.TestCase):
         self.assertEqual(tile_key, '/20160121/cfc61/all/8/72/105.json')
 
 
+class _FakeKey(object):
+
+    def __init__(self, key):
+        self.key = key
+
+
+class _FakeListBucket(object):
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.prefixes = []
+
+    def list(self, prefix=''):
+        self.prefixes.append(prefix)
+        return [_FakeKey(k) for k in self.keys if k.startswith(prefix)]
+
+
+class TestS3ListTiles(unittest.TestCase):
+
+    def _make_store(self, coords, date_prefix='20160121'):
+        from tilequeue.format import zip_format
+        from tilequeue.store import S3
+        from tilequeue.store import s3_tile_key
+        keys = [s3_tile_key(date_prefix, 'osm', 'all', coord,
+                            zip_format.extension).lstrip('/')
+                for coord in coords]
+        # a tile from a different layer shouldn't be returned
+        keys.append(s3_tile_key(date_prefix, 'osm', 'rawr', coords[0],
+                                zip_format.extension).lstrip('/'))
+        bucket = _FakeListBucket(keys)
+        return S3(bucket, date_prefix, 'osm', False, 60, None), bucket
+
+    def test_prefixes(self):
+        from tilequeue.store import s3_list_prefixes
+        prefixes = s3_list_prefixes('20160121', 2)
+        self.assertEqual(256, len(prefixes))
+        self.assertEqual(256, len(set(prefixes)))
+        self.assertEqual('20160121/00', prefixes[0])
+        self.assertEqual(['0', '1'], s3_list_prefixes('', 1)[:2])
+
+    def test_list_tile_ints(self):
+        from tilequeue.format import zip_format
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import deserialize_coord
+        coords = [deserialize_coord(x) for x in
+                  ('8/72/105', '10/1/2', '0/0/0', '16/1000/2000')]
+        store, bucket = self._make_store(coords)
+        coord_ints = list(store.list_tile_ints(zip_format, 'all'))
+        self.assertEqual(sorted(map(coord_marshall_int, coords)),
+                         sorted(coord_ints))
+        self.assertEqual(256, len(bucket.prefixes))
+
+    def test_list_tile_ints_bounded(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import zip_format
+        coords = [Coordinate(zoom=5, column=x, row=y)
+                  for x in xrange(32) for y in xrange(32)]
+        store, bucket = self._make_store(coords)
+        store.list_n_threads = 2
+        tile_ints = store.list_tile_ints(zip_format, 'all')
+        next(tile_ints)
+        # only a few prefixes are listed ahead of the consumer.
+        self.assertTrue(len(bucket.prefixes) <= 8)
+        tile_ints.close()
+
+    def test_list_tiles(self):
+        from tilequeue.format import zip_format
+        from tilequeue.tile import deserialize_coord
+        coords = [deserialize_coord(x) for x in ('8/72/105', '10/1/2')]
+        store, _ = self._make_store(coords)
+        listed = list(store.list_tiles(zip_format, 'all'))
+        self.assertEqual(sorted(coords), sorted(listed))
+
+
+class _FakeDeleteError(object):
+
+    def __init__(self, key, code):
+        self.key = key
+        self.code = code
+
+
+class _FakeDeleteResult(object):
+
+    def __init__(self, deleted, errors):
+        self.deleted = deleted
+        self.errors = errors
+
+
+class _FakeDeleteBucket(object):
+
+    def __init__(self, transient_failures):
+        # number of times each key fails with a transient error before
+        # being deleted.
+        self.transient_failures = transient_failures
+        self.deleted = []
+        self.batch_sizes = []
+
+    def delete_keys(self, key_names):
+        self.batch_sizes.append(len(key_names))
+        deleted = []
+        errors = []
+        for key in key_names:
+            if self.transient_failures.get(key, 0) > 0:
+                self.transient_failures[key] -= 1
+                errors.append(_FakeDeleteError(key, 'SlowDown'))
+            else:
+                deleted.append(key)
+        self.deleted.extend(deleted)
+        return _FakeDeleteResult(deleted, errors)
+
+
+class TestS3DeleteTiles(unittest.TestCase):
+
+    def _make_store(self, bucket):
+        from tilequeue.store import S3
+        return S3(bucket, '20160121', 'osm', False, 0.01, None,
+                  delete_n_threads=4, delete_retry_base_interval=0.001)
+
+    def _key(self, coord):
+        from tilequeue.format import zip_format
+        from tilequeue.store import s3_tile_key
+        return s3_tile_key('20160121', 'osm', 'all', coord,
+                           zip_format.extension).lstrip('/')
+
+    def test_delete_batches(self):
+        from tilequeue.format import zip_format
+        from ModestMaps.Core import Coordinate
+        coords = [Coordinate(zoom=12, column=x, row=0) for x in xrange(2500)]
+        bucket = _FakeDeleteBucket({})
+        store = self._make_store(bucket)
+        n_deleted = store.delete_tiles(iter(coords), zip_format, 'all')
+        self.assertEqual(2500, n_deleted)
+        self.assertEqual(sorted(map(self._key, coords)),
+                         sorted(bucket.deleted))
+        self.assertEqual([500, 1000, 1000], sorted(bucket.batch_sizes))
+
+    def test_retry_transient_errors(self):
+        from tilequeue.format import zip_format
+        from ModestMaps.Core import Coordinate
+        coords = [Coordinate(zoom=12, column=x, row=0) for x in xrange(10)]
+        transient_failures = {self._key(coords[0]): 3,
+                              self._key(coords[5]): 1}
+        bucket = _FakeDeleteBucket(transient_failures)
+        store = self._make_store(bucket)
+        n_deleted = store.delete_tiles(coords, zip_format, 'all')
+        self.assertEqual(10, n_deleted)
+        # only the keys which failed are retried.
+        self.assertEqual([10, 2, 1, 1], bucket.batch_sizes)
+
+    def test_give_up_on_persistent_errors(self):
+        from tilequeue.format import zip_format
+        from ModestMaps.Core import Coordinate
+        coord = Coordinate(zoom=12, column=0, row=0)
+        bucket = _FakeDeleteBucket({self._key(coord): 100})
+        store = self._make_store(bucket)
+        with self.assertRaises(AssertionError):
+            store.delete_tiles([coord], zip_format, 'all')
+        self.assertEqual(store.delete_max_tries, len(bucket.batch_sizes))
+
+
+class _CountingStore(object):
+
+    def __init__(self):
+        self.tiles = {}
+        self.reads = 0
+
+    def read_tile(self, coord, format, layer):
+        self.reads += 1
+        return self.tiles.get((coord, format.extension, layer))
+
+    def write_tile(self, tile_data, coord, format, layer):
+        self.tiles[(coord, format.extension, layer)] = tile_data
+
+    def delete_tiles(self, coords, format, layer):
+        n = 0
+        for coord in coords:
+            if self.tiles.pop((coord, format.extension, layer), None):
+                n += 1
+        return n
+
+
+class TestCachingStore(unittest.TestCase):
+
+    def _coord(self, x):
+        from ModestMaps.Core import Coordinate
+        return Coordinate(zoom=10, column=x, row=0)
+
+    def test_read_through(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import CachingStore
+        backing = _CountingStore()
+        backing.write_tile('data', self._coord(1), json_format, 'all')
+        cache = CachingStore(backing, 10000)
+
+        for _ in xrange(3):
+            self.assertEqual(
+                'data', cache.read_tile(self._coord(1), json_format, 'all'))
+            self.assertIsNone(
+                cache.read_tile(self._coord(2), json_format, 'all'))
+        self.assertEqual(2, backing.reads)
+
+        stats = cache.stats()
+        self.assertEqual(4, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(2, stats['entries'])
+
+    def test_write_and_delete_invalidate(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import CachingStore
+        backing = _CountingStore()
+        cache = CachingStore(backing, 10000)
+        coord = self._coord(1)
+
+        self.assertIsNone(cache.read_tile(coord, json_format, 'all'))
+        cache.write_tile('new', coord, json_format, 'all')
+        self.assertEqual('new', cache.read_tile(coord, json_format, 'all'))
+        self.assertEqual(1, backing.reads)
+
+        self.assertEqual(1, cache.delete_tiles(
+            iter([coord]), json_format, 'all'))
+        self.assertIsNone(cache.read_tile(coord, json_format, 'all'))
+        self.assertEqual(2, backing.reads)
+
+    def test_eviction_to_disk(self):
+        import shutil
+        import tempfile
+        from tilequeue.format import json_format
+        from tilequeue.store import CachingStore
+        from tilequeue.store import TileDirectory
+        dir_path = tempfile.mkdtemp()
+        try:
+            backing = _CountingStore()
+            for x in xrange(5):
+                backing.write_tile(
+                    'x' * 100, self._coord(x), json_format, 'all')
+            disk = TileDirectory(dir_path)
+            cache = CachingStore(backing, 450, disk)
+
+            for x in xrange(5):
+                cache.read_tile(self._coord(x), json_format, 'all')
+            stats = cache.stats()
+            self.assertEqual(3, stats['evictions'])
+            self.assertEqual(2, stats['entries'])
+            self.assertEqual(3, stats['disk_entries'])
+            self.assertTrue(stats['bytes'] <= 450)
+
+            self.assertEqual('x' * 100, cache.read_tile(
+                self._coord(0), json_format, 'all'))
+            self.assertEqual(1, cache.stats()['disk_hits'])
+            self.assertEqual(5, backing.reads)
+        finally:
+            shutil.rmtree(dir_path)
+
+    def test_disk_dir_per_process(self):
+        import os
+        import shutil
+        import tempfile
+        from tilequeue.format import json_format
+        from tilequeue.store import make_caching_store
+        dir_path = tempfile.mkdtemp()
+        try:
+            # anything else under the disk path is left alone.
+            other_path = os.path.join(dir_path, 'other')
+            os.mkdir(other_path)
+            backing = _CountingStore()
+            caches = [make_caching_store(backing, 250, dir_path)
+                      for _ in xrange(2)]
+            for cache in caches:
+                for x in xrange(2):
+                    backing.write_tile(
+                        'x' * 100, self._coord(x), json_format, 'all')
+                    cache.read_tile(self._coord(x), json_format, 'all')
+                self.assertEqual(1, cache.stats()['disk_entries'])
+            self.assertEqual(3, len(os.listdir(dir_path)))
+
+            caches[0].close()
+            self.assertFalse(os.path.exists(caches[0].disk_store.base_path))
+            self.assertEqual('x' * 100, caches[1].read_tile(
+                self._coord(0), json_format, 'all'))
+            self.assertEqual(1, caches[1].stats()['disk_hits'])
+            caches[1].close()
+            self.assertEqual(['other'], os.listdir(dir_path))
+        finally:
+            shutil.rmtree(dir_path)
+
+    def test_disk_budget(self):
+        import os
+        import shutil
+        import tempfile
+        from tilequeue.format import json_format
+        from tilequeue.store import CachingStore
+        from tilequeue.store import TileDirectory
+        dir_path = tempfile.mkdtemp()
+        try:
+            backing = _CountingStore()
+            for x in xrange(6):
+                backing.write_tile(
+                    'x' * 100, self._coord(x), json_format, 'all')
+            disk = TileDirectory(dir_path)
+            cache = CachingStore(backing, 250, disk, 250)
+
+            for x in xrange(6):
+                cache.read_tile(self._coord(x), json_format, 'all')
+
+            def n_files():
+                return sum(len(files) for _, _, files in os.walk(dir_path))
+
+            # only one tile fits in memory, and only two on disk.
+            stats = cache.stats()
+            self.assertEqual(5, stats['evictions'])
+            self.assertEqual(3, stats['disk_evictions'])
+            self.assertEqual(2, stats['disk_entries'])
+            self.assertEqual(200, stats['disk_bytes'])
+            self.assertEqual(2, n_files())
+
+            # promoting a tile back to memory removes its file, although
+            # another tile is evicted to disk in its place.
+            cache.read_tile(self._coord(3), json_format, 'all')
+            self.assertEqual(1, cache.stats()['disk_hits'])
+            self.assertEqual(2, n_files())
+            self.assertEqual(6, backing.reads)
+        finally:
+            shutil.rmtree(dir_path)
+
+    def test_stale_fill(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import CachingStore
+        coord = self._coord(1)
+
+        class _RacingStore(_CountingStore):
+            def read_tile(self, coord, format, layer):
+                tile_data = super(_RacingStore, self).read_tile(
+                    coord, format, layer)
+                if self.reads == 1:
+                    # a write which finishes while the tile is being read.
+                    cache.write_tile('new', coord, format, layer)
+                return tile_data
+
+        backing = _RacingStore()
+        backing.write_tile('old', coord, json_format, 'all')
+        cache = CachingStore(backing, 10000)
+        self.assertEqual('old', cache.read_tile(coord, json_format, 'all'))
+        self.assertEqual('new', cache.read_tile(coord, json_format, 'all'))
+        self.assertEqual(1, backing.reads)
+        self.assertEqual(1, cache.stats()['stale_fills'])
+
+
+class TestContentAddressedStore(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def test_config_needs_blobs(self):
+        import os
+        from tilequeue.store import ContentAddressedStore
+        from tilequeue.store import make_store
+        store = make_store(dict(type='directory', path=self.dir_path,
+                                **{'content-addressed': True}))
+        self.assertIsInstance(store, ContentAddressedStore)
+
+        sqlite_path = os.path.join(self.dir_path, 'tiles.mbtiles')
+        with self.assertRaises(AssertionError):
+            make_store(dict(type='sqlite', path=sqlite_path,
+                            **{'content-addressed': True}))
+
+    def test_dedupe(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import BLOB_POINTER_PREFIX
+        from tilequeue.store import ContentAddressedStore
+        from tilequeue.store import TileDirectory
+        from tilequeue.store import store_stats
+        tile_dir = TileDirectory(self.dir_path)
+        store = ContentAddressedStore(tile_dir)
+
+        coords = [Coordinate(zoom=10, column=x, row=0) for x in xrange(4)]
+        for coord in coords[:3]:
+            store.write_tile('ocean', coord, json_format, 'all')
+        store.write_tile('land', coords[3], json_format, 'all')
+
+        for coord in coords[:3]:
+            self.assertEqual(
+                'ocean', store.read_tile(coord, json_format, 'all'))
+            self.assertTrue(tile_dir.read_tile(
+                coord, json_format, 'all').startswith(BLOB_POINTER_PREFIX))
+        self.assertEqual(
+            'land', store.read_tile(coords[3], json_format, 'all'))
+        self.assertIsNone(store.read_tile(
+            Coordinate(zoom=10, column=9, row=9), json_format, 'all'))
+
+        stats = store.stats()
+        self.assertEqual(4, stats['writes'])
+        self.assertEqual(2, stats['blob_writes'])
+        self.assertEqual(2, stats['distinct_tiles'])
+        self.assertEqual(2.0, stats['dedupe_ratio'])
+        self.assertEqual(dict(ContentAddressedStore=stats),
+                         store_stats(store))
+
+        # a new run doesn't write blobs which are already stored.
+        store = ContentAddressedStore(tile_dir)
+        store.write_tile('ocean', coords[0], json_format, 'all')
+        self.assertEqual(0, store.stats()['blob_writes'])
+
+    def test_known_digests_bounded(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import ContentAddressedStore
+        from tilequeue.store import TileDirectory
+        tile_dir = TileDirectory(self.dir_path)
+        store = ContentAddressedStore(tile_dir, max_known_digests=2)
+
+        coord = Coordinate(zoom=10, column=0, row=0)
+        for tile_data in ('a', 'b', 'a', 'c'):
+            store.write_tile(tile_data, coord, json_format, 'all')
+        # 'b' was the least recently written.
+        self.assertEqual(2, len(store._known_digests))
+        self.assertEqual(3, store.stats()['distinct_tiles'])
+
+        # a forgotten tile's blob is found in the store rather than written
+        # again.
+        store.write_tile('b', coord, json_format, 'all')
+        stats = store.stats()
+        self.assertEqual(3, stats['blob_writes'])
+        self.assertEqual(4, stats['distinct_tiles'])
+
+    def test_metatiles_dedupe_on_contents(self):
+        from time import gmtime, time
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.metatile import make_metatiles
+        from tilequeue.store import ContentAddressedStore
+        from tilequeue.store import TileDirectory
+        store = ContentAddressedStore(TileDirectory(self.dir_path))
+
+        t = time()
+        for x, when in enumerate((t - 10, t)):
+            tiles = [dict(tile='{}', coord=Coordinate(zoom=10, column=x,
+                                                      row=0),
+                          format=json_format, layer='all')]
+            metatile, = make_metatiles(1, tiles, gmtime(when)[0:6])
+            store.write_tile(metatile['tile'], Coordinate(
+                zoom=10, column=0, row=0), metatile['format'], 'all')
+        self.assertEqual(1, store.stats()['blob_writes'])
+
+
 class WriteTileIfChangedTest(unittest.TestCase):
 
     def setUp(self):
@@ -2,6 +2,8 @@ from collections import defaultdict
 from collections import namedtuple
 from contextlib import closing
 from itertools import chain
+from itertools import ifilter
+from itertools import imap
 from ModestMaps.Core import Coordinate
 from multiprocessing.pool import ThreadPool
 from random import randrange
@@ -12,11 +14,13 @@ from tilequeue.metro_extract import city_bounds
 from tilequeue.metro_extract import parse_metro_extract
 from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
-from tilequeue.query import DBConnectionPool
+from tilequeue.query import make_db_conn_pool
 from tilequeue.query import make_data_fetcher
+from tilequeue.query import make_rawr_index_pool
 from tilequeue.queue import make_sqs_queue
 from tilequeue.queue import make_visibility_manager
 from tilequeue.store import make_store
+from tilequeue.store import store_stats
 from tilequeue.tile import coord_children_range
 from tilequeue.tile import coord_int_zoom_up
 from tilequeue.tile import coord_is_valid
@@ -47,6 +51,7 @@ from urllib2 import urlopen
 from zope.dottedname.resolve import resolve
 import argparse
 import datetime
+import json
 import logging
 import logging.config
 import multiprocessing
@@ -662,8 +667,12 @@ def tilequeue_process(cfg, peripherals):
     n_total_needed = n_total_needed_query + n_total_needed_s3
     n_max_io_workers = 50
     n_io_workers = min(n_total_needed, n_max_io_workers)
+    # the index processes are forked, so they're started before any of the
+    # threads.
+    index_pool = make_rawr_index_pool(cfg, layer_data)
     io_pool = ThreadPool(n_io_workers)
-    feature_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    feature_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, io_pool, peripherals.stats, index_pool)
 
     # create all queues used to manage pipeline
 
@@ -697,7 +706,8 @@ def tilequeue_process(cfg, peripherals):
     tile_queue_reader = TileQueueReader(
         queue_mapper, msg_marshaller, msg_tracker, tile_input_queue,
         tile_proc_logger, stats_handler, thread_tile_queue_reader_stop,
-        cfg.max_zoom, cfg.group_by_zoom)
+        cfg.max_zoom, cfg.group_by_zoom,
+        getattr(feature_fetcher, 'prefetch', None))
 
     data_fetch = DataFetch(
         feature_fetcher, tile_input_queue, sql_data_fetch_queue, io_pool,
@@ -857,6 +867,10 @@ def tilequeue_process(cfg, peripherals):
         io_pool.join()
         tile_proc_logger.lifecycle('joining io pool ... done')
 
+        stats = store_stats(store)
+        if stats:
+            tile_proc_logger.lifecycle('store stats: %s' % json.dumps(stats))
+
         tile_proc_logger.lifecycle('joining multiprocess data fetch queue ...')
         sql_data_fetch_queue.close()
         sql_data_fetch_queue.join_thread()
@@ -988,6 +1002,35 @@ def tilequeue_enqueue_stdin(cfg, peripherals):
     logger.info('%d enqueued - %d in flight' % (n_queued, n_in_flight))
 
 
+def tilequeue_query_cache_invalidate(cfg, peripherals, args):
+    """
+    Remove the cached query results covering the expired tiles listed in the
+    files given, or on stdin if there are none.
+    """
+
+    from tilequeue.query import make_query_result_cache
+    from tilequeue.stats import QueryCacheStatsHandler
+    logger = make_logger(cfg, 'query_cache_invalidate')
+
+    query_cache_yaml = cfg.yml.get('query-cache')
+    assert query_cache_yaml, 'Missing query-cache config'
+    query_cache = make_query_result_cache(
+        query_cache_yaml, QueryCacheStatsHandler(peripherals.stats))
+
+    source_names = args.source or None
+    if args.expired_files:
+        for path in args.expired_files:
+            with open(path) as fp:
+                coords = create_coords_generator_from_tiles_file(fp, logger)
+                n = query_cache.invalidate(coords, source_names)
+            logger.info('Invalidated %d query cache entries from %s'
+                        % (n, path))
+    else:
+        coords = create_coords_generator_from_tiles_file(sys.stdin, logger)
+        n = query_cache.invalidate(coords, source_names)
+        logger.info('Invalidated %d query cache entries' % n)
+
+
 def coord_pyramid(coord, zoom_start, zoom_stop):
     """
     generate full pyramid for coord
@@ -1145,11 +1188,9 @@ def tilequeue_consume_tile_traffic(cfg, peripherals):
         logger.info("Couldn't parse log file")
         sys.exit(1)
 
-    conn_info = dict(cfg.postgresql_conn_info)
-    dbnames = conn_info.pop('dbnames')
-    sql_conn_pool = DBConnectionPool(dbnames, conn_info, False)
-    sql_conn = sql_conn_pool.get_conns(1)[0]
-    with sql_conn.cursor() as cursor:
+    sql_conn_pool = make_db_conn_pool(cfg.postgresql_conn_info, False)
+    with sql_conn_pool.get_conns(1) as sql_conns, \
+            sql_conns[0].cursor() as cursor:
 
         # insert the log records after the latest_date
         cursor.execute('SELECT max(date) from tile_traffic_v4')
@@ -1169,7 +1210,7 @@ def tilequeue_consume_tile_traffic(cfg, peripherals):
 
         logger.info('Inserted %d records' % n_coords_inserted)
 
-    sql_conn_pool.put_conns([sql_conn])
+    sql_conn_pool.close()
 
 
 def emit_toi_stats(toi_set, peripherals):
@@ -1382,12 +1423,12 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
         logger.info('Removing %s tiles from TOI and S3 ...',
                     len(toi_to_remove))
 
-        for coord_ints in grouper(toi_to_remove, 1000):
-            removed = store.delete_tiles(
-                map(coord_unmarshall_int, coord_ints),
-                lookup_format_by_extension(
-                    store_parts['format']), store_parts['layer'])
-            logger.info('Removed %s tiles from S3', removed)
+        # the store deletes in concurrent batches and logs its own progress.
+        removed = store.delete_tiles(
+            imap(coord_unmarshall_int, toi_to_remove),
+            lookup_format_by_extension(
+                store_parts['format']), store_parts['layer'])
+        logger.info('Removed %s tiles from S3', removed)
 
         logger.info('Removing %s tiles from TOI and S3 ... done',
                     len(toi_to_remove))
@@ -1550,10 +1591,13 @@ def tilequeue_stuck_tiles(cfg, peripherals):
     assert peripherals.toi, 'Missing toi'
     toi = peripherals.toi.fetch_tiles_of_interest()
 
-    for coord in store.list_tiles(format, layer):
-        coord_int = coord_marshall_int(coord)
-        if coord_int not in toi:
-            print serialize_coord(coord)
+    # the store streams back coordinates as integers, so we can check
+    # membership against the toi a whole chunk at a time.
+    for coord_ints in grouper(store.list_tile_ints(format, layer), 100000):
+        stuck_coord_ints = set(coord_ints)
+        stuck_coord_ints.difference_update(toi)
+        for coord_int in stuck_coord_ints:
+            print serialize_coord(coord_unmarshall_int(coord_int))
 
 
 def tilequeue_delete_stuck_tiles(cfg, peripherals):
@@ -1562,20 +1606,11 @@ def tilequeue_delete_stuck_tiles(cfg, peripherals):
     format = lookup_format_by_extension('zip')
     layer = 'all'
 
-    store = _make_store(cfg)
+    store = _make_store(cfg, logger)
 
     logger.info('Removing tiles from S3 ...')
-    total_removed = 0
-    for coord_strs in grouper(sys.stdin, 1000):
-        coords = []
-        for coord_str in coord_strs:
-            coord = deserialize_coord(coord_str)
-            if coord:
-                coords.append(coord)
-        if coords:
-            n_removed = store.delete_tiles(coords, format, layer)
-            total_removed += n_removed
-            logger.info('Removed %s tiles from S3', n_removed)
+    coords = ifilter(None, imap(deserialize_coord, sys.stdin))
+    total_removed = store.delete_tiles(coords, format, layer)
 
     logger.info('Total removed: %d', total_removed)
     logger.info('Removing tiles from S3 ... DONE')
@@ -1704,9 +1739,11 @@ def tilequeue_process_tile(cfg, peripherals, args):
             query_cfg, cfg.buffer_cfg, os.path.dirname(cfg.query_cfg)))
 
     output_calc_mapping = make_output_calc_mapping(cfg.process_yaml_cfg)
+    index_pool = make_rawr_index_pool(cfg, layer_data)
     io_pool = ThreadPool(len(layer_data))
 
-    data_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    data_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, io_pool, index_pool=index_pool)
 
     nominal_zoom = coord.zoom + cfg.metatile_zoom
     unpadded_bounds = coord_to_mercator_bounds(coord)
@@ -1769,26 +1806,44 @@ def tilequeue_rawr_process(cfg, peripherals):
     assert msg_marshall_yaml, 'Missing message-marshall config'
     msg_marshaller = make_message_marshaller(msg_marshall_yaml)
 
+    # the visibility of messages which are still being processed is
+    # extended, as for the tile queue, if message-visibility is configured.
+    visibility_mgr = None
+    visibility_yaml = cfg.yml.get('message-visibility')
+    if visibility_yaml:
+        visibility_mgr = make_visibility_mgr_from_cfg(visibility_yaml)
+
     rawr_queue_yaml = rawr_yaml.get('queue')
     assert rawr_queue_yaml, 'Missing rawr queue config'
-    rawr_queue = make_rawr_queue_from_yaml(rawr_queue_yaml, msg_marshaller)
+    rawr_queue = make_rawr_queue_from_yaml(
+        rawr_queue_yaml, msg_marshaller, visibility_mgr)
+    read_size = rawr_queue_yaml.get('read-size', 1)
+    assert 1 <= read_size <= 10, 'Invalid rawr queue read-size'
+
+    # each generation thread keeps its own connection to the database.
+    n_threads = rawr_yaml.get('generation-threads', 1)
+    assert n_threads >= 1, 'Invalid rawr generation-threads'
 
     rawr_postgresql_yaml = rawr_yaml.get('postgresql')
     assert rawr_postgresql_yaml, 'Missing rawr postgresql config'
 
     from raw_tiles.formatter.msgpack import Msgpack
     from raw_tiles.gen import RawrGenerator
-    from raw_tiles.source.conn import ConnectionContextManager
     from raw_tiles.source import parse_sources
     from raw_tiles.source import DEFAULT_SOURCES as DEFAULT_RAWR_SOURCES
     from tilequeue.log import JsonRawrProcessingLogger
     from tilequeue.rawr import RawrS3Sink
     from tilequeue.rawr import RawrStoreSink
     from tilequeue.rawr import RawrTileGenerationPipeline
+    from tilequeue.rawr import ThreadConnections
     from tilequeue.stats import RawrTilePipelineStatsHandler
     import boto3
+    import psycopg2
+
     # pass through the postgresql yaml config directly
-    conn_ctx = ConnectionContextManager(rawr_postgresql_yaml)
+    def connect():
+        return psycopg2.connect(**rawr_postgresql_yaml)
+    conn_ctx = ThreadConnections(connect)
 
     rawr_source_list = rawr_yaml.get('sources', DEFAULT_RAWR_SOURCES)
     assert isinstance(rawr_source_list, list), \
@@ -1796,11 +1851,16 @@ def tilequeue_rawr_process(cfg, peripherals):
     assert len(rawr_source_list) > 0, \
         'RAWR source list should be non-empty'
 
+    # write the feature tables in the columnar format, which is quicker to
+    # read. tiles in either format can be read, so this can be switched on
+    # before all the existing tiles have been regenerated.
+    columnar = rawr_yaml.get('columnar-tables', False)
+
     rawr_store = rawr_yaml.get('store')
     if rawr_store:
         store = make_store(rawr_store,
                            credentials=cfg.subtree('aws credentials'))
-        rawr_sink = RawrStoreSink(store)
+        rawr_sink = RawrStoreSink(store, columnar)
 
     else:
         rawr_sink_yaml = rawr_yaml.get('sink')
@@ -1815,7 +1875,7 @@ def tilequeue_rawr_process(cfg, peripherals):
         assert suffix, 'Missing rawr sink suffix'
 
         s3_client = boto3.client('s3', region_name=sink_region)
-        rawr_sink = RawrS3Sink(s3_client, bucket, prefix, suffix)
+        rawr_sink = RawrS3Sink(s3_client, bucket, prefix, suffix, columnar)
 
     logger = make_logger(cfg, 'rawr_process')
     rawr_source = parse_sources(rawr_source_list)
@@ -1823,10 +1883,15 @@ def tilequeue_rawr_process(cfg, peripherals):
     rawr_gen = RawrGenerator(rawr_source, rawr_formatter, rawr_sink)
     stats_handler = RawrTilePipelineStatsHandler(peripherals.stats)
     rawr_proc_logger = JsonRawrProcessingLogger(logger)
+    # check often enough that each extension is made soon after it's due.
+    progress_interval = 60
+    if visibility_mgr is not None:
+        progress_interval = max(1, visibility_mgr.extend_secs // 10)
     rawr_pipeline = RawrTileGenerationPipeline(
             rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
             peripherals.queue_writer, stats_handler,
-            rawr_proc_logger, conn_ctx)
+            rawr_proc_logger, conn_ctx, n_threads, read_size,
+            progress_interval)
     rawr_pipeline()
 
 
@@ -2000,9 +2065,11 @@ def tilequeue_batch_process(cfg, args):
             query_cfg, cfg.buffer_cfg, os.path.dirname(cfg.query_cfg)))
 
     output_calc_mapping = make_output_calc_mapping(cfg.process_yaml_cfg)
+    index_pool = make_rawr_index_pool(cfg, layer_data)
     io_pool = ThreadPool(len(layer_data))
 
-    data_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    data_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, io_pool, index_pool=index_pool)
 
     rawr_yaml = cfg.yml.get('rawr')
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
@@ -2086,6 +2153,10 @@ def tilequeue_batch_process(cfg, args):
 
     batch_logger.end_run(queue_coord)
 
+    stats = store_stats(store)
+    if stats:
+        logger.info('store stats: %s', json.dumps(stats))
+
 
 def tilequeue_main(argv_args=None):
     if argv_args is None:
@@ -2189,6 +2260,19 @@ def tilequeue_main(argv_args=None):
     subparser.set_defaults(
             func=_make_peripherals_with_args_command(tilequeue_tile_status))
 
+    subparser = subparsers.add_parser('query-cache-invalidate')
+    subparser.add_argument('--config', required=True,
+                           help='The path to the tilequeue config file.')
+    subparser.add_argument('--source', action='append',
+                           help='Only invalidate the results of this query '
+                           'source. Can be given more than once.')
+    subparser.add_argument('expired_files', nargs='*',
+                           help='Files of expired tiles as "z/x/y", one per '
+                           'line. Read from stdin if none are given.')
+    subparser.set_defaults(
+            func=_make_peripherals_with_args_command(
+                tilequeue_query_cache_invalidate))
+
     subparser = subparsers.add_parser('tile')
     subparser.add_argument('--config', required=True,
                            help='The path to the tilequeue config file.')
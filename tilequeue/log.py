@@ -115,6 +115,8 @@ class JsonTileProcessingLogger(object):
             size=coord_proc_data.size,
             storage=coord_proc_data.store_info,
         )
+        if coord_proc_data.queries:
+            json_obj['queries'] = coord_proc_data.queries
         json_str = json.dumps(json_obj)
         self.logger.info(json_str)
 
@@ -1,5 +1,6 @@
 import zipfile
 import cStringIO as StringIO
+import md5
 from collections import defaultdict
 from tilequeue.format import zip_format
 from time import gmtime
@@ -182,3 +183,25 @@ def metatiles_are_equal(tile_data_1, tile_data_2):
         pass
 
     return False
+
+
+def metatile_contents_hash(tile_data):
+    """
+    Return a hex digest of the contents of a zipped metatile, such that two
+    metatiles which metatiles_are_equal have the same digest. Returns None
+    if the tile data isn't a zip file.
+    """
+
+    try:
+        with zipfile.ZipFile(StringIO.StringIO(tile_data), mode='r') as zf:
+            m = md5.new()
+            for name in sorted(zf.namelist()):
+                contents = zf.read(name)
+                # length prefixes stop the boundaries between names and
+                # contents from being ambiguous.
+                m.update('%d:%s%d:' % (len(name), name, len(contents)))
+                m.update(contents)
+            return m.hexdigest()
+
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
+        return None
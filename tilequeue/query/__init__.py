@@ -1,5 +1,7 @@
+from tilequeue.query.cache import make_query_result_cache
 from tilequeue.query.fixture import make_fixture_data_fetcher
 from tilequeue.query.pool import DBConnectionPool
+from tilequeue.query.pool import make_db_conn_pool
 from tilequeue.query.postgres import make_db_data_fetcher
 from tilequeue.query.rawr import make_rawr_data_fetcher
 from tilequeue.query.split import make_split_data_fetcher
@@ -8,20 +10,34 @@ from tilequeue.process import Source
 
 __all__ = [
     'DBConnectionPool',
+    'make_db_conn_pool',
     'make_db_data_fetcher',
     'make_fixture_data_fetcher',
     'make_data_fetcher',
+    'make_query_result_cache',
+    'make_rawr_index_pool',
 ]
 
 
-def make_data_fetcher(cfg, layer_data, query_cfg, io_pool):
+def make_data_fetcher(cfg, layer_data, query_cfg, io_pool, stats=None,
+                      index_pool=None):
+    query_cache = None
+    query_cache_yaml = cfg.yml.get('query-cache')
+    if query_cache_yaml:
+        query_cache_stats_handler = None
+        if stats is not None:
+            from tilequeue.stats import QueryCacheStatsHandler
+            query_cache_stats_handler = QueryCacheStatsHandler(stats)
+        query_cache = make_query_result_cache(
+            query_cache_yaml, query_cache_stats_handler)
+
     db_fetcher = make_db_data_fetcher(
         cfg.postgresql_conn_info, cfg.template_path, cfg.reload_templates,
-        query_cfg, io_pool)
+        query_cfg, io_pool, query_cache)
 
     if cfg.yml.get('use-rawr-tiles'):
         rawr_fetcher = _make_rawr_fetcher(
-            cfg, layer_data, query_cfg, io_pool)
+            cfg, layer_data, query_cfg, io_pool, stats, index_pool)
 
         group_by_zoom = cfg.yml.get('rawr').get('group-zoom')
         assert group_by_zoom is not None, 'Missing group-zoom rawr config'
@@ -32,6 +48,29 @@ def make_data_fetcher(cfg, layer_data, query_cfg, io_pool):
         return db_fetcher
 
 
+def make_rawr_index_pool(cfg, layer_data):
+    """
+    Make the pool of processes to build the indexes of each RAWR tile in, if
+    rawr index-processes is configured, or return None.
+
+    The processes are forked from this one, so the pool must be made before
+    any threads are started, e.g: before the io_pool ThreadPool, and then
+    passed to make_data_fetcher. A fork copies only the thread which made
+    it, so a lock held by another thread at the time stays locked forever
+    in the child.
+    """
+
+    if not cfg.yml.get('use-rawr-tiles'):
+        return None
+    index_processes = (cfg.yml.get('rawr') or {}).get('index-processes')
+    if not index_processes:
+        return None
+
+    from tilequeue.query.rawr import make_index_pool
+    layers = _make_layer_info(layer_data, cfg.process_yaml_cfg)
+    return make_index_pool(int(index_processes), layers)
+
+
 class _NullRawrStorage(object):
 
     def __init__(self, data_source, table_sources):
@@ -53,7 +92,8 @@ class _NullRawrStorage(object):
         return _tables
 
 
-def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
+def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool, stats=None,
+                       index_pool=None):
     rawr_yaml = cfg.yml.get('rawr')
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
 
@@ -91,6 +131,10 @@ def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
     #              settings.
     source_type = rawr_source_yaml.get('type')
 
+    # whether the storage only reads the tables as they're used, so there's
+    # nothing much to fetch ahead of time.
+    lazy_tables = False
+
     if source_type == 's3':
         rawr_source_s3_yaml = rawr_source_yaml.get('s3')
         bucket = rawr_source_s3_yaml.get('bucket')
@@ -103,12 +147,46 @@ def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
         assert suffix, 'Missing rawr source s3 suffix'
         allow_missing_tiles = rawr_source_s3_yaml.get(
             'allow-missing-tiles', False)
+        range_reads = rawr_source_s3_yaml.get('range-reads', False)
+
+        disk_cache = None
+        disk_cache_yaml = rawr_source_s3_yaml.get('disk-cache')
+        if disk_cache_yaml:
+            from tilequeue.rawr import make_rawr_disk_cache
+            disk_cache = make_rawr_disk_cache(disk_cache_yaml)
+
+        # optionally give each request for a RAWR tile a deadline, retry
+        # failures and hedge slow requests.
+        fetch_policy = None
+        fetch_yaml = rawr_source_s3_yaml.get('fetch')
+        if fetch_yaml:
+            from tilequeue.rawr import make_rawr_fetch_policy
+            fetch_stats_handler = None
+            if stats is not None:
+                from tilequeue.stats import RawrFetchStatsHandler
+                fetch_stats_handler = RawrFetchStatsHandler(stats)
+            fetch_policy = make_rawr_fetch_policy(
+                fetch_yaml, fetch_stats_handler)
 
         import boto3
         from tilequeue.rawr import RawrS3Source
-        s3_client = boto3.client('s3', region_name=region)
+        client_config = None
+        if fetch_policy is not None:
+            # the policy does the retrying, and abandoned requests need to
+            # time out rather than holding their connection and thread.
+            from botocore.config import Config
+            timeout = fetch_yaml.get('attempt-timeout') or 60
+            client_config = Config(
+                connect_timeout=fetch_yaml.get('connect-timeout', timeout),
+                read_timeout=fetch_yaml.get('read-timeout', timeout),
+                retries=dict(max_attempts=0))
+        s3_client = boto3.client('s3', region_name=region,
+                                 config=client_config)
         storage = RawrS3Source(s3_client, bucket, prefix, suffix,
-                               table_sources, allow_missing_tiles)
+                               table_sources, allow_missing_tiles,
+                               range_reads, disk_cache, fetch_policy)
+        # range reads are only used without the disk cache.
+        lazy_tables = range_reads and disk_cache is None
 
     elif source_type == 'generate':
         from raw_tiles.source.conn import ConnectionContextManager
@@ -134,15 +212,39 @@ def _make_rawr_fetcher(cfg, layer_data, query_cfg, io_pool):
         assert False, 'Source type %r not understood. ' \
             'Options are s3, generate and store.' % (source_type,)
 
+    # optionally start fetching the RAWR tiles for upcoming jobs while the
+    # current one is being processed, holding up to this many at once. with
+    # range reads, that would only fetch the zip's directory, so it's off.
+    prefetch_tiles = rawr_yaml.get('prefetch-tiles')
+    if prefetch_tiles and not lazy_tables:
+        from tilequeue.query.rawr import PrefetchingStorage
+        storage = PrefetchingStorage(storage, int(prefetch_tiles))
+
     # TODO: this needs to be configurable, everywhere! this is a long term
     # refactor - it's hard-coded in a bunch of places :-(
     max_z = 16
 
     layers = _make_layer_info(layer_data, cfg.process_yaml_cfg)
 
+    # optionally keep built RAWR tiles in memory, up to an estimated
+    # max-bytes, so that jobs for the same RAWR tile don't download and
+    # index it again. only s3 sources can say which version of a RAWR tile
+    # they have, so the cache isn't used for other sources.
+    tile_cache = None
+    tile_cache_yaml = rawr_yaml.get('tile-cache')
+    if tile_cache_yaml:
+        from tilequeue.query.rawr import RawrTileCache
+        max_bytes = tile_cache_yaml.get('max-bytes')
+        assert max_bytes, 'Missing rawr tile-cache max-bytes'
+        tile_cache_stats_handler = None
+        if stats is not None:
+            from tilequeue.stats import RawrTileCacheStatsHandler
+            tile_cache_stats_handler = RawrTileCacheStatsHandler(stats)
+        tile_cache = RawrTileCache(int(max_bytes), tile_cache_stats_handler)
+
     return make_rawr_data_fetcher(
         group_by_zoom, max_z, storage, layers, indexes_cfg,
-        label_placement_layers)
+        label_placement_layers, tile_cache, index_pool)
 
 
 def _make_layer_info(layer_data, process_yaml_cfg):
@@ -0,0 +1,328 @@
+from ModestMaps.Core import Coordinate
+from tilequeue.tile import coord_to_mercator_bounds
+from tilequeue.tile import earth_circum
+from tilequeue.tile import mercator_point_to_coord
+import cPickle
+import errno
+import math
+import md5
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+
+def bounds_coord(bounds):
+    """
+    Returns the tile coordinate whose bounds are the given bounds, or None if
+    they aren't the bounds of a tile.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    width = maxx - minx
+    if width <= 0:
+        return None
+    zoom = int(round(math.log(earth_circum / width, 2)))
+    if zoom < 0:
+        return None
+    coord = mercator_point_to_coord(
+        zoom, minx + width / 2.0, maxy - width / 2.0)
+    tile_bounds = coord_to_mercator_bounds(coord)
+    for a, b in zip(bounds, tile_bounds):
+        if abs(a - b) > 1.0e-3:
+            return None
+    return coord
+
+
+def _query_key(query):
+    if isinstance(query, basestring):
+        text = query
+    else:
+        text = query.sql() + repr(query.params)
+    return md5.new(text).hexdigest()
+
+
+class QueryResultCache(object):
+
+    """Disk cache of the rows returned by each source's queries
+
+    Entries are keyed by the source, the tile which the bounds cover, and
+    the text and parameters of the query, which covers the zoom and any
+    change to the source's templates. They're stored as compressed pickles
+    in a directory per tile and source:
+
+      <path>/<z>/<x>/<y>/<source>/<query hash>
+
+    so that the entries covering an expired tile can be removed without an
+    index. Only queries for nominal zooms up to max_zoom, and for bounds
+    which are exactly a tile, are cached.
+
+    Entries expire ttl seconds after they were written, unless source_ttls
+    has a different value for their source. A TTL of zero, or None, means
+    that the source isn't cached at all.
+
+    If max_bytes is set, the entries are kept within that many bytes on
+    disk. The directory is shared between processes, so each process keeps
+    a running total of what it has written since it last scanned the
+    directory. Once that total passes max_bytes, or after scan_interval
+    writes, the directory is scanned. Expired entries are removed, and
+    then the oldest ones until the total is back under the budget.
+    """
+
+    # writes between scans of the directory, so that what the other
+    # processes have written is counted too.
+    scan_interval = 1000
+    # evicting goes below the budget by this fraction, so that it isn't
+    # needed again straight away.
+    evict_fraction = 0.1
+
+    def __init__(self, path, max_zoom, ttl, source_ttls=None,
+                 stats_handler=None, max_bytes=None):
+        self.path = path
+        self.max_zoom = max_zoom
+        self.ttl = ttl
+        self.source_ttls = source_ttls or {}
+        self.stats_handler = stats_handler
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, expired=0, writes=0,
+                           bytes_saved=0, invalidations=0, evictions=0)
+        # the total size of the entries, as of the last scan plus what has
+        # been written since, and the number of writes since the scan.
+        self._bytes = None
+        self._writes_since_scan = 0
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self._stats[name] += n
+
+    def source_ttl(self, source_name):
+        return self.source_ttls.get(source_name, self.ttl)
+
+    def key(self, source_name, zoom, bounds, query):
+        """
+        Returns the path of the cache entry for the query, or None if the
+        query shouldn't be cached.
+        """
+
+        if zoom > self.max_zoom or not self.source_ttl(source_name):
+            return None
+        coord = bounds_coord(bounds)
+        if coord is None:
+            return None
+        return os.path.join(
+            self._tile_path(coord), source_name, _query_key(query))
+
+    def _tile_path(self, coord):
+        return os.path.join(self.path, str(int(coord.zoom)),
+                            str(int(coord.column)), str(int(coord.row)))
+
+    def get(self, source_name, key):
+        """
+        Returns the cached rows for the key, or None if there aren't any or
+        they have expired.
+        """
+
+        try:
+            mtime = os.stat(key).st_mtime
+            if time.time() - mtime > self.source_ttl(source_name):
+                self._remove(key)
+                self._count('expired')
+                rows = None
+            else:
+                with open(key, 'rb') as fh:
+                    # the result's uncompressed size is what it saved.
+                    data = zlib.decompress(fh.read())
+                rows = cPickle.loads(data)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            rows = None
+
+        if rows is None:
+            self._count('misses')
+            if self.stats_handler:
+                self.stats_handler.miss(source_name)
+        else:
+            self._count('hits')
+            self._count('bytes_saved', len(data))
+            if self.stats_handler:
+                self.stats_handler.hit(source_name, len(data))
+        return rows
+
+    def put(self, key, rows):
+        dir_path = os.path.dirname(key)
+        try:
+            os.makedirs(dir_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        data = zlib.compress(cPickle.dumps(rows, cPickle.HIGHEST_PROTOCOL))
+        # write to a temporary file and rename it into place, so that
+        # readers never see a partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.rename(tmp_path, key)
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        self._count('writes')
+
+        if self.max_bytes is not None:
+            with self.lock:
+                if self._bytes is not None:
+                    self._bytes += len(data)
+                self._writes_since_scan += 1
+                should_scan = self._bytes is None or \
+                    self._bytes > self.max_bytes or \
+                    self._writes_since_scan >= self.scan_interval
+                if should_scan:
+                    self._writes_since_scan = 0
+            if should_scan:
+                self._enforce_budget()
+
+    def _scan(self):
+        # returns a list of (mtime, size, path, source name) for each entry.
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            source_name = os.path.basename(dir_path)
+            for file_name in file_names:
+                if file_name.startswith('.tmp'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                entries.append((st.st_mtime, st.st_size, path, source_name))
+        return entries
+
+    def _enforce_budget(self):
+        now = time.time()
+        entries = self._scan()
+        total = sum(entry[1] for entry in entries)
+        n_evicted = 0
+
+        # expired entries go first, and then the oldest until the total is
+        # under the budget.
+        remaining = []
+        for entry in entries:
+            mtime, size, path, source_name = entry
+            ttl = self.source_ttl(source_name)
+            if not ttl or now - mtime > ttl:
+                self._remove(path)
+                total -= size
+                n_evicted += 1
+            else:
+                remaining.append(entry)
+
+        if total > self.max_bytes:
+            target = self.max_bytes * (1.0 - self.evict_fraction)
+            remaining.sort()
+            for mtime, size, path, source_name in remaining:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+                n_evicted += 1
+
+        with self.lock:
+            self._bytes = total
+            self._stats['evictions'] += n_evicted
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _cached_zooms(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def _invalidate_tile(self, coord, source_names):
+        tile_path = self._tile_path(coord)
+        if source_names is None:
+            paths = [tile_path]
+        else:
+            paths = [os.path.join(tile_path, name) for name in source_names]
+        n = 0
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                n += 1
+        return n
+
+    def invalidate(self, coords, source_names=None):
+        """
+        Remove the cached entries which cover any of the coordinates, for
+        all sources or only those named in source_names. The coordinates can
+        be at any zoom; for example, an expired z16 tile invalidates the
+        entries for its ancestor at each cached zoom. Returns the number of
+        tile (or tile and source) directories removed.
+        """
+
+        cached_zooms = self._cached_zooms()
+        tiles = set()
+        for coord in coords:
+            for zoom in cached_zooms:
+                if coord.zoom >= zoom:
+                    tile = coord.zoomTo(zoom).container()
+                    tiles.add((zoom, int(tile.column), int(tile.row)))
+                else:
+                    tiles.update(self._cached_tiles_under(coord, zoom))
+
+        n = 0
+        for zoom, x, y in tiles:
+            n += self._invalidate_tile(
+                Coordinate(zoom=zoom, column=x, row=y), source_names)
+        self._count('invalidations', n)
+        if self.stats_handler:
+            self.stats_handler.invalidated(n)
+        return n
+
+    def _cached_tiles_under(self, coord, zoom):
+        # list the cached tiles at the zoom which are under the coordinate,
+        # rather than generating every possible one.
+        dz = zoom - int(coord.zoom)
+        x0 = int(coord.column) << dz
+        y0 = int(coord.row) << dz
+        n = 1 << dz
+        zoom_path = os.path.join(self.path, str(zoom))
+        for x_name in os.listdir(zoom_path):
+            if not x_name.isdigit() or not x0 <= int(x_name) < x0 + n:
+                continue
+            for y_name in os.listdir(os.path.join(zoom_path, x_name)):
+                if y_name.isdigit() and y0 <= int(y_name) < y0 + n:
+                    yield zoom, int(x_name), int(y_name)
+
+    def stats(self):
+        with self.lock:
+            return dict(self._stats)
+
+
+def make_query_result_cache(cache_yaml, stats_handler=None):
+    path = cache_yaml.get('path')
+    assert path, 'Missing query-cache path'
+    max_zoom = int(cache_yaml.get('max-zoom', 9))
+    ttl = cache_yaml.get('ttl', 3600)
+    source_ttls = cache_yaml.get('source-ttls')
+    max_bytes = cache_yaml.get('max-bytes', 1 << 30)
+    if max_bytes is not None:
+        max_bytes = int(max_bytes)
+    return QueryResultCache(path, max_zoom, ttl, source_ttls, stats_handler,
+                            max_bytes)
@@ -1,8 +1,11 @@
+from array import array
 from collections import namedtuple
 from collections import defaultdict
 from itertools import izip
 from tilequeue.process import Source
 from enum import Enum
+import struct
+import sys
 
 
 def namedtuple_with_defaults(name, props, defaults):
@@ -60,6 +63,121 @@ def wkb_shape_type(wkb):
         assert False, "WKB shape type %d not understood." % (typ,)
 
 
+_WKB_GEOM_TYPES = {
+    1: 'Point', 2: 'LineString', 3: 'Polygon', 4: 'MultiPoint',
+    5: 'MultiLineString', 6: 'MultiPolygon', 7: 'GeometryCollection',
+}
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def _wkb_header(wkb, offset):
+    # returns (little endian, geometry type, number of dimensions, offset of
+    # the geometry's body) for the WKB geometry at offset. understands
+    # EWKB's flags and SRID as well as ISO's Z and M type codes.
+    little_endian = ord(wkb[offset]) == 1
+    code = struct.unpack_from('<I' if little_endian else '>I',
+                              wkb, offset + 1)[0]
+    offset += 5
+    n_dims = 2
+    if code & 0x80000000:
+        n_dims += 1
+    if code & 0x40000000:
+        n_dims += 1
+    if code & 0x20000000:
+        # skip the SRID
+        offset += 4
+    code &= 0x0fffffff
+    iso_dims, typ = divmod(code, 1000)
+    if iso_dims in (1, 2):
+        n_dims += 1
+    elif iso_dims == 3:
+        n_dims += 2
+    return little_endian, typ, n_dims, offset
+
+
+def wkb_geom_type(wkb):
+    """
+    Returns the geometry type name of the WKB, as shapely's geom_type would,
+    without parsing the geometry.
+    """
+
+    _, typ, _, _ = _wkb_header(wkb, 0)
+    return _WKB_GEOM_TYPES[typ]
+
+
+def _wkb_coords(wkb, offset, n_points, n_dims, little_endian, envelope):
+    # widen the envelope to include the block of coordinates, reading them
+    # all at once into an array of doubles rather than one at a time.
+    end = offset + 8 * n_dims * n_points
+    if n_points:
+        coords = array('d')
+        coords.fromstring(wkb[offset:end])
+        if little_endian != _NATIVE_LITTLE_ENDIAN:
+            coords.byteswap()
+        xs = coords[0::n_dims]
+        ys = coords[1::n_dims]
+        # NaN coordinates are how WKB represents an empty point.
+        if xs[0] == xs[0]:
+            envelope[0] = min(envelope[0], min(xs))
+            envelope[1] = min(envelope[1], min(ys))
+            envelope[2] = max(envelope[2], max(xs))
+            envelope[3] = max(envelope[3], max(ys))
+    return end
+
+
+def _wkb_envelope(wkb, offset, envelope):
+    little_endian, typ, n_dims, offset = _wkb_header(wkb, offset)
+    uint = '<I' if little_endian else '>I'
+
+    if typ == 1:
+        return _wkb_coords(wkb, offset, 1, n_dims, little_endian, envelope)
+
+    elif typ == 2:
+        n_points = struct.unpack_from(uint, wkb, offset)[0]
+        return _wkb_coords(
+            wkb, offset + 4, n_points, n_dims, little_endian, envelope)
+
+    elif typ == 3:
+        n_rings = struct.unpack_from(uint, wkb, offset)[0]
+        offset += 4
+        for ring in xrange(n_rings):
+            n_points = struct.unpack_from(uint, wkb, offset)[0]
+            offset += 4
+            if ring == 0:
+                # the outer ring bounds the polygon, so there's no need to
+                # read the coordinates of any holes.
+                offset = _wkb_coords(
+                    wkb, offset, n_points, n_dims, little_endian, envelope)
+            else:
+                offset += 8 * n_dims * n_points
+        return offset
+
+    elif typ in (4, 5, 6, 7):
+        n_parts = struct.unpack_from(uint, wkb, offset)[0]
+        offset += 4
+        for _ in xrange(n_parts):
+            offset = _wkb_envelope(wkb, offset, envelope)
+        return offset
+
+    else:
+        assert False, "WKB shape type %d not understood." % (typ,)
+
+
+def wkb_envelope(wkb):
+    """
+    Returns the (minx, miny, maxx, maxy) bounds of the WKB geometry, read
+    directly from the bytes without building a shapely object, or None if
+    the geometry is empty.
+    """
+
+    inf = float('inf')
+    envelope = [inf, inf, -inf, -inf]
+    _wkb_envelope(wkb, 0, envelope)
+    if envelope[0] == inf:
+        return None
+    return tuple(envelope)
+
+
 def deassoc(x):
     """
     Turns an array consisting of alternating key-value pairs into a
@@ -204,7 +322,42 @@ Transit = namedtuple(
     'trains subways light_rails trams railways')
 
 
-def mz_calculate_transit_routes_and_score(osm, node_id, way_id, rel_id):
+class TransitCache(object):
+    """
+    Memoizes the parts of mz_calculate_transit_routes_and_score which depend
+    only on the relation graph, so that the stations and stops which share a
+    stop area, and so most of their graph, only walk it once. This must only
+    be used with a lookup which doesn't change once it's being read.
+    """
+
+    def __init__(self):
+        # frozenset of seed relation IDs -> (all relations, root relation)
+        self.relations = {}
+        # frozensets of station, line and relation IDs, and the root
+        # relation -> Transit
+        self.transits = {}
+
+    def recurse_up(self, seed_relations, osm):
+        key = frozenset(seed_relations)
+        result = self.relations.get(key)
+        if result is None:
+            result = mz_recurse_up_transit_relations(key, osm)
+            self.relations[key] = result
+        all_relations, root_relation_id = result
+        return set(all_relations), root_relation_id
+
+
+def _copy_transit(transit):
+    # the route lists end up in the feature's properties, so each feature
+    # gets its own copy.
+    return transit._replace(
+        trains=list(transit.trains), subways=list(transit.subways),
+        light_rails=list(transit.light_rails), trams=list(transit.trams),
+        railways=list(transit.railways))
+
+
+def mz_calculate_transit_routes_and_score(osm, node_id, way_id, rel_id,
+                                          cache=None):
     candidate_relations = set()
     if node_id:
         candidate_relations.update(osm.relations_using_node(node_id))
@@ -232,8 +385,12 @@ def mz_calculate_transit_routes_and_score(osm, node_id, way_id, rel_id):
     # the second sweep goes "downwards" from relations to "child" relations.
     # if a relation R1 has a member R2 which is also a relation, then R2 will
     # be included in this sweep as long as it also has "interesting" tags.
-    all_relations, root_relation_id = mz_recurse_up_transit_relations(
-        seed_relations, osm)
+    if cache is None:
+        all_relations, root_relation_id = mz_recurse_up_transit_relations(
+            seed_relations, osm)
+    else:
+        all_relations, root_relation_id = cache.recurse_up(
+            seed_relations, osm)
     del seed_relations
 
     # collect all the interesting nodes - this includes the station node (if
@@ -264,6 +421,17 @@ def mz_calculate_transit_routes_and_score(osm, node_id, way_id, rel_id):
     if way_id:
         stations_and_lines.add(way_id)
 
+    # the rest depends only on these sets of IDs, which are often the same
+    # for several features.
+    transit_key = None
+    if cache is not None:
+        transit_key = (frozenset(stations_and_stops),
+                       frozenset(stations_and_lines),
+                       frozenset(all_relations), root_relation_id)
+        transit = cache.transits.get(transit_key)
+        if transit is not None:
+            return _copy_transit(transit)
+
     # collect all IDs together in one array to intersect with the parts arrays
     # of route relations which may include them.
     all_routes = set()
@@ -303,9 +471,13 @@ def mz_calculate_transit_routes_and_score(osm, node_id, way_id, rel_id):
              10 * min(9, bonus * (len(subways) + len(light_rails))) +
              min(9, len(trams) + len(railways)))
 
-    return Transit(score=score, root_relation_id=root_relation_id,
-                   trains=trains, subways=subways, light_rails=light_rails,
-                   railways=railways, trams=trams)
+    transit = Transit(score=score, root_relation_id=root_relation_id,
+                      trains=trains, subways=subways, light_rails=light_rails,
+                      railways=railways, trams=trams)
+    if transit_key is not None:
+        cache.transits[transit_key] = transit
+        transit = _copy_transit(transit)
+    return transit
 
 
 _TAG_NAME_ALTERNATES = (
@@ -367,7 +539,35 @@ _US_ROUTE_MODIFIERS = set([
 # be used to look up nodes, ways and relations and the relationships between
 # them.
 def layer_properties(fid, shape, props, layer_name, zoom, osm):
+    layer_props, is_bus_route = zoomless_layer_properties(
+        fid, shape, props, layer_name, osm)
+    return zoom_layer_properties(layer_props, is_bus_route, zoom)
+
+
+def zoom_layer_properties(layer_props, is_bus_route, zoom):
+    """
+    Returns a copy of the properties from zoomless_layer_properties with the
+    properties which depend on the zoom added.
+    """
+
+    layer_props = layer_props.copy()
+    if is_bus_route and \
+       zoom >= 12 and \
+       layer_props.get('highway') in BUS_ROADS:
+        layer_props['is_bus_route'] = True
+    return layer_props
+
+
+def zoomless_layer_properties(fid, shape, props, layer_name, osm):
+    """
+    Returns the layer properties which don't depend on the zoom, and whether
+    the feature is part of a bus route, which is used to add properties at
+    some zooms. The result can be reused at every zoom, but mustn't be
+    modified.
+    """
+
     layer_props = props.copy()
+    mz_is_bus_route = False
 
     # drop the 'source' tag, if it exists. we override it anyway, and it just
     # gets confusing having multiple source tags. in the future, we may
@@ -393,7 +593,6 @@ def layer_properties(fid, shape, props, layer_name, zoom, osm):
        fid >= 0:
         mz_networks = []
         mz_cycling_networks = set()
-        mz_is_bus_route = False
         for rel_id in osm.relations_using_way(fid):
             rel = osm.relation(rel_id)
             if not rel:
@@ -430,11 +629,6 @@ def layer_properties(fid, shape, props, layer_name, zoom, osm):
                 mz_cycling_network = cn
                 break
 
-        if mz_is_bus_route and \
-           zoom >= 12 and \
-           layer_props.get('highway') in BUS_ROADS:
-            layer_props['is_bus_route'] = True
-
         layer_props['mz_networks'] = mz_networks
         if mz_cycling_network:
             layer_props['mz_cycling_network'] = mz_cycling_network
@@ -457,7 +651,8 @@ def layer_properties(fid, shape, props, layer_name, zoom, osm):
             rel_id = -fid
 
         transit = mz_calculate_transit_routes_and_score(
-            osm, node_id, way_id, rel_id)
+            osm, node_id, way_id, rel_id,
+            getattr(osm, 'transit_cache', None))
         layer_props['mz_transit_score'] = transit.score
         layer_props['mz_transit_root_relation_id'] = (
             transit.root_relation_id)
@@ -466,4 +661,4 @@ def layer_properties(fid, shape, props, layer_name, zoom, osm):
         layer_props['light_rail_routes'] = transit.light_rails
         layer_props['tram_routes'] = transit.trams
 
-    return layer_props
+    return layer_props, mz_is_bus_route
@@ -1,56 +1,368 @@
-from itertools import cycle
-from itertools import islice
+from collections import Counter
+from collections import defaultdict
+from psycopg2.extensions import connection as _psycopg2_connection
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import HstoreAdapter
 from psycopg2.extras import register_hstore, register_json
 import psycopg2
+import random
 import threading
+import time
 import ujson
 
 
+class PooledConnection(_psycopg2_connection):
+
+    """psycopg2 connection which can carry the pool's bookkeeping"""
+
+    dbname = None
+    last_used = 0
+    # names of the statements prepared on this connection.
+    prepared_statements = None
+
+
 class ConnectionsContextManager(object):
 
-    """Handle automatically closing connections via with statement"""
+    """Handle automatically returning connections via with statement"""
 
-    def __init__(self, conns):
+    def __init__(self, conns, pool=None):
         self.conns = conns
+        self.pool = pool
 
     def __enter__(self):
         return self.conns
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for conn in self.conns:
-            try:
-                conn.close()
-            except Exception:
-                pass
+        if self.pool is not None:
+            self.pool.put_conns(self.conns)
+        else:
+            for conn in self.conns:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
         suppress_exception = False
         return suppress_exception
 
 
 class DBConnectionPool(object):
 
-    """Manage database connections with varying database names"""
+    """Manage persistent database connections with varying database names
+
+    Connections are kept open between uses, in a pool of idle connections
+    for each database name. A connection which has been closed, for example
+    by execute_query after an error, or which was left in a transaction,
+    is discarded when it is returned and replaced on demand. Connections
+    which have been idle for longer than health_check_interval seconds are
+    checked with a trivial query before they are handed out.
+
+    If max_conns_per_db is set, get_conns blocks until enough connections
+    are available. All the connections for a call are reserved at once, so
+    that concurrent callers can't deadlock each holding part of a set.
+
+    Each connection goes to the better of two randomly chosen databases,
+    scored by an exponentially weighted moving average of the latency and
+    error rate of their recent queries, reported with observe(), and by how
+    many of their connections are already in use. This steers queries away
+    from a replica which is slow, for example while it's being vacuumed,
+    without sending everything to whichever one was fastest last.
+
+    If statement_timeout is set, in milliseconds, it's applied to each new
+    connection so that a stalled query fails rather than holding up the
+    tile indefinitely.
+    """
+
+    # weight of each new observation in the moving averages.
+    ewma_alpha = 0.1
 
-    def __init__(self, dbnames, conn_info, readonly=True):
-        self.dbnames = cycle(dbnames)
+    def __init__(self, dbnames, conn_info, readonly=True,
+                 max_conns_per_db=None, health_check_interval=30,
+                 statement_timeout=None):
+        self.dbnames = list(dbnames)
+        assert self.dbnames, 'No dbnames configured'
         self.conn_info = conn_info
-        self.conn_mapping = {}
         self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
         self.readonly = readonly
+        self.max_conns_per_db = max_conns_per_db
+        self.health_check_interval = health_check_interval
+        self.statement_timeout = statement_timeout
+        # moving averages of query latency, in seconds, and error rate by
+        # database name.
+        self.latency = {}
+        self.error_rate = defaultdict(float)
 
-    def _make_conn(self, conn_info):
-        conn = psycopg2.connect(**conn_info)
+        # idle connections, and the number of open connections, whether
+        # idle or in use, by database name.
+        self.idle_conns = defaultdict(list)
+        self.n_conns = defaultdict(int)
+        # the hstore OIDs differ between databases, but not between
+        # connections to the same database, so they only need looking up
+        # once.
+        self.hstore_oids = {}
+        self._stats = dict(
+            created=0, reused=0, discarded=0, health_check_failures=0,
+            waits=0, wait_time=0.0, connect_time=0.0)
+
+    def _make_conn(self, dbname):
+        conn_info_with_db = dict(self.conn_info, dbname=dbname)
+        conn = psycopg2.connect(
+            connection_factory=PooledConnection, **conn_info_with_db)
+        conn.dbname = dbname
         conn.set_session(readonly=self.readonly, autocommit=True)
-        register_hstore(conn)
+        oids = self.hstore_oids.get(dbname)
+        if oids is None:
+            oids = HstoreAdapter.get_oids(conn)
+            self.hstore_oids[dbname] = oids
+        register_hstore(conn, oid=oids[0], array_oid=oids[1])
         register_json(conn, loads=ujson.loads)
+        if self.statement_timeout:
+            with conn.cursor() as cursor:
+                cursor.execute('SET statement_timeout = %d' %
+                               int(self.statement_timeout))
         return conn
 
-    def get_conns(self, n_conn):
+    def observe(self, dbname, latency, error=False):
+        """
+        Record the latency, in seconds, of a query on the database, and
+        whether it failed.
+        """
+
+        alpha = self.ewma_alpha
         with self.lock:
-            dbnames = list(islice(self.dbnames, n_conn))
+            old_latency = self.latency.get(dbname)
+            if old_latency is None:
+                self.latency[dbname] = latency
+            else:
+                self.latency[dbname] = (
+                    alpha * latency + (1 - alpha) * old_latency)
+            self.error_rate[dbname] = (
+                alpha * (1.0 if error else 0.0) +
+                (1 - alpha) * self.error_rate[dbname])
+
+    def _n_in_use(self, dbname):
+        return self.n_conns[dbname] - len(self.idle_conns[dbname])
+
+    def _score(self, dbname, n_extra):
+        # expected cost of another query on the database: lower is better.
+        # databases without any observations yet are assumed to be as fast
+        # as the average, so that they get tried.
+        latency = self.latency.get(dbname)
+        if latency is None:
+            if self.latency:
+                latency = sum(self.latency.values()) / len(self.latency)
+            else:
+                latency = 0.0
+        n_in_use = self._n_in_use(dbname) + n_extra
+        success_rate = max(1.0 - self.error_rate[dbname], 0.01)
+        return (latency + 0.001) * (1 + n_in_use) / success_rate
+
+    def _has_room(self, dbname, n_chosen, now):
+        # whether the database has a slot for another connection, either
+        # now, or once all of its connections have been returned.
+        if self.max_conns_per_db is None:
+            return True
+        n_in_use = self._n_in_use(dbname) if now else 0
+        return n_in_use + n_chosen < self.max_conns_per_db
+
+    def _candidates(self, preferred, allowed, chosen):
+        # databases with a free slot now, and then those which will have one
+        # once connections are returned, so that none is given more than
+        # max_conns_per_db. databases which aren't preferred are only used
+        # when none of the others will do.
+        for now in (True, False):
+            for dbnames in (preferred, allowed):
+                candidates = [x for x in dbnames
+                              if self._has_room(x, chosen[x], now)]
+                if candidates:
+                    return candidates
+        return []
+
+    def _choose_dbnames(self, n_conn, avoid, exclude=()):
+        # returns None if exclude rules out every database.
+        allowed = [x for x in self.dbnames if x not in exclude]
+        if not allowed:
+            return None
+        preferred = [x for x in allowed if x not in avoid]
+        chosen = Counter()
+        dbnames = []
+        for _ in xrange(n_conn):
+            candidates = self._candidates(preferred, allowed, chosen)
+            assert candidates, 'Need more connections than the pool allows'
+            if len(candidates) > 2:
+                choices = random.sample(candidates, 2)
+            else:
+                choices = candidates
+            dbname = min(choices, key=lambda x: self._score(x, chosen[x]))
+            chosen[dbname] += 1
+            dbnames.append(dbname)
+        return dbnames
+
+    def _is_healthy(self, conn, now):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if now - conn.last_used >= self.health_check_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _can_reserve(self, n_needed):
+        if self.max_conns_per_db is None:
+            return True
+        for dbname, n in n_needed.items():
+            n_free = (len(self.idle_conns[dbname]) +
+                      self.max_conns_per_db - self.n_conns[dbname])
+            if n_free < n:
+                return False
+        return True
+
+    def _reserve(self, n_conn, avoid=(), block=True, exclude=()):
+        # returns a list of (dbname, conn) pairs, where conn is an idle
+        # connection to reuse, or None where a slot has been reserved for a
+        # new connection. returns None if block is false and the
+        # connections aren't available, or if exclude leaves no databases.
+        start = time.time()
+        waited = False
+        with self.cond:
+            while True:
+                dbnames = self._choose_dbnames(n_conn, avoid, exclude)
+                if dbnames is None:
+                    return None
+                n_needed = Counter(dbnames)
+                if self._can_reserve(n_needed):
+                    break
+                if not block:
+                    return None
+                waited = True
+                self.cond.wait()
+
+            reserved = []
+            for dbname in dbnames:
+                idle = self.idle_conns[dbname]
+                if idle:
+                    conn = idle.pop()
+                else:
+                    conn = None
+                    self.n_conns[dbname] += 1
+                reserved.append((dbname, conn))
+
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += time.time() - start
+        return reserved
+
+    def _unreserve(self, dbnames):
+        with self.cond:
+            for dbname in dbnames:
+                self.n_conns[dbname] -= 1
+            self.cond.notify_all()
+
+    def get_conns(self, n_conn, avoid=(), block=True, exclude=()):
+        """
+        Returns a context manager for a list of n_conn connections,
+        preferring databases which aren't in avoid, and never using those
+        in exclude. If block is false, returns None rather than waiting for
+        connections to be returned. Returns None if exclude leaves no
+        databases to use.
+        """
+
+        reserved = self._reserve(n_conn, avoid, block, exclude)
+        if reserved is None:
+            return None
+
         conns = []
-        for dbname in dbnames:
-            conn_info_with_db = dict(self.conn_info, dbname=dbname)
-            conn = self._make_conn(conn_info_with_db)
-            conns.append(conn)
-        conns_ctx_mgr = ConnectionsContextManager(conns)
+        try:
+            while reserved:
+                dbname, conn = reserved[0]
+                now = time.time()
+                if conn is not None and not self._is_healthy(conn, now):
+                    self._close(conn)
+                    with self.lock:
+                        self._stats['health_check_failures'] += 1
+                    conn = None
+                if conn is None:
+                    conn = self._make_conn(dbname)
+                    with self.lock:
+                        self._stats['created'] += 1
+                        self._stats['connect_time'] += time.time() - now
+                else:
+                    with self.lock:
+                        self._stats['reused'] += 1
+                reserved.pop(0)
+                conns.append(conn)
+        except Exception:
+            # give back everything reserved so far, so that a failure to
+            # connect doesn't leak slots in the pool.
+            self.put_conns(conns)
+            for _, conn in reserved:
+                if conn is not None:
+                    self._close(conn)
+            self._unreserve([dbname for dbname, _ in reserved])
+            raise
+
+        conns_ctx_mgr = ConnectionsContextManager(conns, self)
         return conns_ctx_mgr
+
+    def put_conns(self, conns):
+        now = time.time()
+        with self.cond:
+            for conn in conns:
+                if conn.closed or \
+                   conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    self._close(conn)
+                    self.n_conns[conn.dbname] -= 1
+                    self._stats['discarded'] += 1
+                else:
+                    conn.last_used = now
+                    self.idle_conns[conn.dbname].append(conn)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            for dbname, idle in self.idle_conns.items():
+                for conn in idle:
+                    self._close(conn)
+                self.n_conns[dbname] -= len(idle)
+                del idle[:]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self._stats)
+            stats['open'] = sum(self.n_conns.values())
+            stats['idle'] = sum(len(x) for x in self.idle_conns.values())
+            stats['databases'] = dict(
+                (dbname, dict(latency=self.latency.get(dbname),
+                              error_rate=self.error_rate[dbname]))
+                for dbname in self.dbnames)
+        return stats
+
+
+def make_db_conn_pool(postgresql_conn_info, readonly=True):
+    """
+    Make a connection pool from the postgresql config, which holds both the
+    psycopg2 connection arguments and the pool's own options.
+    """
+
+    conn_info = dict(postgresql_conn_info)
+    dbnames = conn_info.pop('dbnames')
+    max_conns_per_db = conn_info.pop('max-conns-per-db', None)
+    health_check_interval = conn_info.pop('health-check-interval', None)
+    statement_timeout = conn_info.pop('statement-timeout', None)
+
+    pool = DBConnectionPool(
+        dbnames, conn_info, readonly, max_conns_per_db=max_conns_per_db,
+        statement_timeout=statement_timeout)
+    if health_check_interval is not None:
+        pool.health_check_interval = health_check_interval
+    return pool
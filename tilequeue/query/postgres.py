@@ -1,15 +1,34 @@
+from collections import deque
 from collections import namedtuple
+from collections import OrderedDict
+from itertools import izip
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
-from psycopg2.extras import RealDictCursor
-from tilequeue.query import DBConnectionPool
+from multiprocessing.pool import ThreadPool
+from tilequeue.query.common import wkb_envelope
+from tilequeue.query.pool import make_db_conn_pool
+from tilequeue.tile import coord_to_mercator_bounds
+from tilequeue.tile import earth_circum
+from tilequeue.tile import mercator_point_to_coord_fractional
 from tilequeue.transform import calculate_padded_bounds
+from tilequeue.utils import convert_seconds_to_millis
+import json
+import logging
+import math
+import md5
+import re
 import sys
+import threading
+import time
 
 
 TemplateSpec = namedtuple('TemplateSpec', 'template start_zoom end_zoom')
 DataSource = namedtuple('DataSource', 'name template_specs')
 
+# sentinel for a template which hasn't been compiled yet, as opposed to one
+# which couldn't be compiled.
+_not_compiled = object()
+
 
 class TemplateFinder(object):
 
@@ -36,12 +55,194 @@ class TemplateFinder(object):
         return template
 
 
+class _NotParameterizable(Exception):
+
+    """Raised when a template uses the bounds in a way which can't be
+    turned into query parameters"""
+
+
+# stands in for a bounds parameter in the rendered template text.
+_PARAM_TOKEN = '__tq_param_%d__'
+_PARAM_TOKEN_PATTERN = re.compile('__tq_param_([0-9]+)__')
+
+
+class BoundsParameter(object):
+
+    """Stands in for the bounds when rendering a template into SQL with
+    the bounds as parameters
+
+    The bbox filters write a token for each coordinate instead of its value,
+    and record which coordinate, and of which padding of the bounds, that
+    token stands for in the shared slots list.
+    """
+
+    def __init__(self, slots, pad_factor=None):
+        self.slots = slots
+        self.pad_factor = pad_factor
+
+    def tokens(self):
+        tokens = []
+        for i in xrange(4):
+            tokens.append(_PARAM_TOKEN % len(self.slots))
+            self.slots.append((self.pad_factor, i))
+        return tokens
+
+    def padded(self, pad_factor):
+        if self.pad_factor is not None:
+            raise _NotParameterizable('Bounds padded more than once')
+        return BoundsParameter(self.slots, pad_factor)
+
+    # any other use of the bounds, such as indexing them, can't be turned
+    # into parameters. these raise an exception which jinja won't turn into
+    # an undefined value, so that rendering stops.
+    def __getitem__(self, key):
+        raise _NotParameterizable('Bounds used as %r' % (key,))
+
+    def __iter__(self):
+        raise _NotParameterizable('Bounds iterated')
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        raise _NotParameterizable('Bounds used as %r' % name)
+
+
+def _slot_values(slots, bounds):
+    padded = {None: bounds}
+    values = []
+    for pad_factor, i in slots:
+        slot_bounds = padded.get(pad_factor)
+        if slot_bounds is None:
+            slot_bounds = calculate_padded_bounds(pad_factor, bounds).bounds
+            padded[pad_factor] = slot_bounds
+        values.append(slot_bounds[i])
+    return values
+
+
+class BoundQuery(object):
+
+    """A query with the bounds passed as parameters, rather than inlined as
+    literals in the text
+
+    The parts are literal SQL strings, with None in the place of each
+    parameter. padded is set if any of the parameters are from padded
+    bounds, e.g: in bbox_padded_intersection.
+    """
+
+    def __init__(self, parts, params, padded=False):
+        self.parts = parts
+        self.params = params
+        self.padded = padded
+
+    def sql(self):
+        # in psycopg2's paramstyle, which needs any literal % escaping.
+        return ''.join('%s' if part is None else part.replace('%', '%%')
+                       for part in self.parts)
+
+    def prepared_sql(self):
+        # in the style of a PREPARE statement, with numbered parameters.
+        sql_parts = []
+        n = 0
+        for part in self.parts:
+            if part is None:
+                n += 1
+                sql_parts.append('$%d' % n)
+            else:
+                sql_parts.append(part)
+        return ''.join(sql_parts)
+
+    def statement_name(self):
+        return 'tq_%s' % md5.new(self.prepared_sql()).hexdigest()[:16]
+
+    @staticmethod
+    def join(queries, separator):
+        parts = []
+        params = []
+        padded = False
+        for query in queries:
+            if not isinstance(query, BoundQuery):
+                query = BoundQuery([query], [])
+            if parts:
+                parts.append(separator)
+            parts.extend(query.parts)
+            params.extend(query.params)
+            padded = padded or query.padded
+        return BoundQuery(parts, params, padded)
+
+
+class CompiledQuery(object):
+
+    """A template rendered for a zoom, waiting for the bounds"""
+
+    def __init__(self, parts, slots):
+        self.parts = parts
+        self.slots = slots
+
+    def bind(self, bounds):
+        padded = any(pad_factor is not None for pad_factor, _ in self.slots)
+        return BoundQuery(
+            self.parts, _slot_values(self.slots, bounds), padded)
+
+
+def compile_template(template, bounds, zoom):
+    """
+    Render the template into a CompiledQuery with the bounds as parameters.
+
+    The bounds given are only used to check the result: the template is also
+    rendered with them inlined, and unless that matches the compiled query
+    with the same bounds, None is returned. This catches templates which use
+    the bounds in ways other than through the bbox filters.
+    """
+
+    slots = []
+    bounds_param = BoundsParameter(slots)
+    try:
+        text = template.render(
+            bounds=dict(polygon=bounds_param, line=bounds_param,
+                        point=bounds_param),
+            zoom=zoom)
+    except _NotParameterizable:
+        return None
+
+    parts = []
+    part_slots = []
+    fields = _PARAM_TOKEN_PATTERN.split(text)
+    for i, field in enumerate(fields):
+        if i % 2 == 0:
+            if field:
+                parts.append(field)
+        else:
+            parts.append(None)
+            part_slots.append(slots[int(field)])
+    compiled = CompiledQuery(parts, part_slots)
+
+    literal = template.render(
+        bounds=dict(polygon=bounds, line=bounds, point=bounds), zoom=zoom)
+    values = iter(_slot_values(part_slots, bounds))
+    check = ''.join('%.12f' % next(values) if part is None else part
+                    for part in parts)
+    if check != literal:
+        return None
+
+    return compiled
+
+
 class TemplateQueryGenerator(object):
 
-    def __init__(self, template_finder):
+    """Renders a template into a query for some bounds and zoom
+
+    If parameterize is set, each template is compiled once per zoom into a
+    query with the bounds as parameters, and calls return BoundQuery
+    objects. Templates which can't be compiled are rendered for each call,
+    as they are without parameterize.
+    """
+
+    def __init__(self, template_finder, parameterize=False):
         self.template_finder = template_finder
+        self.parameterize = parameterize
+        self.compiled = {}
 
-    def __call__(self, source, bounds, zoom):
+    def render(self, source, bounds, zoom):
         template = self.template_finder(source)
 
         # TODO bounds padding
@@ -54,6 +255,21 @@ class TemplateQueryGenerator(object):
         query = template.render(bounds=padded_bounds, zoom=zoom)
         return query
 
+    def __call__(self, source, bounds, zoom):
+        if not self.parameterize:
+            return self.render(source, bounds, zoom)
+
+        key = (source, zoom)
+        compiled = self.compiled.get(key, _not_compiled)
+        if compiled is _not_compiled:
+            template = self.template_finder(source)
+            compiled = compile_template(template, bounds, zoom)
+            self.compiled[key] = compiled
+
+        if compiled is None:
+            return self.render(source, bounds, zoom)
+        return compiled.bind(bounds)
+
 
 class SourcesQueriesGenerator(object):
 
@@ -62,6 +278,14 @@ class SourcesQueriesGenerator(object):
         self.query_generator = query_generator
 
     def __call__(self, zoom, bounds):
+        return [query for _, query in self.source_queries(zoom, bounds)]
+
+    def source_queries(self, zoom, bounds):
+        """
+        Returns a list of (source name, query) pairs, with one query for
+        each source which has templates for the zoom.
+        """
+
         queries = []
         for source in self.sources:
             template_queries = []
@@ -72,8 +296,13 @@ class SourcesQueriesGenerator(object):
                         template_spec.template, bounds, zoom)
                     template_queries.append(template_query)
             if template_queries:
-                source_query = '\nUNION ALL\n'.join(template_queries)
-                queries.append(source_query)
+                separator = '\nUNION ALL\n'
+                if any(isinstance(x, BoundQuery) for x in template_queries):
+                    source_query = BoundQuery.join(
+                        template_queries, separator)
+                else:
+                    source_query = separator.join(template_queries)
+                queries.append((source.name, source_query))
         return queries
 
 
@@ -81,9 +310,16 @@ def jinja_filter_geometry(value):
     return 'ST_AsBinary(%s)' % value
 
 
+def _bbox_coords(bounds):
+    if isinstance(bounds, BoundsParameter):
+        return bounds.tokens()
+    return ['%.12f' % x for x in bounds[:4]]
+
+
 def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    coords = _bbox_coords(bounds)
+    min_point = 'ST_MakePoint(%s, %s)' % (coords[0], coords[1])
+    max_point = 'ST_MakePoint(%s, %s)' % (coords[2], coords[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_filter = '%s && %s' % (geometry_col_name, bbox)
@@ -91,8 +327,9 @@ def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
 
 
 def jinja_filter_bbox_intersection(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    coords = _bbox_coords(bounds)
+    min_point = 'ST_MakePoint(%s, %s)' % (coords[0], coords[1])
+    max_point = 'ST_MakePoint(%s, %s)' % (coords[2], coords[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_intersection = 'st_intersection(%s, %s)' % (geometry_col_name, bbox)
@@ -101,22 +338,27 @@ def jinja_filter_bbox_intersection(bounds, geometry_col_name, srid=3857):
 
 def jinja_filter_bbox_padded_intersection(
         bounds, geometry_col_name, pad_factor=1.1, srid=3857):
-    padded_bounds = calculate_padded_bounds(pad_factor, bounds)
+    if isinstance(bounds, BoundsParameter):
+        padded_bounds = bounds.padded(pad_factor)
+    else:
+        padded_bounds = calculate_padded_bounds(pad_factor, bounds).bounds
     return jinja_filter_bbox_intersection(
-        padded_bounds.bounds, geometry_col_name, srid)
+        padded_bounds, geometry_col_name, srid)
 
 
 def jinja_filter_bbox(bounds, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    coords = _bbox_coords(bounds)
+    min_point = 'ST_MakePoint(%s, %s)' % (coords[0], coords[1])
+    max_point = 'ST_MakePoint(%s, %s)' % (coords[2], coords[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     return bbox
 
 
 def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
+    coords = _bbox_coords(bounds)
+    min_point = 'ST_MakePoint(%s, %s)' % (coords[0], coords[1])
+    max_point = 'ST_MakePoint(%s, %s)' % (coords[2], coords[3])
     bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
     bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
     bbox_filter = \
@@ -125,16 +367,116 @@ def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
     return bbox_filter
 
 
-def execute_query(conn, query):
+def _execute_prepared(cursor, conn, query):
+    name = query.statement_name()
+    prepared = conn.prepared_statements
+    if prepared is None:
+        prepared = conn.prepared_statements = set()
+    n_params = len(query.params)
+    if name not in prepared:
+        param_types = ''
+        if n_params:
+            param_types = ' (%s)' % ', '.join(['float8'] * n_params)
+        cursor.execute('PREPARE %s%s AS %s' % (
+            name, param_types, query.prepared_sql()))
+        prepared.add(name)
+    param_values = ''
+    if n_params:
+        param_values = ' (%s)' % ', '.join(['%s'] * n_params)
+    cursor.execute('EXECUTE %s%s' % (name, param_values), query.params)
+
+
+class QueryRows(list):
+
+    """The rows read from a cursor, as tuples
+
+    index maps each column's name to its position in the rows, so columns
+    can be read without a dict for each row. dicts() builds those, leaving
+    out None values, for the consumers which need them.
+    """
+
+    def __init__(self, columns, rows=()):
+        super(QueryRows, self).__init__(rows)
+        self.columns = columns
+        self.index = dict((name, i) for i, name in enumerate(columns))
+
+    def column(self, name):
+        """
+        Returns the values of the named column in each row, or None if
+        there's no such column.
+        """
+
+        i = self.index.get(name)
+        if i is None:
+            return None
+        return [row[i] for row in self]
+
+    def dicts(self):
+        names = self.columns
+        dict_rows = []
+        for row in self:
+            read_row = {}
+            for name, value in izip(names, row):
+                if value is not None:
+                    read_row[name] = value
+            dict_rows.append(read_row)
+        return dict_rows
+
+
+def read_rows(cursor):
+    """
+    Read the rows from the cursor into a QueryRows of tuples, converting
+    buffers to bytes.
+
+    The rows are pickled on the way to the processing stage, so buffers have
+    to be converted here, even though they'd only be parsed later. Building
+    dicts is left until the connection has been given back.
+    """
+
+    names = tuple(column[0] for column in cursor.description)
+    rows = QueryRows(names)
+    append = rows.append
+    for row in cursor:
+        append(tuple(
+            bytes(value) if type(value) is buffer else value
+            for value in row))
+    return rows
+
+
+def execute_query(conn, query, prepare=False, server_side_cursor=False,
+                  itersize=2000):
+    """
+    Execute the query on the connection and return the rows as a QueryRows.
+
+    With server_side_cursor, rows are fetched from a named cursor itersize
+    at a time, which keeps down the memory used for very large results.
+    Named cursors need a transaction and can't run prepared statements, so
+    prepare is ignored for them.
+    """
+
     try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query)
-        rows = list(cursor.fetchall())
+        if server_side_cursor:
+            conn.autocommit = False
+            cursor = conn.cursor('tq_fetch')
+            cursor.itersize = itersize
+        else:
+            cursor = conn.cursor()
+
+        if not isinstance(query, BoundQuery):
+            cursor.execute(query)
+        elif prepare and not server_side_cursor:
+            _execute_prepared(cursor, conn, query)
+        else:
+            cursor.execute(query.sql(), query.params)
+        rows = read_rows(cursor)
+
+        if server_side_cursor:
+            cursor.close()
+            conn.commit()
+            conn.autocommit = True
 
         return rows
     except Exception:
-        # TODO this kind of thing is only necessary if we re-use connections
-
         # If any exception occurs during query execution, close the
         # connection to ensure it is not in an invalid state. The
         # connection pool knows to create new connections to replace
@@ -156,65 +498,555 @@ class DataFetchException(Exception):
         super(DataFetchException, self).__init__(msgs)
 
 
+class SourceRows(list):
+
+    """The rows fetched for a tile
+
+    Along with the rows, this carries query_stats, a dict of the time in
+    milliseconds, number of rows and bytes of WKB returned by each source's
+    query, for the tile which ran the queries.
+    """
+
+    query_stats = None
+
+
+def _query_stats(rows, seconds, **extra):
+    # rows are either a QueryRows or, from the query cache, dicts.
+    if isinstance(rows, QueryRows):
+        shapes_wkb = rows.column('__geometry__') or ()
+    else:
+        shapes_wkb = [row.get('__geometry__') for row in rows]
+    n_bytes = 0
+    for shape_wkb in shapes_wkb:
+        if shape_wkb is not None:
+            n_bytes += len(shape_wkb)
+    stats = dict(time=convert_seconds_to_millis(seconds), rows=len(rows),
+                 bytes=n_bytes)
+    stats.update(extra)
+    return stats
+
+
+# returned by _row_bounds for a row without a geometry.
+_no_geometry = object()
+
+
+def _row_bounds(row):
+    # returns None if the geometry is empty.
+    shape_wkb = row.get('__geometry__')
+    if shape_wkb is None:
+        return _no_geometry
+    return wkb_envelope(shape_wkb)
+
+
+class BatchFetch(object):
+
+    """Fetches the rows for several coordinates at the same zoom at once
+
+    The first call runs one set of queries for the bounds of all the
+    coordinates, and splits the rows between them by their geometry's
+    bounding box, the same test as the bbox filter in the queries, so each
+    tile gets the rows its own queries would return. If pad_factor is more
+    than 1, each tile also gets the rows within that padding of it. Each
+    coordinate's rows are handed over, and forgotten, when it is fetched.
+
+    The rows' columns are as the batch's queries returned them, so queries
+    which clip to padded bounds, which would be those of the whole batch,
+    can't be batched. If can_batch is given, it's called with the zoom and
+    bounds of the first fetch, and if it returns False, each coordinate is
+    fetched alone.
+    """
+
+    def __init__(self, fetch, coords, pad_factor=1.0, can_batch=None):
+        self.fetch = fetch
+        self.coords = coords
+        self.pad_factor = pad_factor
+        self.can_batch = can_batch
+        self.batched = None
+        self.zoom = None
+        self.rows_by_tile = None
+        self.query_stats = None
+
+    def _fetch_all(self, zoom):
+        minx, miny, maxx, maxy = coord_to_mercator_bounds(self.coords[0])
+        for coord in self.coords[1:]:
+            bounds = coord_to_mercator_bounds(coord)
+            minx = min(minx, bounds[0])
+            miny = min(miny, bounds[1])
+            maxx = max(maxx, bounds[2])
+            maxy = max(maxy, bounds[3])
+        rows = self.fetch(zoom, (minx, miny, maxx, maxy))
+
+        coord_zoom = self.coords[0].zoom
+        rows_by_tile = {}
+        for coord in self.coords:
+            rows_by_tile[(int(coord.column), int(coord.row))] = SourceRows()
+
+        # growing each row's bounds by any padding is the same as testing
+        # them against each padded tile.
+        pad = 0.5 * (earth_circum / (1 << int(coord_zoom))) * \
+            (self.pad_factor - 1.0)
+
+        for row in rows:
+            row_bounds = _row_bounds(row)
+            if row_bounds is _no_geometry:
+                # can't tell where it is, so it has to go everywhere.
+                for tile_rows in rows_by_tile.itervalues():
+                    tile_rows.append(row)
+                continue
+            if row_bounds is None:
+                # an empty geometry doesn't match any bbox filter.
+                continue
+
+            minx, miny, maxx, maxy = row_bounds
+            x0, y0, x1, y1 = _tile_range(
+                coord_zoom, (minx - pad, miny - pad, maxx + pad, maxy + pad))
+            if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(rows_by_tile):
+                for x in xrange(x0, x1 + 1):
+                    for y in xrange(y0, y1 + 1):
+                        tile_rows = rows_by_tile.get((x, y))
+                        if tile_rows is not None:
+                            tile_rows.append(row)
+            else:
+                for (x, y), tile_rows in rows_by_tile.iteritems():
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        tile_rows.append(row)
+
+        self.zoom = zoom
+        self.rows_by_tile = rows_by_tile
+        self.query_stats = getattr(rows, 'query_stats', None)
+
+    def fetcher_for(self, coord):
+        key = (int(coord.column), int(coord.row))
+
+        def fetch(zoom, unpadded_bounds):
+            if self.batched is None:
+                self.batched = self.can_batch is None or \
+                    self.can_batch(zoom, unpadded_bounds)
+            if not self.batched:
+                return self.fetch(zoom, unpadded_bounds)
+            if self.rows_by_tile is None:
+                self._fetch_all(zoom)
+            if zoom != self.zoom or key not in self.rows_by_tile:
+                # not what the batch was planned for, so fetch it alone.
+                return self.fetch(zoom, unpadded_bounds)
+            rows = self.rows_by_tile.pop(key)
+            # the stats for the batch's queries go with the first tile
+            # fetched, so that they're only counted once.
+            if self.query_stats is not None:
+                rows.query_stats = self.query_stats
+                for source_stats in rows.query_stats.itervalues():
+                    source_stats['batched'] = len(self.coords)
+                self.query_stats = None
+            return rows
+
+        return fetch
+
+
+def _tile_range(zoom, bounds):
+    # the range of tiles, inclusive, at the zoom which the bounds touch. the
+    # tolerance stops bounds which fall on a tile edge from missing one of
+    # the tiles either side due to rounding in the projection.
+    eps = 1.0e-9
+    minx, miny, maxx, maxy = bounds
+    top_left = mercator_point_to_coord_fractional(zoom, minx, maxy)
+    bottom_right = mercator_point_to_coord_fractional(zoom, maxx, miny)
+    x0 = int(math.ceil(top_left.column - eps)) - 1
+    y0 = int(math.ceil(top_left.row - eps)) - 1
+    x1 = int(math.floor(bottom_right.column + eps))
+    y1 = int(math.floor(bottom_right.row + eps))
+    return x0, y0, x1, y1
+
+
+def batch_coords(all_data, max_tiles):
+    """
+    Group the data by the zoom of its coordinate, and then into square
+    blocks of at most max_tiles coordinates. Returns a list of lists of
+    data.
+    """
+
+    block_dz = 0
+    while 4 ** (block_dz + 1) <= max_tiles:
+        block_dz += 1
+
+    batches = OrderedDict()
+    for data in all_data:
+        coord = data['coord']
+        block = coord.zoomTo(max(0, coord.zoom - block_dz)).container()
+        key = (coord.zoom, block.column, block.row)
+        batches.setdefault(key, []).append(data)
+    return batches.values()
+
+
+class _QueryAttempt(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.done = False
+        self.cancelled = False
+        self.rows = None
+        self.exc_info = None
+        self.latency = None
+
+
+class HedgedQuery(object):
+
+    """Runs a query on one or more connections and keeps the first result
+
+    Each attempt runs in the io pool and reports its latency and whether it
+    failed to the connection pool, which uses them to choose databases.
+    Attempts which lose the race are cancelled on the server. Their latency
+    is only a lower bound, as they didn't finish, so it's reported scaled
+    up by cancelled_penalty, which stops a slow database which always
+    loses the race from looking fast.
+    """
+
+    cancelled_penalty = 2.0
+
+    def __init__(self, query, execute_args, io_pool, conn_pool):
+        self.query = query
+        self.execute_args = execute_args
+        self.io_pool = io_pool
+        self.conn_pool = conn_pool
+        self.cond = threading.Condition()
+        self.attempts = []
+        self.start_time = time.time()
+
+    def start(self, conn):
+        attempt = _QueryAttempt(conn)
+        with self.cond:
+            self.attempts.append(attempt)
+        self.io_pool.apply_async(self._run, (attempt,))
+
+    def _run(self, attempt):
+        start = time.time()
+        try:
+            attempt.rows = execute_query(
+                attempt.conn, self.query, *self.execute_args)
+        except Exception:
+            attempt.exc_info = sys.exc_info()
+        attempt.latency = time.time() - start
+        if attempt.cancelled:
+            # the error, if any, is from being cancelled.
+            self.conn_pool.observe(
+                attempt.conn.dbname,
+                attempt.latency * self.cancelled_penalty)
+        else:
+            self.conn_pool.observe(
+                attempt.conn.dbname, attempt.latency,
+                error=attempt.exc_info is not None)
+        with self.cond:
+            attempt.done = True
+            self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Wait for an attempt to succeed, or for all of them to fail, and
+        return it. Returns None if that doesn't happen within timeout
+        seconds.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                for attempt in self.attempts:
+                    if attempt.done and attempt.exc_info is None:
+                        return attempt
+                if all(attempt.done for attempt in self.attempts):
+                    return self.attempts[0]
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.cond.wait(remaining)
+
+    def finish(self, winner):
+        """
+        Cancel the other attempts still running, and wait for them to stop
+        so that their connections can be returned to the pool.
+        """
+
+        for attempt in self.attempts:
+            if attempt is not winner and not attempt.done:
+                attempt.cancelled = True
+                try:
+                    attempt.conn.cancel()
+                except Exception:
+                    pass
+        with self.cond:
+            while not all(attempt.done for attempt in self.attempts):
+                self.cond.wait()
+
+
+def _explain_slow_query(conns_ctx, sql, params, slow_query, logger):
+    try:
+        with conns_ctx as conns:
+            with conns[0].cursor() as cursor:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+                plan = [row[0] for row in cursor]
+        slow_query['explain'] = '\n'.join(plan)
+    except Exception as e:
+        slow_query['explain_error'] = str(e)
+    logger.warning(json.dumps(slow_query))
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    index = int(math.ceil(len(values) * pct / 100.0)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
 class DataFetcher(object):
 
-    def __init__(self, conn_info, queries_generator, io_pool):
+    # the number of recent latencies kept for each source and zoom, and the
+    # fewest needed before hedging queries.
+    hedge_window = 100
+    hedge_min_samples = 20
+
+    def __init__(self, conn_info, queries_generator, io_pool,
+                 query_cache=None):
         self.conn_info = dict(conn_info)
         self.queries_generator = queries_generator
         self.io_pool = io_pool
+        self.query_cache = query_cache
 
-        self.dbnames = self.conn_info.pop('dbnames')
-        self.dbnames_query_index = 0
-        self.sql_conn_pool = DBConnectionPool(
-            self.dbnames, self.conn_info)
+        # prepared statements only live as long as the server connection,
+        # so can't be used through pgbouncer in transaction pooling mode.
+        self.prepare_statements = self.conn_info.pop(
+            'prepare-statements', False)
+        # zooms at or below this use server-side cursors, which hold down the
+        # memory needed for the very large results at low zooms.
+        self.server_side_cursor_max_zoom = self.conn_info.pop(
+            'server-side-cursor-max-zoom', None)
+        self.cursor_itersize = self.conn_info.pop('cursor-itersize', 2000)
+        # the most coordinates at the same zoom fetched with one set of
+        # queries. this bounds the size of the batch's results, which are
+        # all held in memory until each coordinate is fetched.
+        self.batch_max_tiles = self.conn_info.pop('batch-max-tiles', None)
+        # optionally, give each tile in a batch the rows within this padding
+        # of it too. the default gives each tile the same rows as its own
+        # queries, whose bbox filters aren't padded.
+        self.batch_pad_factor = self.conn_info.pop('batch-pad-factor', 1.0)
+        # a query which is still running when this percentile of the recent
+        # latencies for its source and zoom has passed is re-issued on
+        # another database, and whichever finishes first is used.
+        self.hedge_percentile = self.conn_info.pop('hedge-percentile', None)
+        # don't hedge queries any sooner than this, in seconds, which stops
+        # fast queries being duplicated for little gain.
+        self.hedge_min_delay = self.conn_info.pop('hedge-min-delay', 0.05)
+        self.latencies = {}
+        self.latencies_lock = threading.Lock()
+        # source queries taking at least this many milliseconds are logged,
+        # with their sql and bounds, to the slow_query logger. optionally,
+        # the query plan is captured too, by running the query again.
+        self.slow_query_ms = self.conn_info.pop('slow-query-ms', None)
+        self.slow_query_explain = self.conn_info.pop(
+            'slow-query-explain', False)
+        self.slow_query_logger = logging.getLogger('slow_query')
+        # started when the first plan is captured.
+        self.explain_pool = None
+        self.explain_lock = threading.Lock()
+        self.explaining = False
+        self.dbnames = self.conn_info['dbnames']
+        self.sql_conn_pool = make_db_conn_pool(self.conn_info)
 
     def fetch_tiles(self, all_data):
         # postgres data fetcher doesn't need this kind of session management,
-        # so we can just return the same object for all uses.
-        for data in all_data:
-            yield self, data
+        # so we can just return the same object for all uses, unless the
+        # fetches for coordinates at the same zoom are batched together.
+        if not self.batch_max_tiles or self.batch_max_tiles < 4:
+            for data in all_data:
+                yield self, data
+            return
+
+        for batch in batch_coords(all_data, self.batch_max_tiles):
+            if len(batch) == 1:
+                yield self, batch[0]
+                continue
+            batch_fetch = BatchFetch(
+                self, [data['coord'] for data in batch],
+                self.batch_pad_factor, self._can_batch)
+            for data in batch:
+                yield batch_fetch.fetcher_for(data['coord']), data
+
+    def _can_batch(self, zoom, unpadded_bounds):
+        # the batch's rows are only the same as each tile's own if the
+        # queries are compiled, so the bounds are only used in the bbox
+        # filters, and none of their columns are clipped to padded bounds.
+        source_queries = self.queries_generator.source_queries(
+            zoom, unpadded_bounds)
+        for _, query in source_queries:
+            if not isinstance(query, BoundQuery) or query.padded:
+                return False
+        return True
 
     def __call__(self, zoom, unpadded_bounds):
-        queries = self.queries_generator(zoom, unpadded_bounds)
+        source_queries = self.queries_generator.source_queries(
+            zoom, unpadded_bounds)
+        assert source_queries, 'no queries'
+
+        all_source_rows = SourceRows()
+        all_source_rows.query_stats = query_stats = {}
+        queries = []
+        source_names = []
+        cache_keys = []
+        for source_name, query in source_queries:
+            cache_key = None
+            if self.query_cache is not None:
+                cache_key = self.query_cache.key(
+                    source_name, zoom, unpadded_bounds, query)
+                if cache_key is not None:
+                    start = time.time()
+                    source_rows = self.query_cache.get(source_name, cache_key)
+                    if source_rows is not None:
+                        all_source_rows.extend(source_rows)
+                        query_stats[source_name] = _query_stats(
+                            source_rows, time.time() - start, cached=True)
+                        continue
+            queries.append(query)
+            source_names.append(source_name)
+            cache_keys.append(cache_key)
+
+        if not queries:
+            return all_source_rows
 
         n_conns = len(queries)
-        assert n_conns, 'no queries'
 
+        server_side_cursor = (
+            self.server_side_cursor_max_zoom is not None and
+            zoom <= self.server_side_cursor_max_zoom)
+        execute_args = (self.prepare_statements, server_side_cursor,
+                        self.cursor_itersize)
+
+        hedge_conns = []
         with self.sql_conn_pool.get_conns(n_conns) as sql_conns:
-            async_results = []
-            for query, conn in zip(queries, sql_conns):
-                async_result = self.io_pool.apply_async(
-                    execute_query, (conn, query))
-                async_results.append(async_result)
-
-            all_source_rows = []
-            async_exceptions = []
-            for async_result in async_results:
-                try:
-                    source_rows = async_result.get()
-                    # TODO can all the source rows just be smashed together?
-                    # seems like it because the data allows discrimination
-                    all_source_rows.extend(source_rows)
-                except Exception:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    async_exception = exc_value
-                    async_exceptions.append(async_exception)
-                    continue
+            try:
+                hedged_queries = []
+                for query, conn in zip(queries, sql_conns):
+                    hedged_query = HedgedQuery(
+                        query, execute_args, self.io_pool, self.sql_conn_pool)
+                    hedged_query.start(conn)
+                    hedged_queries.append(hedged_query)
 
-            if async_exceptions:
-                raise DataFetchException(async_exceptions)
+                all_attempts = []
+                for hedged_query, source_name in zip(
+                        hedged_queries, source_names):
+                    attempt = self._wait(
+                        hedged_query, source_name, zoom, hedge_conns)
+                    all_attempts.append(attempt)
+            finally:
+                for conns_ctx in hedge_conns:
+                    self.sql_conn_pool.put_conns(conns_ctx.conns)
 
-        read_rows = []
-        for row in all_source_rows:
-            read_row = {}
-            for k, v in row.items():
-                if isinstance(v, buffer):
-                    v = bytes(v)
-                if v is not None:
-                    read_row[k] = v
-            read_rows.append(read_row)
+        async_exceptions = []
+        for attempt, hedged_query, source_name, cache_key in zip(
+                all_attempts, hedged_queries, source_names, cache_keys):
+            if attempt.exc_info is not None:
+                async_exceptions.append(attempt.exc_info[1])
+                continue
+            # processing reads the rows as dicts, so this is where they're
+            # built, after the connections have been given back.
+            source_rows = attempt.rows.dicts()
+            # TODO can all the source rows just be smashed together?
+            # seems like it because the data allows discrimination
+            all_source_rows.extend(source_rows)
+            if cache_key is not None:
+                self.query_cache.put(cache_key, source_rows)
+
+            source_stats = _query_stats(
+                attempt.rows, attempt.latency,
+                hedged=len(hedged_query.attempts) > 1)
+            query_stats[source_name] = source_stats
+            if self.slow_query_ms is not None and \
+               source_stats['time'] >= self.slow_query_ms:
+                self._log_slow_query(
+                    source_name, hedged_query.query, zoom, unpadded_bounds,
+                    source_stats)
+
+        if async_exceptions:
+            raise DataFetchException(async_exceptions)
+
+        return all_source_rows
+
+    def _log_slow_query(self, source_name, query, zoom, bounds, stats):
+        if isinstance(query, BoundQuery):
+            sql, params = query.sql(), query.params
+        else:
+            sql, params = query, None
+        slow_query = dict(source=source_name, zoom=zoom, bounds=bounds,
+                          sql=sql, params=params, stats=stats)
+        if not self.slow_query_explain:
+            self.slow_query_logger.warning(json.dumps(slow_query))
+            return
+
+        # the plan is captured by running the query again, in the
+        # background so that the tile isn't held up any longer. that's on
+        # its own thread rather than the io pool, which the tiles' queries
+        # need, and only one plan is captured at a time. slow queries
+        # while it runs are logged without one.
+        with self.explain_lock:
+            explaining = self.explaining
+            self.explaining = True
+        if explaining:
+            self.slow_query_logger.warning(json.dumps(slow_query))
+            return
+        if self.explain_pool is None:
+            self.explain_pool = ThreadPool(1)
+        self.explain_pool.apply_async(
+            self._explain, (sql, params, slow_query))
+
+    def _explain(self, sql, params, slow_query):
+        try:
+            conns_ctx = self.sql_conn_pool.get_conns(1, block=False)
+            if conns_ctx is None:
+                self.slow_query_logger.warning(json.dumps(slow_query))
+            else:
+                _explain_slow_query(conns_ctx, sql, params, slow_query,
+                                    self.slow_query_logger)
+        finally:
+            with self.explain_lock:
+                self.explaining = False
+
+    def _hedge_delay(self, latency_key):
+        if self.hedge_percentile is None:
+            return None
+        with self.latencies_lock:
+            latencies = self.latencies.get(latency_key)
+            if not latencies or len(latencies) < self.hedge_min_samples:
+                return None
+            delay = _percentile(latencies, self.hedge_percentile)
+        return max(delay, self.hedge_min_delay)
+
+    def _wait(self, hedged_query, source_name, zoom, hedge_conns):
+        latency_key = (source_name, zoom)
+        delay = self._hedge_delay(latency_key)
+        attempt = None
+        if delay is not None:
+            elapsed = time.time() - hedged_query.start_time
+            attempt = hedged_query.wait(max(0, delay - elapsed))
+            if attempt is None:
+                # don't wait for connections to become free to hedge; that
+                # would defeat the point. nor is there any point in running
+                # it on the same database as the query it's hedging.
+                dbname = hedged_query.attempts[0].conn.dbname
+                conns_ctx = self.sql_conn_pool.get_conns(
+                    1, block=False, exclude=(dbname,))
+                if conns_ctx is not None:
+                    hedge_conns.append(conns_ctx)
+                    hedged_query.start(conns_ctx.conns[0])
+        if attempt is None:
+            attempt = hedged_query.wait()
+        hedged_query.finish(attempt)
 
-        return read_rows
+        if attempt.exc_info is None:
+            with self.latencies_lock:
+                latencies = self.latencies.get(latency_key)
+                if latencies is None:
+                    latencies = self.latencies[latency_key] = deque(
+                        maxlen=self.hedge_window)
+                latencies.append(time.time() - hedged_query.start_time)
+        return attempt
 
 
 def make_jinja_environment(template_path):
@@ -233,7 +1065,9 @@ def make_queries_generator(sources, template_path, reload_templates):
     jinja_environment = make_jinja_environment(template_path)
     cache_templates = not reload_templates
     template_finder = TemplateFinder(jinja_environment, cache_templates)
-    query_generator = TemplateQueryGenerator(template_finder)
+    # compiled queries would go stale when reloading templates.
+    query_generator = TemplateQueryGenerator(
+        template_finder, parameterize=cache_templates)
     queries_generator = SourcesQueriesGenerator(sources, query_generator)
     return queries_generator
 
@@ -256,7 +1090,7 @@ def parse_source_data(queries_cfg):
 
 
 def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
-                         query_cfg, io_pool):
+                         query_cfg, io_pool, query_cache=None):
     """
     Returns an object which is callable with the zoom and unpadded bounds and
     which returns a list of rows.
@@ -266,4 +1100,4 @@ def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
     queries_generator = make_queries_generator(
         sources, template_path, reload_templates)
     return DataFetcher(
-        postgresql_conn_info, queries_generator, io_pool)
+        postgresql_conn_info, queries_generator, io_pool, query_cache)
@@ -1,35 +1,94 @@
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
 from shapely.geometry import box
 from shapely.wkb import loads as wkb_loads
-from tilequeue.query.common import layer_properties
+from tilequeue.query.common import zoom_layer_properties
+from tilequeue.query.common import zoomless_layer_properties
 from tilequeue.query.common import is_station_or_stop
 from tilequeue.query.common import is_station_or_line
 from tilequeue.query.common import deassoc
 from tilequeue.query.common import mz_is_interesting_transit_relation
 from tilequeue.query.common import shape_type_lookup
 from tilequeue.query.common import name_keys
+from tilequeue.query.common import wkb_envelope
+from tilequeue.query.common import wkb_geom_type
 from tilequeue.query.common import wkb_shape_type
 from tilequeue.query.common import ShapeType
+from tilequeue.query.common import Table
+from tilequeue.query.common import TransitCache
 from tilequeue.transform import calculate_padded_bounds
 from tilequeue.utils import CoordsByParent
 from raw_tiles.tile import shape_tile_coverage
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+from itertools import izip
 from math import floor
+import multiprocessing
+import sys
+import threading
+import time
 
 
 class Relation(object):
     """
     Relation object holds data about a relation and provides a nicer interface
     than the raw tuple by turning the tags array into a dict, and separating
-    out the "parts" array of IDs into separate lists for nodes, ways and other
-    relations.
+    out the "parts" array of IDs into separate arrays for nodes, ways and
+    other relations.
+
+    If given, intern is called on each tag key and value, so that the many
+    relations with the same tags can share the strings.
     """
 
-    def __init__(self, rel_id, way_off, rel_off, parts, members, tags):
+    __slots__ = ('id', 'tags', 'node_ids', 'way_ids', 'rel_ids')
+
+    def __init__(self, rel_id, way_off, rel_off, parts, members, tags,
+                 intern=None):
         self.id = rel_id
+        if intern is not None:
+            tags = [intern(x) for x in tags]
         self.tags = deassoc(tags)
-        self.node_ids = parts[0:way_off]
-        self.way_ids = parts[way_off:rel_off]
-        self.rel_ids = parts[rel_off:]
+        self.node_ids = array('l', parts[0:way_off])
+        self.way_ids = array('l', parts[way_off:rel_off])
+        self.rel_ids = array('l', parts[rel_off:])
+
+
+class _IdMultiMap(object):
+    """
+    Compact map of integer IDs to lists of integer IDs.
+
+    While building, the (key, value) pairs are appended to a pair of integer
+    arrays. freeze() sorts them by key, keeping the values for each key in
+    the order they were added, and they're then looked up by bisection. This
+    uses 16 bytes per pair, rather than a list slot and int object per value
+    and a list per key.
+    """
+
+    def __init__(self):
+        self.keys = array('l')
+        self.values = array('l')
+        self.frozen = False
+
+    def add(self, key, value):
+        assert not self.frozen, 'Cannot add to a frozen map'
+        self.keys.append(key)
+        self.values.append(value)
+
+    def freeze(self):
+        keys = self.keys
+        values = self.values
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self.keys = array('l', [keys[i] for i in order])
+        self.values = array('l', [values[i] for i in order])
+        self.frozen = True
+
+    def get(self, key):
+        if not self.frozen:
+            self.freeze()
+        keys = self.keys
+        lo = bisect_left(keys, key)
+        hi = bisect_right(keys, key, lo)
+        return self.values[lo:hi].tolist()
 
 
 class TilePyramid(namedtuple('TilePyramid', 'z x y max_z')):
@@ -97,10 +156,33 @@ class OsmRawrLookup(object):
         self.ways = {}
         self.relations = {}
 
-        self._ways_using_node = defaultdict(list)
-        self._relations_using_node = defaultdict(list)
-        self._relations_using_way = defaultdict(list)
-        self._relations_using_rel = defaultdict(list)
+        self._ways_using_node = _IdMultiMap()
+        self._relations_using_node = _IdMultiMap()
+        self._relations_using_way = _IdMultiMap()
+        self._relations_using_rel = _IdMultiMap()
+
+        self.transit_cache = None
+
+        # relation tags repeat a lot, e.g: type=route, so only one copy of
+        # each string is kept.
+        self._strings = {}
+
+    def _intern(self, string):
+        return self._strings.setdefault(string, string)
+
+    def freeze(self):
+        """
+        Prepare the lookups for reading, once all the rows have been added.
+        """
+
+        self._ways_using_node.freeze()
+        self._relations_using_node.freeze()
+        self._relations_using_way.freeze()
+        self._relations_using_rel.freeze()
+        self._strings = None
+        # the lookup doesn't change from here on, so the transit routes
+        # calculations can be shared between features.
+        self.transit_cache = TransitCache()
 
     def add_row(self, *args):
         # there's only a single dispatch from the indexing function, which
@@ -155,10 +237,11 @@ class OsmRawrLookup(object):
                 # was not interesting, e.g: not a road, station, etc... that
                 # we might need to look up later.
                 if way_id in self.ways:
-                    self._ways_using_node[node_id].append(way_id)
+                    self._ways_using_node.add(node_id, way_id)
 
     def add_relation(self, rel_id, way_off, rel_off, parts, members, tags):
-        r = Relation(rel_id, way_off, rel_off, parts, members, tags)
+        r = Relation(rel_id, way_off, rel_off, parts, members, tags,
+                     self._intern)
         is_transit_relation = mz_is_interesting_transit_relation(r.tags)
         is_route = 'route' in r.tags and \
                    ('network' in r.tags or 'ref' in r.tags)
@@ -166,22 +249,22 @@ class OsmRawrLookup(object):
             self.relations[r.id] = r
             for node_id in r.node_ids:
                 if node_id in self.nodes:
-                    self._relations_using_node[node_id].append(rel_id)
+                    self._relations_using_node.add(node_id, rel_id)
             for way_id in r.way_ids:
                 if way_id in self.ways:
-                    self._relations_using_way[way_id].append(rel_id)
+                    self._relations_using_way.add(way_id, rel_id)
             for member_rel_id in r.rel_ids:
-                self._relations_using_rel[member_rel_id].append(rel_id)
+                self._relations_using_rel.add(member_rel_id, rel_id)
 
     def relations_using_node(self, node_id):
         "Returns a list of relation IDs which contain the node with that ID."
 
-        return self._relations_using_node.get(node_id, [])
+        return self._relations_using_node.get(node_id)
 
     def relations_using_way(self, way_id):
         "Returns a list of relation IDs which contain the way with that ID."
 
-        return self._relations_using_way.get(way_id, [])
+        return self._relations_using_way.get(way_id)
 
     def relations_using_rel(self, rel_id):
         """
@@ -189,12 +272,12 @@ class OsmRawrLookup(object):
         ID.
         """
 
-        return self._relations_using_rel.get(rel_id, [])
+        return self._relations_using_rel.get(rel_id)
 
     def ways_using_node(self, node_id):
         "Returns a list of way IDs which contain the node with that ID."
 
-        return self._ways_using_node.get(node_id, [])
+        return self._ways_using_node.get(node_id)
 
     def relation(self, rel_id):
         "Returns the Relation object with the given ID."
@@ -282,6 +365,9 @@ class _LazyShape(object):
     many thousands of objects, it can become the slowest part of the indexing
     process. Given that we reject many features on the basis of their
     properties alone, lazily parsing the WKB can provide a significant saving.
+
+    The bounds and geometry type are read straight from the WKB, so they
+    don't need the shape to be parsed either.
     """
 
     def __init__(self, wkb):
@@ -296,12 +382,30 @@ class _LazyShape(object):
 
     @property
     def bounds(self):
-        if self.obj is None:
-            self.obj = wkb_loads(self.wkb)
         if self._bounds is None:
-            self._bounds = self.obj.bounds
+            self._bounds = wkb_envelope(self.wkb)
+            if self._bounds is None:
+                # empty geometries have empty bounds, whatever shapely
+                # thinks those should be.
+                if self.obj is None:
+                    self.obj = wkb_loads(self.wkb)
+                self._bounds = self.obj.bounds
         return self._bounds
 
+    @property
+    def geom_type(self):
+        if self.obj is not None:
+            return self.obj.geom_type
+        return wkb_geom_type(self.wkb)
+
+
+def _bounds_disjoint(a, b):
+    return a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1]
+
+
+def _bounds_within(a, b):
+    return a[0] >= b[0] and a[1] >= b[1] and a[2] <= b[2] and a[3] <= b[3]
+
 
 _Metadata = namedtuple('_Metadata', 'source ways relations')
 
@@ -352,6 +456,106 @@ def _make_meta(source, fid, shape_type, osm):
     return _Metadata(source.name, ways, rel_dicts)
 
 
+class _TileIndex(object):
+    """
+    Compact index of features by the tiles of a tile pyramid that they
+    appear in.
+
+    Features are kept in a list, and referred to by their position in it.
+    While building, each (tile, feature id) entry is appended to a pair of
+    integer arrays for its zoom, where the tile is numbered by its position
+    within the pyramid. freeze() then sorts them by tile with a counting
+    sort into a CSR-style layout: for each zoom, an array of feature ids
+    grouped by tile, and an array of offsets into it for each tile. This
+    uses a few bytes per entry, rather than a list slot per entry and a
+    Tile object and list per tile.
+    """
+
+    def __init__(self, tile_pyramid):
+        self.tile_pyramid = tile_pyramid
+        self.features = []
+        # zoom -> (tile numbers, feature ids), while building.
+        self._pending = defaultdict(lambda: (array('I'), array('I')))
+        # zoom -> (offsets, feature ids), once frozen.
+        self._frozen = None
+
+    def add_feature(self, feature):
+        self.features.append(feature)
+        return len(self.features) - 1
+
+    def add(self, zoom, x, y, feature_id):
+        dz = zoom - self.tile_pyramid.z
+        rel_x = x - (self.tile_pyramid.x << dz)
+        rel_y = y - (self.tile_pyramid.y << dz)
+        size = 1 << dz
+        if 0 <= rel_x < size and 0 <= rel_y < size:
+            tile_nums, feature_ids = self._pending[zoom]
+            tile_nums.append((rel_x << dz) | rel_y)
+            feature_ids.append(feature_id)
+
+    def freeze(self):
+        frozen = {}
+        for zoom, (tile_nums, feature_ids) in self._pending.iteritems():
+            n_tiles = 1 << (2 * (zoom - self.tile_pyramid.z))
+            offsets = array('I', [0]) * (n_tiles + 1)
+            for tile_num in tile_nums:
+                offsets[tile_num + 1] += 1
+            for i in xrange(n_tiles):
+                offsets[i + 1] += offsets[i]
+
+            # stable, so each tile's features stay in the order they were
+            # added.
+            sorted_ids = array('I', [0]) * len(feature_ids)
+            cursor = offsets[:-1]
+            for tile_num, feature_id in izip(tile_nums, feature_ids):
+                sorted_ids[cursor[tile_num]] = feature_id
+                cursor[tile_num] += 1
+            frozen[zoom] = (offsets, sorted_ids)
+        self._frozen = frozen
+        self._pending = None
+
+    def feature_ids(self, tile):
+        """
+        Returns an array of the ids of the features in the tile, in the
+        order they were added.
+        """
+
+        assert self._frozen is not None, 'Index must be frozen before use'
+        entry = self._frozen.get(tile.z)
+        if entry is None:
+            return ()
+        offsets, sorted_ids = entry
+        dz = tile.z - self.tile_pyramid.z
+        rel_x = tile.x - (self.tile_pyramid.x << dz)
+        rel_y = tile.y - (self.tile_pyramid.y << dz)
+        size = 1 << dz
+        if not (0 <= rel_x < size and 0 <= rel_y < size):
+            return ()
+        tile_num = (rel_x << dz) | rel_y
+        return sorted_ids[offsets[tile_num]:offsets[tile_num + 1]]
+
+    def __call__(self, tile):
+        features = self.features
+        return [features[i] for i in self.feature_ids(tile)]
+
+    def merge(self, fragment, make_feature):
+        """
+        Append an index fragment built from a chunk of rows by another
+        process. make_feature is called with the position of each indexed
+        row in the chunk and its layer min zooms, and returns the _Feature
+        to store.
+        """
+
+        entries, pending = fragment
+        base = len(self.features)
+        for position, layer_min_zooms in entries:
+            self.features.append(make_feature(position, layer_min_zooms))
+        for zoom, (tile_nums, feature_ids) in pending.iteritems():
+            my_tile_nums, my_feature_ids = self._pending[zoom]
+            my_tile_nums.extend(tile_nums)
+            my_feature_ids.extend(array('I', [i + base for i in feature_ids]))
+
+
 def insert_into_index(tile_pyramid, feature, tile_index,
                       start_zoom=0, end_zoom=None):
     assert isinstance(feature, _Feature)
@@ -395,21 +599,27 @@ def insert_into_index(tile_pyramid, feature, tile_index,
     if zoom < floor_zoom:
         return
 
-    tiles = shape_tile_coverage(feature.shape, zoom, tile_pyramid.tile())
+    tiles = set((tile.x, tile.y) for tile in shape_tile_coverage(
+        feature.shape, zoom, tile_pyramid.tile()))
+    if not tiles:
+        return
 
+    feature_id = tile_index.add_feature(feature)
     while zoom >= floor_zoom:
         parent_tiles = set()
-        for tile in tiles:
-            tile_index[tile].append(feature)
-            parent_tiles.add(tile.parent())
+        for x, y in tiles:
+            tile_index.add(zoom, x, y, feature_id)
+            parent_tiles.add((x >> 1, y >> 1))
 
         zoom -= 1
         tiles = parent_tiles
 
 
-def make_layer_min_zooms(layers, source, fid, shape, props, shape_type):
+def make_layer_min_zooms(layers, source, fid, shape, props, shape_type,
+                         meta=None):
     layer_min_zooms = {}
-    meta = _make_meta(source, fid, shape_type, None)
+    if meta is None:
+        meta = _make_meta(source, fid, shape_type, None)
     for layer_name, info in layers.items():
         if info.shape_types and shape_type not in info.shape_types:
             continue
@@ -431,7 +641,7 @@ class _SimpleLayersIndex(object):
     def __init__(self, layers, tile_pyramid, source, start_zoom, end_zoom):
         self.layers = layers
         self.tile_pyramid = tile_pyramid
-        self.tile_index = defaultdict(list)
+        self.tile_index = _TileIndex(tile_pyramid)
         self.source = source
         self.start_zoom = start_zoom
         self.end_zoom = end_zoom
@@ -447,8 +657,11 @@ class _SimpleLayersIndex(object):
         insert_into_index(self.tile_pyramid, feature, self.tile_index,
                           self.start_zoom, self.end_zoom)
 
+    def freeze(self):
+        self.tile_index.freeze()
+
     def __call__(self, tile):
-        return self.tile_index.get(tile, [])
+        return self.tile_index(tile)
 
 
 class _LayersIndex(object):
@@ -464,24 +677,48 @@ class _LayersIndex(object):
     def __init__(self, layers, tile_pyramid):
         self.layers = layers
         self.tile_pyramid = tile_pyramid
-        self.tile_index = defaultdict(list)
+        self.tile_index = _TileIndex(tile_pyramid)
         self.delayed_features = []
 
     def add_row(self, fid, shape_wkb, props):
         shape = _LazyShape(shape_wkb)
-        # single object (hence single id()) will be shared amongst all layers.
-        # this allows us to easily and quickly de-duplicate at later layers in
-        # the stack.
+        # single object (hence single id in the tile index) will be shared
+        # amongst all layers. this allows us to easily and quickly
+        # de-duplicate at later layers in the stack.
         feature = _Feature(fid, shape, props, {})
 
         # delay min zoom calculation in order to collect more information about
         # the ways and relations using a particular feature.
         self.delayed_features.append(feature)
 
-    def index(self, osm, source):
-        for feature in self.delayed_features:
-            self._index_feature(feature, osm, source)
+    def index(self, osm, source, indexer=None):
         self.source = source
+        if indexer is None:
+            for feature in self.delayed_features:
+                self._index_feature(feature, osm, source)
+            self.tile_index.freeze()
+
+        else:
+            # the metadata needs the OSM lookup, so it's made here and sent
+            # along with each row, rather than sending the whole lookup to
+            # each worker.
+            features = self.delayed_features
+            rows = []
+            for feature in features:
+                shape_wkb = feature.shape.wkb
+                meta = _make_meta(
+                    source, feature.fid, wkb_shape_type(shape_wkb), osm)
+                rows.append((feature.fid, shape_wkb, feature.properties,
+                             meta))
+
+            def make_feature(position, layer_min_zooms):
+                feature = features[position]
+                feature.layer_min_zooms.update(layer_min_zooms)
+                return feature
+
+            indexer.submit(self.tile_index, self.layers.keys(), source, rows,
+                           make_feature)
+
         del self.delayed_features
 
     def _index_feature(self, feature, osm, source):
@@ -507,10 +744,10 @@ class _LayersIndex(object):
         insert_into_index(self.tile_pyramid, feature, self.tile_index)
 
     def __call__(self, tile):
-        return self.tile_index.get(tile, [])
+        return self.tile_index(tile)
 
 
-def osm_index(layers, tables, tile_pyramid):
+def osm_index(layers, tables, tile_pyramid, indexer=None):
     from raw_tiles.index.index import index_table
 
     table_indexes = defaultdict(list)
@@ -539,6 +776,7 @@ def osm_index(layers, tables, tile_pyramid):
             assert source == table.source, 'Mismatched sources'
 
     assert source
+    osm.freeze()
 
     # there's a chicken and egg problem with the indexes: we want to know
     # which features to index, but also calculate the feature's min zoom,
@@ -549,12 +787,12 @@ def osm_index(layers, tables, tile_pyramid):
     # might mean we buffer more information in memory than we technically
     # need if many of the features are not visible, but means we get one
     # single set of _Feature objects.
-    index.index(osm, source)
+    index.index(osm, source, indexer)
 
     return index, osm
 
 
-def simple_index(layers, tables, tile_pyramid, index_cfg):
+def simple_index(layers, tables, tile_pyramid, index_cfg, indexer=None):
     from raw_tiles.index.index import index_table
 
     table_name = index_cfg.get('table')
@@ -571,25 +809,175 @@ def simple_index(layers, tables, tile_pyramid, index_cfg):
     simple_layers = {layer_name: layers[layer_name]}
     index = _SimpleLayersIndex(
         simple_layers, tile_pyramid, table.source, start_zoom, end_zoom)
-    index_table(table.rows, index)
+
+    if indexer is None:
+        index_table(table.rows, index)
+        index.freeze()
+
+    else:
+        rows = [(fid, shape_wkb, props, None)
+                for fid, shape_wkb, props in table.rows]
+
+        def make_feature(position, layer_min_zooms):
+            fid, shape_wkb, props, _ = rows[position]
+            return _Feature(fid, _LazyShape(shape_wkb), props, layer_min_zooms)
+
+        indexer.submit(index.tile_index, [layer_name], table.source, rows,
+                       make_feature, start_zoom, end_zoom)
+
     return index
 
 
+# layers used by the index worker processes. these are set when each worker
+# starts, rather than sent with each chunk of rows, as the min zoom
+# functions generally can't be pickled. the workers are forked, so they
+# inherit them instead.
+_worker_layers = None
+
+
+def _init_index_worker(layers):
+    global _worker_layers
+    _worker_layers = layers
+
+
+class _FragmentIndex(_TileIndex):
+    """
+    Index of a chunk of rows, built in a worker process. Rather than the
+    features, it keeps the position of each indexed row in the chunk and
+    its layer min zooms, which is all the parent process needs to merge it.
+    """
+
+    def __init__(self, tile_pyramid):
+        super(_FragmentIndex, self).__init__(tile_pyramid)
+        self.position = None
+
+    def add_feature(self, feature):
+        self.features.append((self.position, feature.layer_min_zooms))
+        return len(self.features) - 1
+
+    def fragment(self):
+        return self.features, dict(self._pending)
+
+
+def _index_rows(args):
+    layer_names, source, tile_pyramid, start_zoom, end_zoom, rows = args
+    layers = dict((name, _worker_layers[name]) for name in layer_names)
+
+    index = _FragmentIndex(tile_pyramid)
+    for position, (fid, shape_wkb, props, meta) in enumerate(rows):
+        shape = _LazyShape(shape_wkb)
+        shape_type = wkb_shape_type(shape_wkb)
+        layer_min_zooms = make_layer_min_zooms(
+            layers, source, fid, shape, props, shape_type, meta)
+
+        index.position = position
+        feature = _Feature(fid, shape, props, layer_min_zooms)
+        insert_into_index(tile_pyramid, feature, index, start_zoom, end_zoom)
+
+    return index.fragment()
+
+
+class _ParallelIndexer(object):
+    """
+    Builds indexes in a pool of worker processes.
+
+    The rows of each table are split into chunks of consecutive rows, and
+    every chunk of every table is submitted before any results are waited
+    for, so that the tables are indexed concurrently. The fragments are
+    merged in the order the rows were read, so the result is the same as
+    indexing in a single process.
+    """
+
+    def __init__(self, pool, tile_pyramid, chunk_size):
+        self.pool = pool
+        self.tile_pyramid = tile_pyramid
+        self.chunk_size = chunk_size
+        self.tile_indexes = []
+        self.pending = []
+
+    def submit(self, tile_index, layer_names, source, rows, make_feature,
+               start_zoom=0, end_zoom=None):
+        layer_names = list(layer_names)
+        for start in xrange(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            result = self.pool.apply_async(_index_rows, ((
+                layer_names, source, self.tile_pyramid, start_zoom, end_zoom,
+                chunk),))
+            self.pending.append((tile_index, start, make_feature, result))
+        self.tile_indexes.append(tile_index)
+
+    def finish(self):
+        for tile_index, start, make_feature, result in self.pending:
+            def make_chunk_feature(position, layer_min_zooms):
+                return make_feature(start + position, layer_min_zooms)
+
+            tile_index.merge(result.get(), make_chunk_feature)
+        self.pending = []
+
+        for tile_index in self.tile_indexes:
+            tile_index.freeze()
+        self.tile_indexes = []
+
+
+def make_index_pool(n_processes, layers):
+    """
+    Make a pool of processes to build RAWR tile indexes in. This should be
+    made before any other threads are started, as the workers are forked
+    from this process.
+    """
+
+    return multiprocessing.Pool(
+        n_processes, _init_index_worker, (layers,))
+
+
+class _FeatureWork(object):
+
+    """Zoom-independent results for a feature in a RawrTile"""
+
+    __slots__ = ('names', 'named_layer', 'label_layers', 'layer_props',
+                 'label')
+
+    def __init__(self, names, named_layer, label_layers):
+        self.names = names
+        self.named_layer = named_layer
+        self.label_layers = label_layers
+        # layer name -> result of zoomless_layer_properties
+        self.layer_props = {}
+        # WKB of the label placement point
+        self.label = None
+
+
 class RawrTile(object):
 
+    # number of rows in each chunk sent to the index pool.
+    index_chunk_size = 5000
+
     def __init__(self, layers, tables, tile_pyramid, label_placement_layers,
-                 indexes_cfg):
+                 indexes_cfg, index_pool=None):
         """
         Expect layers to be a dict of layer name to LayerInfo (see fixture.py).
         Tables should be a callable which returns a Table object (namedtuple
         of a source and iterator over the rows in the table) when called with
         that table's name.
+
+        If index_pool is given, from make_index_pool, the min zooms and
+        tile coverage of the features are calculated in its processes.
         """
 
         self.layers = layers
         self.tile_pyramid = tile_pyramid
         self.label_placement_layers = label_placement_layers
         self.osm = None
+        # work for each feature which doesn't depend on the zoom or bounds,
+        # by the key from _lookup, so that it's done once per feature
+        # rather than once for each zoom it's fetched at. a tile which is
+        # shared between jobs is called with each job's own memo instead.
+        self._work = {}
+
+        indexer = None
+        if index_pool is not None:
+            indexer = _ParallelIndexer(
+                index_pool, tile_pyramid, self.index_chunk_size)
 
         indexes = []
         for index_cfg in indexes_cfg:
@@ -597,17 +985,26 @@ class RawrTile(object):
             assert typ, 'Index configuration must provide a type.'
 
             if typ == 'osm':
-                index, osm = osm_index(layers, tables, tile_pyramid)
+                index, osm = osm_index(layers, tables, tile_pyramid, indexer)
                 assert self.osm is None, 'Cannot have more than one OSM index.'
                 self.osm = osm
                 indexes.append(index)
 
             elif typ == 'simple':
                 indexes.append(simple_index(
-                    layers, tables, tile_pyramid, index_cfg))
+                    layers, tables, tile_pyramid, index_cfg, indexer))
             else:
                 raise ValueError('Unknown index type %r' % (typ,))
 
+        if indexer is not None:
+            indexer.finish()
+
+        # the tables aren't read again once they're indexed, so anything
+        # they hold open, e.g: a mapped payload, can be released.
+        close_fn = getattr(tables, 'close', None)
+        if close_fn is not None:
+            close_fn()
+
         self.indexes = indexes
 
     def _named_layer(self, layer_min_zooms):
@@ -624,22 +1021,38 @@ class RawrTile(object):
 
     def _lookup(self, zoom, unpadded_bounds):
         source_features = defaultdict(list)
-        seen_ids = set()
+        tiles = list(_tiles(zoom, unpadded_bounds))
 
-        def _add_feature(source, feature):
-            feature_id = id(feature)
-            if feature_id not in seen_ids:
-                seen_ids.add(feature_id)
-                source_features[source].append(feature)
+        # features are only ever in one index, so they're de-duplicated by
+        # their id within that index. a single tile can't list a feature
+        # twice, so there's nothing to de-duplicate.
+        seen_ids = None
+        if len(tiles) > 1:
+            seen_ids = [set() for _ in self.indexes]
 
-        for tile in _tiles(zoom, unpadded_bounds):
-            for index in self.indexes:
-                for feature in index(tile):
-                    _add_feature(index.source, feature)
+        # each feature is returned with a key, unique within the tile,
+        # of the index it's in and its id in that index.
+        for tile in tiles:
+            for i, index in enumerate(self.indexes):
+                tile_index = index.tile_index
+                features = tile_index.features
+                out = source_features[index.source]
+                feature_ids = tile_index.feature_ids(tile)
+                if seen_ids is None:
+                    out.extend(((i, fid), features[fid])
+                               for fid in feature_ids)
+                    continue
+                seen = seen_ids[i]
+                for fid in feature_ids:
+                    if fid not in seen:
+                        seen.add(fid)
+                        out.append(((i, fid), features[fid]))
 
         return source_features.iteritems()
 
-    def __call__(self, zoom, unpadded_bounds):
+    def __call__(self, zoom, unpadded_bounds, work=None):
+        if work is None:
+            work = self._work
         read_rows = []
         bbox = box(*unpadded_bounds)
 
@@ -653,32 +1066,47 @@ class RawrTile(object):
         assert bbox.within(self.tile_pyramid.bbox())
 
         for source, features in self._lookup(zoom, unpadded_bounds):
-            for (fid, shape, props, layer_min_zooms) in features:
+            for key, (fid, shape, props, layer_min_zooms) in features:
                 read_row = self._parse_row(
                     zoom, unpadded_bounds, bbox, source, fid, shape, props,
-                    layer_min_zooms)
+                    layer_min_zooms, work, key)
                 if read_row:
                     read_rows.append(read_row)
 
         return read_rows
 
+    def _feature_work(self, memo, key, fid, shape, props, layer_min_zooms):
+        work = memo.get(key)
+        if work is None:
+            # add names into whichever of the pois, landuse or buildings
+            # layers has claimed this feature.
+            names = {}
+            for k in name_keys(props):
+                names[k] = props[k]
+            label_layers = self.label_placement_layers.get(
+                shape_type_lookup(shape), {})
+            work = _FeatureWork(
+                names, self._named_layer(layer_min_zooms), label_layers)
+            memo[key] = work
+        return work
+
     def _parse_row(self, zoom, unpadded_bounds, bbox, source, fid, shape,
-                   props, layer_min_zooms):
-        # reject any feature which doesn't intersect the given bounds
-        if bbox.disjoint(shape):
+                   props, layer_min_zooms, memo, key):
+        # reject any feature which doesn't intersect the given bounds. the
+        # bounds decide most features without needing to parse the shape:
+        # only those which cross the edge of the bounds need the exact test.
+        shape_bounds = shape.bounds
+        if _bounds_disjoint(shape_bounds, unpadded_bounds):
+            return None
+        if not _bounds_within(shape_bounds, unpadded_bounds) and \
+           bbox.disjoint(shape):
             return None
 
         # place for assembing the read row as if from postgres
         read_row = {}
         generate_label_placement = False
 
-        # add names into whichever of the pois, landuse or buildings
-        # layers has claimed this feature.
-        names = {}
-        for k in name_keys(props):
-            names[k] = props[k]
-        named_layer = self._named_layer(layer_min_zooms)
-
+        work = None
         for layer_name, min_zoom in layer_min_zooms.items():
             # we need to keep fractional zooms, e.g: 4.999 should appear
             # in tiles at zoom level 4, but not 3. also, tiles at zooms
@@ -687,20 +1115,26 @@ class RawrTile(object):
             if tile_zoom > zoom:
                 continue
 
-            layer_props = layer_properties(
-                fid, shape, props, layer_name, zoom, self.osm)
+            if work is None:
+                work = self._feature_work(
+                    memo, key, fid, shape, props, layer_min_zooms)
+
+            zoomless = work.layer_props.get(layer_name)
+            if zoomless is None:
+                zoomless = zoomless_layer_properties(
+                    fid, shape, props, layer_name, self.osm)
+                work.layer_props[layer_name] = zoomless
+            layer_props = zoom_layer_properties(zoomless[0], zoomless[1], zoom)
             layer_props['min_zoom'] = min_zoom
 
-            if names and named_layer == layer_name:
-                layer_props.update(names)
+            if work.names and work.named_layer == layer_name:
+                layer_props.update(work.names)
 
             read_row['__' + layer_name + '_properties__'] = layer_props
 
             # if the feature exists in any label placement layer, then we
             # should consider generating a centroid
-            label_layers = self.label_placement_layers.get(
-                shape_type_lookup(shape), {})
-            if layer_name in label_layers:
+            if layer_name in work.label_layers:
                 generate_label_placement = True
 
         if read_row:
@@ -714,15 +1148,16 @@ class RawrTile(object):
                 clip_box = calculate_padded_bounds(
                     pad_factor, unpadded_bounds)
             # don't need to clip if geom is fully within the clipping box
-            if box(*shape.bounds).within(clip_box):
+            if _bounds_within(shape_bounds, clip_box.bounds):
                 clip_shape = shape
             else:
                 clip_shape = clip_box.intersection(shape)
             read_row['__geometry__'] = bytes(clip_shape.wkb)
 
             if generate_label_placement:
-                read_row['__label__'] = bytes(
-                    shape.representative_point().wkb)
+                if work.label is None:
+                    work.label = bytes(shape.representative_point().wkb)
+                read_row['__label__'] = work.label
 
             if source:
                 read_row['__properties__'] = {'source': source.value}
@@ -730,16 +1165,370 @@ class RawrTile(object):
         return read_row
 
 
+def _estimate_row_bytes(row):
+    # rough size of what the indexes keep for a row. parsed geometries are
+    # somewhat larger than their WKB, and the properties are kept as they
+    # are, so this is an estimate rather than an exact measure.
+    size = 64
+    for value in row:
+        if isinstance(value, basestring):
+            size += 2 * len(value)
+        elif isinstance(value, dict):
+            size += 64
+            for k, v in value.iteritems():
+                size += len(k) + (len(v) if isinstance(v, basestring) else 8)
+        elif isinstance(value, (list, tuple)):
+            size += 8 * len(value)
+        else:
+            size += 8
+    return size
+
+
+class _RawrTileJob(object):
+
+    """A RawrTile as used by one job
+
+    The job has its own memo of the work for each feature, so that jobs
+    running at the same time on a cached tile don't share one, and the memo
+    is dropped along with the job rather than adding to the cached tile.
+    """
+
+    def __init__(self, rawr_tile):
+        self.rawr_tile = rawr_tile
+        self._work = {}
+
+    def __call__(self, zoom, unpadded_bounds):
+        return self.rawr_tile(zoom, unpadded_bounds, self._work)
+
+
+class _SizedTables(object):
+
+    """Wraps a "tables" callable, adding up the estimated size of the rows"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.version = getattr(tables, 'version', None)
+        self.n_bytes = 0
+
+    def _sized_rows(self, rows):
+        for row in rows:
+            self.n_bytes += _estimate_row_bytes(row)
+            yield row
+
+    def __call__(self, table_name):
+        table = self.tables(table_name)
+        return Table(table.source, self._sized_rows(table.rows))
+
+    def close(self):
+        close_fn = getattr(self.tables, 'close', None)
+        if close_fn is not None:
+            close_fn()
+
+
+class RawrTileCache(object):
+
+    """LRU cache of built RawrTile objects
+
+    Entries are keyed by the tile, and hold the version of the RAWR tile
+    object the RawrTile was built from along with it, so that a rebuilt RAWR
+    tile is never served from a stale entry. The cache is bounded by the
+    estimated memory used by the entries.
+    """
+
+    def __init__(self, max_bytes, stats_handler=None):
+        self.max_bytes = max_bytes
+        self.stats_handler = stats_handler
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, evictions=0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+            else:
+                # re-insert to mark as most recently used.
+                self._entries[key] = entry
+                self._stats['hits'] += 1
+        if self.stats_handler:
+            if entry is None:
+                self.stats_handler.miss()
+            else:
+                self.stats_handler.hit()
+        return None if entry is None else entry[0]
+
+    def put(self, key, rawr_tile, n_bytes):
+        n_evicted = 0
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._size -= old_entry[1]
+            if n_bytes <= self.max_bytes:
+                self._entries[key] = (rawr_tile, n_bytes)
+                self._size += n_bytes
+            while self._size > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._size -= evicted_bytes
+                n_evicted += 1
+            self._stats['evictions'] += n_evicted
+        if self.stats_handler:
+            self.stats_handler.stored(n_bytes, n_evicted)
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+        return stats
+
+
+def _tables_if_changed(storage, tile, version):
+    # returns the tables for the tile, or None if they're still the version
+    # given. storage which can check that without fetching the whole tile
+    # again has an if_changed(tile, version) method.
+    if_changed = getattr(storage, 'if_changed', None)
+    if if_changed is not None:
+        return if_changed(tile, version)
+    tables = storage(tile)
+    if getattr(tables, 'version', None) == version:
+        return None
+    return tables
+
+
+# returned by PrefetchingStorage._take for a tile without a usable prefetch.
+_NOT_PREFETCHED = object()
+
+
+class _Prefetch(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.done_at = None
+        self.tables = None
+        self.exc_info = None
+        self.cancelled = False
+
+
+class PrefetchingStorage(object):
+
+    """Wraps a RAWR storage to start fetching tiles before they're needed
+
+    prefetch(tile) queues the tile to be fetched by the wrapped storage in a
+    background thread, so that downloading the next tiles overlaps with
+    indexing and processing the current one. At most max_tiles tiles are
+    being fetched or held at once, which bounds the memory used. Others
+    wait, in the order they were queued, for a slot to be freed.
+
+    Calling the storage for a tile takes its prefetched result, waiting for
+    it if it's still being fetched, and frees its slot. A tile which wasn't
+    prefetched, or whose prefetch failed, is fetched directly. The same goes
+    for if_changed(tile, version), which passes the version on to the
+    wrapped storage when there's no prefetched result. A result
+    which isn't used within max_age seconds is dropped, as is one passed to
+    cancel(tile), e.g: when its job fails. A cancelled tile which is still
+    being fetched keeps its slot until the fetch finishes.
+    """
+
+    def __init__(self, storage, max_tiles, max_age=300):
+        self.storage = storage
+        self.max_tiles = max_tiles
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # tiles queued but not started, and those started, by (z, x, y).
+        self.upcoming = OrderedDict()
+        self.started = OrderedDict()
+        # number of cancelled tiles which are still being fetched.
+        self.abandoned = 0
+        self._stats = dict(hits=0, misses=0, failed=0, expired=0,
+                           cancelled=0)
+
+    def __getattr__(self, name):
+        # pass through the rest of the storage's interface.
+        if name == 'storage':
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def _key(self, tile):
+        return (tile.z, tile.x, tile.y)
+
+    def prefetch(self, tile):
+        key = self._key(tile)
+        with self.lock:
+            if key not in self.started and key not in self.upcoming:
+                self.upcoming[key] = tile
+            self._start_more()
+
+    def _start_more(self):
+        # must be called with the lock held.
+        now = time.time()
+        for key, prefetch in self.started.items():
+            if prefetch.done_at is not None and \
+               now - prefetch.done_at > self.max_age:
+                del self.started[key]
+                self._stats['expired'] += 1
+
+        while self.upcoming and \
+                len(self.started) + self.abandoned < self.max_tiles:
+            key, tile = self.upcoming.popitem(last=False)
+            prefetch = _Prefetch()
+            self.started[key] = prefetch
+            thread = threading.Thread(
+                target=self._fetch, args=(tile, prefetch))
+            thread.daemon = True
+            thread.start()
+
+    def _fetch(self, tile, prefetch):
+        try:
+            prefetch.tables = self.storage(tile)
+        except Exception:
+            prefetch.exc_info = sys.exc_info()
+        with self.lock:
+            prefetch.done_at = time.time()
+            if prefetch.cancelled:
+                # nothing will take the result, so drop it and free the
+                # slot.
+                prefetch.tables = None
+                prefetch.exc_info = None
+                self.abandoned -= 1
+                self._start_more()
+        prefetch.done.set()
+
+    def _take(self, tile):
+        key = self._key(tile)
+        with self.lock:
+            self.upcoming.pop(key, None)
+            prefetch = self.started.pop(key, None)
+            self._stats['misses' if prefetch is None else 'hits'] += 1
+            self._start_more()
+
+        if prefetch is not None:
+            prefetch.done.wait()
+            if prefetch.exc_info is None:
+                return prefetch.tables
+            # the error might have been transient, so try again rather
+            # than failing the job.
+            with self.lock:
+                self._stats['failed'] += 1
+
+        return _NOT_PREFETCHED
+
+    def __call__(self, tile):
+        tables = self._take(tile)
+        if tables is _NOT_PREFETCHED:
+            tables = self.storage(tile)
+        return tables
+
+    def if_changed(self, tile, version):
+        tables = self._take(tile)
+        if tables is _NOT_PREFETCHED:
+            return _tables_if_changed(self.storage, tile, version)
+        if getattr(tables, 'version', None) == version:
+            return None
+        return tables
+
+    def cancel(self, tile):
+        key = self._key(tile)
+        with self.lock:
+            queued = self.upcoming.pop(key, None)
+            prefetch = self.started.pop(key, None)
+            if queued is not None or prefetch is not None:
+                self._stats['cancelled'] += 1
+            if prefetch is not None and prefetch.done_at is None:
+                prefetch.cancelled = True
+                self.abandoned += 1
+            self._start_more()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self._stats)
+            stats['upcoming'] = len(self.upcoming)
+            stats['started'] = len(self.started)
+            stats['abandoned'] = self.abandoned
+        return stats
+
+
 class DataFetcher(object):
 
     def __init__(self, min_z, max_z, storage, layers, indexes_cfg,
-                 label_placement_layers):
+                 label_placement_layers, tile_cache=None, index_pool=None):
         self.min_z = min_z
         self.max_z = max_z
         self.storage = storage
         self.layers = layers
         self.indexes_cfg = indexes_cfg
         self.label_placement_layers = label_placement_layers
+        self.tile_cache = tile_cache
+        self.index_pool = index_pool
+
+    def _rawr_tile(self, tile_pyramid):
+        tile = tile_pyramid.tile()
+
+        # built tiles are reused while the RAWR tile is still the version
+        # they were built from, which the storage checks as it fetches the
+        # tile, e.g: with a conditional GET, rather than downloading it.
+        key = None
+        cached = None
+        if self.tile_cache is not None:
+            key = (tile.z, tile.x, tile.y)
+            cached = self.tile_cache.get(key)
+
+        if cached is None:
+            tables = self.storage(tile)
+        else:
+            version, fetcher = cached
+            tables = _tables_if_changed(self.storage, tile, version)
+            if tables is None:
+                return fetcher
+
+        # only tiles whose version is known can be reused.
+        version = getattr(tables, 'version', None)
+        if key is not None and version is not None:
+            tables = _SizedTables(tables)
+        elif key is not None:
+            if cached is not None:
+                self.tile_cache.discard(key)
+            key = None
+
+        fetcher = RawrTile(self.layers, tables, tile_pyramid,
+                           self.label_placement_layers, self.indexes_cfg,
+                           self.index_pool)
+
+        if key is not None:
+            self.tile_cache.put(key, (version, fetcher), tables.n_bytes)
+        return fetcher
+
+    def _storage_tile(self, coord):
+        # returns the RAWR tile for a parent coordinate from the queue, if
+        # it's one which this fetcher would be asked for.
+        if coord.zoom != self.min_z:
+            return None
+        return TilePyramid(
+            self.min_z, int(coord.column), int(coord.row), self.max_z).tile()
+
+    def prefetch(self, coord):
+        """
+        Hint that the RAWR tile for the parent coordinate of a job will be
+        needed soon, if the storage can prefetch it.
+        """
+
+        prefetch_fn = getattr(self.storage, 'prefetch', None)
+        tile = self._storage_tile(coord)
+        if prefetch_fn is not None and tile is not None:
+            prefetch_fn(tile)
+
+    def cancel_prefetch(self, coord):
+        cancel_fn = getattr(self.storage, 'cancel', None)
+        tile = self._storage_tile(coord)
+        if cancel_fn is not None and tile is not None:
+            cancel_fn(tile)
 
     def fetch_tiles(self, all_data):
         # group all coords by the "unit of work" zoom, i.e: z10 for
@@ -757,10 +1546,7 @@ class DataFetcher(object):
                 self.min_z, int(top_coord.column), int(top_coord.row),
                 self.max_z)
 
-            tables = self.storage(tile_pyramid.tile())
-
-            fetcher = RawrTile(self.layers, tables, tile_pyramid,
-                               self.label_placement_layers, self.indexes_cfg)
+            fetcher = _RawrTileJob(self._rawr_tile(tile_pyramid))
 
             for coord, data in coord_group:
                 yield fetcher, data
@@ -783,7 +1569,14 @@ class DataFetcher(object):
 #             set (or other in-supporting collection) of layer names.
 #             Geometries of that type in that layer will have a label
 #             placement generated for them.
+#  - tile_cache: Optional RawrTileCache to reuse built tiles. Only used if
+#             the "tables" have a version attribute, e.g: the ETag of the
+#             RAWR tile. The storage can have an if_changed(tile, version)
+#             method, returning None if the tile is still that version.
+#  - index_pool: Optional pool from make_index_pool to build the indexes in
+#             several processes.
 def make_rawr_data_fetcher(min_z, max_z, storage, layers, indexes_cfg,
-                           label_placement_layers={}):
+                           label_placement_layers={}, tile_cache=None,
+                           index_pool=None):
     return DataFetcher(min_z, max_z, storage, layers, indexes_cfg,
-                       label_placement_layers)
+                       label_placement_layers, tile_cache, index_pool)
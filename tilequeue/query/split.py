@@ -30,6 +30,22 @@ class DataFetcher(object):
         return chain(self.above_fetcher.fetch_tiles(above_data),
                      self.below_fetcher.fetch_tiles(below_data))
 
+    def _fetcher_fn(self, coord, name):
+        fetcher = self.above_fetcher
+        if coord.zoom < self.split_zoom:
+            fetcher = self.below_fetcher
+        return getattr(fetcher, name, None)
+
+    def prefetch(self, coord):
+        prefetch_fn = self._fetcher_fn(coord, 'prefetch')
+        if prefetch_fn is not None:
+            prefetch_fn(coord)
+
+    def cancel_prefetch(self, coord):
+        cancel_fn = self._fetcher_fn(coord, 'cancel_prefetch')
+        if cancel_fn is not None:
+            cancel_fn(coord)
+
 
 def make_split_data_fetcher(split_zoom, below_fetcher, above_fetcher):
     return DataFetcher(split_zoom, below_fetcher, above_fetcher)
@@ -1,15 +1,21 @@
+from array import array
 from botocore.exceptions import ClientError
 from collections import defaultdict
+from collections import deque
 from collections import namedtuple
 from contextlib import closing
+from contextlib import contextmanager
 from cStringIO import StringIO
 from itertools import imap
 from ModestMaps.Core import Coordinate
 from msgpack import Unpacker
+from multiprocessing.pool import ThreadPool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from raw_tiles.tile import Tile
 from raw_tiles.source.table_reader import TableReader
 from tilequeue.command import explode_and_intersect
 from tilequeue.format import zip_format
+from tilequeue.queue import JobProgressException
 from tilequeue.queue.message import MessageHandle
 from tilequeue.store import calc_hash
 from tilequeue.tile import coord_marshall_int
@@ -20,15 +26,33 @@ from tilequeue.utils import format_stacktrace_one_line
 from tilequeue.utils import grouper
 from tilequeue.utils import time_block
 from time import gmtime
+import errno
+import mmap
+import msgpack
+import os
+import Queue
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
 import zipfile
 
 
 class SqsQueue(object):
 
-    def __init__(self, sqs_client, queue_url, recv_wait_time_seconds):
+    def __init__(self, sqs_client, queue_url, recv_wait_time_seconds,
+                 visibility_mgr=None):
         self.sqs_client = sqs_client
         self.queue_url = queue_url
         self.recv_wait_time_seconds = recv_wait_time_seconds
+        self.visibility_mgr = visibility_mgr
+        self.lock = threading.Lock()
+        # handles of the messages read whose visibility can be extended,
+        # until they're done or released.
+        self.in_flight = set()
 
     def send_without_retry(self, payloads):
         """
@@ -103,31 +127,83 @@ class SqsQueue(object):
             raise Exception('Messages failed to send to sqs after %d '
                             'retries: %s' % (num_tries, len(payloads)))
 
-    def read(self):
-        """read a single message from the queue"""
-        resp = self.sqs_client.receive_message(
+    def read_batch(self, max_messages=10):
+        """read up to max_messages messages from the queue"""
+        kwargs = dict(
             QueueUrl=self.queue_url,
-            MaxNumberOfMessages=1,
+            MaxNumberOfMessages=max_messages,
             AttributeNames=('SentTimestamp',),
             WaitTimeSeconds=self.recv_wait_time_seconds,
         )
+        if self.visibility_mgr is not None:
+            kwargs['VisibilityTimeout'] = self.visibility_mgr.timeout_secs
+        resp = self.sqs_client.receive_message(**kwargs)
         if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise Exception('Invalid status code from sqs: %s' %
                             resp['ResponseMetadata']['HTTPStatusCode'])
-        msgs = resp.get('Messages')
-        if not msgs:
+        msgs = resp.get('Messages') or []
+        assert len(msgs) <= max_messages
+        msg_handles = []
+        for msg in msgs:
+            payload = msg['Body']
+            handle = msg['ReceiptHandle']
+            timestamp = msg['Attributes']['SentTimestamp']
+            metadata = dict(timestamp=timestamp)
+            msg_handles.append(MessageHandle(handle, payload, metadata))
+        if self.visibility_mgr is not None:
+            with self.lock:
+                self.in_flight.update(h.handle for h in msg_handles)
+        return msg_handles
+
+    def read(self):
+        """read a single message from the queue"""
+        msg_handles = self.read_batch(1)
+        if not msg_handles:
             return None
-        assert len(msgs) == 1
-        msg = msgs[0]
-        payload = msg['Body']
-        handle = msg['ReceiptHandle']
-        timestamp = msg['Attributes']['SentTimestamp']
-        metadata = dict(timestamp=timestamp)
-        msg_handle = MessageHandle(handle, payload, metadata)
-        return msg_handle
+        return msg_handles[0]
+
+    def job_progress(self, msg_handle):
+        """extend the visibility of a message which is still being worked on"""
+        if self.visibility_mgr is None:
+            return
+        handle = msg_handle.handle
+        with self.lock:
+            # the message may have been done since the caller saw it, and
+            # extending it then would start tracking it again.
+            if handle not in self.in_flight or \
+               not self.visibility_mgr.should_extend(handle):
+                return
+            visibility_state = self.visibility_mgr.extend(handle)
+
+        try:
+            self.sqs_client.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=handle,
+                VisibilityTimeout=self.visibility_mgr.extend_secs,
+            )
+        except Exception as e:
+            with self.lock:
+                if handle not in self.in_flight:
+                    # deleted while its visibility was being changed.
+                    return
+            err_details = dict(
+                visibility=dict(
+                    last=visibility_state.last.isoformat(),
+                    total=visibility_state.total,
+                    ))
+            raise JobProgressException(
+                'update visibility timeout', e, err_details)
+
+    def release(self, msg_handle):
+        """stop extending the visibility of a message which won't be done"""
+        with self.lock:
+            self.in_flight.discard(msg_handle.handle)
+            if self.visibility_mgr is not None:
+                self.visibility_mgr.done(msg_handle.handle)
 
     def done(self, msg_handle):
         """acknowledge completion of message"""
+        self.release(msg_handle)
         self.sqs_client.delete_message(
             QueueUrl=self.queue_url,
             ReceiptHandle=msg_handle.handle,
@@ -399,13 +475,58 @@ class RawrAllWithParentsIntersector(object):
         return coords, metrics, timing
 
 
+class ThreadConnections(object):
+
+    """Connection context which keeps a connection open for each thread
+
+    RAWR tile generation uses a new transaction, but not a new connection,
+    for each job. A connection which has been closed, or which was left in
+    a transaction after an error, is discarded and replaced on next use.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.local = threading.local()
+
+    def _discard(self):
+        conn = self.local.conn
+        self.local.conn = None
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def __call__(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self.connect()
+            self.local.conn = conn
+        try:
+            yield conn
+        except Exception:
+            if conn.closed or \
+               conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                self._discard()
+            raise
+
+
 class RawrTileGenerationPipeline(object):
 
-    """Entry point for rawr process command"""
+    """Entry point for rawr process command
+
+    Up to read_size messages are read from the queue at once, and if
+    n_threads is more than one they're processed concurrently, each
+    worker thread generating and uploading its own RAWR tile. While jobs
+    are in progress, their visibility on the queue is extended every
+    progress_interval seconds. Each message is only marked as done once
+    its own tile has been written and its coordinates enqueued.
+    """
 
     def __init__(
             self, rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
-            queue_writer, stats_handler, rawr_proc_logger, conn_ctx):
+            queue_writer, stats_handler, rawr_proc_logger, conn_ctx,
+            n_threads=1, read_size=1, progress_interval=60):
         self.rawr_queue = rawr_queue
         self.msg_marshaller = msg_marshaller
         self.group_by_zoom = group_by_zoom
@@ -414,151 +535,519 @@ class RawrTileGenerationPipeline(object):
         self.stats_handler = stats_handler
         self.rawr_proc_logger = rawr_proc_logger
         self.conn_ctx = conn_ctx
+        self.read_size = read_size
+        self.progress_interval = progress_interval
+        self.pool = None
+        if n_threads > 1:
+            self.pool = ThreadPool(n_threads)
+        self.lock = threading.Lock()
+        self.in_progress = set()
 
     def _atexit_log(self):
         self.rawr_proc_logger.lifecycle('Processing stopped')
 
+    def _read(self):
+        if self.read_size > 1:
+            read_batch = getattr(self.rawr_queue, 'read_batch', None)
+            if read_batch is not None:
+                return read_batch(self.read_size)
+        msg_handle = self.rawr_queue.read()
+        if not msg_handle:
+            return []
+        return [msg_handle]
+
+    def _extend_visibility(self):
+        # runs in a background thread for as long as the pipeline does.
+        while True:
+            time.sleep(self.progress_interval)
+            self.extend_in_progress()
+
+    def extend_in_progress(self):
+        """extend the visibility of all the jobs still in progress"""
+        with self.lock:
+            msg_handles = list(self.in_progress)
+        for msg_handle in msg_handles:
+            try:
+                self.rawr_queue.job_progress(msg_handle)
+            except Exception as e:
+                self.log_exception(e, 'extend visibility')
+
     def __call__(self):
         self.rawr_proc_logger.lifecycle('Processing started')
         import atexit
         atexit.register(self._atexit_log)
 
+        if getattr(self.rawr_queue, 'job_progress', None) is not None:
+            progress_thread = threading.Thread(target=self._extend_visibility)
+            progress_thread.daemon = True
+            progress_thread.start()
+
         while True:
             timing = {}
 
             try:
                 # NOTE: it's ok if reading from the queue takes a long time
                 with time_block(timing, 'queue_read'):
-                    msg_handle = self.rawr_queue.read()
+                    msg_handles = self._read()
             except Exception as e:
                 self.log_exception(e, 'queue read')
                 continue
 
-            if not msg_handle:
+            if not msg_handles:
                 # this gets triggered when no messages are returned
                 continue
 
-            try:
-                coords = self.msg_marshaller.unmarshall(msg_handle.payload)
-            except Exception as e:
-                self.log_exception(e, 'unmarshall payload')
-                continue
-
-            # split coordinates into group by zoom and higher and low zoom
-            # the message payload is either coordinates that are at group by
-            # zoom and higher, or all below the group by zoom
-            is_low_zoom = False
-            did_rawr_tile_gen = False
-            for coord in coords:
-                if coord.zoom < self.group_by_zoom:
-                    is_low_zoom = True
-                else:
-                    assert not is_low_zoom, \
-                        'Mix of low/high zoom coords in payload'
-
-            # check if we need to generate the rawr tile
-            # proceed directly to enqueueing the coordinates if not
-            if not is_low_zoom:
-                did_rawr_tile_gen = True
-                try:
-                    parent = common_parent(coords, self.group_by_zoom)
-                except Exception as e:
-                    self.log_exception(e, 'find parent')
-                    continue
-
-                try:
-                    rawr_tile_coord = convert_coord_object(parent)
-                except Exception as e:
-                    self.log_exception(e, 'convert coord', parent)
-                    continue
+            self.process_batch(msg_handles, timing)
+
+    def process_batch(self, msg_handles, timing=None):
+        """process the messages, concurrently if there's a worker pool"""
+        with self.lock:
+            self.in_progress.update(msg_handles)
+        jobs = [(msg_handle, dict(timing or {}))
+                for msg_handle in msg_handles]
+        if self.pool is None or len(jobs) == 1:
+            for job in jobs:
+                self._process(job)
+        else:
+            self.pool.map(self._process, jobs, chunksize=1)
 
-                try:
-                    rawr_gen_timing = {}
-                    with time_block(rawr_gen_timing, 'total'):
-                        # grab connection
-                        with self.conn_ctx() as conn:
-                            # commit transaction
-                            with conn as conn:
-                                # cleanup cursor resources
-                                with conn.cursor() as cur:
-                                    table_reader = TableReader(cur)
-
-                                    rawr_gen_specific_timing = self.rawr_gen(
-                                        table_reader, rawr_tile_coord)
-
-                    rawr_gen_timing.update(rawr_gen_specific_timing)
-                    timing['rawr_gen'] = rawr_gen_timing
-
-                except Exception as e:
-                    self.log_exception(e, 'rawr tile gen', parent)
-                    continue
+    def _process(self, job):
+        msg_handle, timing = job
+        try:
+            self._process_msg(msg_handle, timing)
+        finally:
+            with self.lock:
+                failed = msg_handle in self.in_progress
+                self.in_progress.discard(msg_handle)
+            # a message which wasn't done is read again, with a new handle,
+            # once its visibility times out.
+            release_fn = getattr(self.rawr_queue, 'release', None)
+            if failed and release_fn is not None:
+                release_fn(msg_handle)
+
+    def _process_msg(self, msg_handle, timing):
+        parent = None
+        try:
+            coords = self.msg_marshaller.unmarshall(msg_handle.payload)
+        except Exception as e:
+            self.log_exception(e, 'unmarshall payload')
+            return
+
+        # split coordinates into group by zoom and higher and low zoom
+        # the message payload is either coordinates that are at group by
+        # zoom and higher, or all below the group by zoom
+        is_low_zoom = False
+        did_rawr_tile_gen = False
+        for coord in coords:
+            if coord.zoom < self.group_by_zoom:
+                is_low_zoom = True
+            else:
+                assert not is_low_zoom, \
+                    'Mix of low/high zoom coords in payload'
 
+        # check if we need to generate the rawr tile
+        # proceed directly to enqueueing the coordinates if not
+        if not is_low_zoom:
+            did_rawr_tile_gen = True
             try:
-                with time_block(timing, 'queue_write'):
-                    n_enqueued, n_inflight = \
-                        self.queue_writer.enqueue_batch(coords)
+                parent = common_parent(coords, self.group_by_zoom)
             except Exception as e:
-                self.log_exception(e, 'queue write', parent)
-                continue
+                self.log_exception(e, 'find parent')
+                return
 
             try:
-                with time_block(timing, 'queue_done'):
-                    self.rawr_queue.done(msg_handle)
+                rawr_tile_coord = convert_coord_object(parent)
             except Exception as e:
-                self.log_exception(e, 'queue done', parent)
-                continue
+                self.log_exception(e, 'convert coord', parent)
+                return
 
             try:
-                self.rawr_proc_logger.processed(
-                    n_enqueued, n_inflight, did_rawr_tile_gen, timing, parent)
-            except Exception as e:
-                self.log_exception(e, 'log', parent)
-                continue
+                rawr_gen_timing = {}
+                with time_block(rawr_gen_timing, 'total'):
+                    # grab connection
+                    with self.conn_ctx() as conn:
+                        # commit transaction
+                        with conn as conn:
+                            # cleanup cursor resources
+                            with conn.cursor() as cur:
+                                table_reader = TableReader(cur)
+
+                                rawr_gen_specific_timing = self.rawr_gen(
+                                    table_reader, rawr_tile_coord)
+
+                rawr_gen_timing.update(rawr_gen_specific_timing)
+                timing['rawr_gen'] = rawr_gen_timing
 
-            try:
-                self.stats_handler(
-                    n_enqueued, n_inflight, did_rawr_tile_gen, timing)
             except Exception as e:
-                self.log_exception(e, 'stats', parent)
+                self.log_exception(e, 'rawr tile gen', parent)
+                return
+
+        try:
+            with time_block(timing, 'queue_write'):
+                n_enqueued, n_inflight = \
+                    self.queue_writer.enqueue_batch(coords)
+        except Exception as e:
+            self.log_exception(e, 'queue write', parent)
+            return
+
+        # stop extending the message's visibility before it's deleted.
+        with self.lock:
+            self.in_progress.discard(msg_handle)
+        try:
+            with time_block(timing, 'queue_done'):
+                self.rawr_queue.done(msg_handle)
+        except Exception as e:
+            self.log_exception(e, 'queue done', parent)
+            return
+
+        try:
+            self.rawr_proc_logger.processed(
+                n_enqueued, n_inflight, did_rawr_tile_gen, timing, parent)
+        except Exception as e:
+            self.log_exception(e, 'log', parent)
+            return
+
+        try:
+            self.stats_handler(
+                n_enqueued, n_inflight, did_rawr_tile_gen, timing)
+        except Exception as e:
+            self.log_exception(e, 'stats', parent)
 
     def log_exception(self, exception, msg, parent_coord=None):
         stacktrace = format_stacktrace_one_line()
         self.rawr_proc_logger.error(msg, exception, stacktrace, parent_coord)
 
 
-def make_rawr_zip_payload(rawr_tile, date_time=None):
-    """make a zip file from the rawr tile formatted data"""
+# columnar RAWR tables start with this, followed by a version byte. msgpack
+# tables start with the type byte of a row, which is never 'R'.
+_COLUMNAR_MAGIC = 'RAWRCOL'
+# version 2 stores the fids as 8-byte integers. version 1 used the size of
+# the writer's C long, and is still read where that matches.
+_COLUMNAR_VERSION = 2
+_MIN_FID = -(1 << 63)
+_MAX_FID = (1 << 63) - 1
+
+
+def _little_endian(arr):
+    if sys.byteorder != 'little':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tostring()
+
+
+def pack_columnar_table(rows):
+    """
+    Pack a table of (fid, shape_wkb, props) rows into the columnar format,
+    or return None if any row isn't a feature, e.g: the ways and relations
+    tables.
+
+    After the magic and version, the format has a msgpack header with the
+    number of rows, and the property keys and values used in the table,
+    each stored once. Then there are arrays of the fids, of the offsets of
+    each row's WKB and of each row's properties, and of the properties as
+    (key, value) index pairs. Finally, there's the WKB of all the rows,
+    concatenated. The arrays are little-endian, and the fids are 8 bytes
+    each.
+    """
+
+    fids = []
+    wkb_offsets = array('I', [0])
+    wkbs = []
+    prop_offsets = array('I', [0])
+    prop_pairs = array('I')
+    key_ids = {}
+    keys = []
+    value_ids = {}
+    values = []
+    n_bytes = 0
+
+    for row in rows:
+        if len(row) != 3:
+            return None
+        fid, shape_wkb, props = row
+        if not isinstance(fid, (int, long)) or \
+           not _MIN_FID <= fid <= _MAX_FID or \
+           not isinstance(shape_wkb, str) or \
+           not isinstance(props, dict):
+            return None
+
+        fids.append(fid)
+        wkbs.append(shape_wkb)
+        n_bytes += len(shape_wkb)
+        wkb_offsets.append(n_bytes)
+
+        for k, v in props.iteritems():
+            key_id = key_ids.get(k)
+            if key_id is None:
+                key_id = key_ids[k] = len(keys)
+                keys.append(k)
+            # values aren't all hashable, so they're matched by their packed
+            # form.
+            packed_v = msgpack.packb(v)
+            value_id = value_ids.get(packed_v)
+            if value_id is None:
+                value_id = value_ids[packed_v] = len(values)
+                values.append(v)
+            prop_pairs.append(key_id)
+            prop_pairs.append(value_id)
+        prop_offsets.append(len(prop_pairs) // 2)
+
+    header = msgpack.packb(dict(n=len(fids), keys=keys, values=values))
+    return ''.join([
+        _COLUMNAR_MAGIC, chr(_COLUMNAR_VERSION),
+        struct.pack('<I', len(header)), header,
+        struct.pack('<%dq' % len(fids), *fids), _little_endian(wkb_offsets),
+        _little_endian(prop_offsets), _little_endian(prop_pairs),
+    ] + wkbs)
+
+
+def unpack_columnar_table(data):
+    """
+    Return an iterator over the (fid, shape_wkb, props) rows of a table
+    packed by pack_columnar_table. Only the arrays are decoded up front,
+    and each row's WKB and properties are made as it's reached. The keys
+    and values are decoded once for the table, and shared by the rows.
+    """
+
+    assert data.startswith(_COLUMNAR_MAGIC), 'Not a columnar RAWR table'
+    offset = len(_COLUMNAR_MAGIC)
+    version = ord(data[offset])
+    if version not in (1, _COLUMNAR_VERSION):
+        raise ValueError('Unknown columnar RAWR table version %d' % version)
+    offset += 1
+    header_len, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    header = msgpack.unpackb(data[offset:offset + header_len])
+    offset += header_len
+
+    n = header['n']
+    if version == 1:
+        fid_size = header['fid_size']
+        fids = array('l')
+        assert fids.itemsize == fid_size, \
+            'Mismatched fid size in columnar RAWR table'
+        fids.fromstring(data[offset:offset + fid_size * n])
+        if sys.byteorder != 'little':
+            fids.byteswap()
+    else:
+        fid_size = 8
+        fids = struct.unpack_from('<%dq' % n, data, offset)
+    offset += fid_size * n
+
+    arrays = [fids]
+    for typecode, length in (('I', n + 1), ('I', n + 1), ('I', 0)):
+        arr = array(typecode)
+        if length == 0:
+            # the pairs, of which there are as many as the last offset.
+            length = 2 * arrays[2][-1]
+        n_bytes = arr.itemsize * length
+        arr.fromstring(data[offset:offset + n_bytes])
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        offset += n_bytes
+        arrays.append(arr)
+    fids, wkb_offsets, prop_offsets, prop_pairs = arrays
+
+    return _columnar_rows(data, offset, header['keys'], header['values'],
+                          fids, wkb_offsets, prop_offsets, prop_pairs)
+
+
+def _columnar_rows(data, wkb_start, keys, values, fids, wkb_offsets,
+                   prop_offsets, prop_pairs):
+    for i in xrange(len(fids)):
+        shape_wkb = data[wkb_start + wkb_offsets[i]:
+                         wkb_start + wkb_offsets[i + 1]]
+        props = {}
+        for j in xrange(2 * prop_offsets[i], 2 * prop_offsets[i + 1], 2):
+            props[keys[prop_pairs[j]]] = values[prop_pairs[j + 1]]
+        yield fids[i], shape_wkb, props
+
+
+def make_rawr_zip_payload(rawr_tile, date_time=None, columnar=False):
+    """
+    make a zip file from the rawr tile formatted data. if columnar is set,
+    tables of features are written in the columnar format, and the others
+    stay as msgpack.
+    """
     if date_time is None:
         date_time = gmtime()[0:6]
 
     buf = StringIO()
     with zipfile.ZipFile(buf, mode='w') as z:
         for fmt_data in rawr_tile.all_formatted_data:
+            data = fmt_data.data
+            if columnar:
+                rows = Unpacker(file_like=StringIO(data))
+                data = pack_columnar_table(rows) or data
             zip_info = zipfile.ZipInfo(fmt_data.name, date_time)
-            z.writestr(zip_info, fmt_data.data, zipfile.ZIP_DEFLATED)
+            z.writestr(zip_info, data, zipfile.ZIP_DEFLATED)
     return buf.getvalue()
 
 
+class _PrefixedFile(object):
+
+    """File-like which reads some already-read bytes, then the rest"""
+
+    def __init__(self, prefix, fh):
+        self.prefix = prefix
+        self.fh = fh
+
+    def read(self, n=-1):
+        if not self.prefix:
+            return self.fh.read(n)
+        if n is None or n < 0:
+            data = self.prefix + self.fh.read()
+            self.prefix = ''
+        else:
+            data = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            if len(data) < n:
+                data += self.fh.read(n - len(data))
+        return data
+
+
+def _zip_tables(table_sources, zfh):
+    from tilequeue.query.common import Table
+
+    def get_table(table_name):
+        # stream the rows out of the zip member as it's decompressed, rather
+        # than extracting the whole table first. the tables are read one at
+        # a time, so the readers don't compete for the zip's file object.
+        fh = zfh.open(table_name, 'r')
+        magic = fh.read(len(_COLUMNAR_MAGIC))
+        if magic == _COLUMNAR_MAGIC:
+            rows = unpack_columnar_table(magic + fh.read())
+        else:
+            rows = Unpacker(file_like=_PrefixedFile(magic, fh))
+        source = table_sources[table_name]
+        return Table(source, rows)
+
+    return get_table
+
+
+class RawrTables(object):
+
+    """Callable "tables" object, returning a table given its name
+
+    The version is the ETag of the RAWR tile object which the tables were
+    read from, if it's known. close() releases anything the tables hold
+    open, e.g: a mapped payload, once they've been read.
+    """
+
+    def __init__(self, get_table, version=None, close=None):
+        self.get_table = get_table
+        self.version = version
+        self._close = close
+
+    def __call__(self, table_name):
+        return self.get_table(table_name)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
 def unpack_rawr_zip_payload(table_sources, payload):
     """unpack a zipfile and turn it into a callable "tables" object."""
     # the io we get from S3 is streaming, so we can't seek on it, but zipfile
     # seems to require that. so we buffer it all in memory. RAWR tiles are
     # generally up to around 100MB in size, which should be safe to store in
     # RAM.
-    from tilequeue.query.common import Table
     from io import BytesIO
 
     zfh = zipfile.ZipFile(BytesIO(payload), 'r')
+    return _zip_tables(table_sources, zfh)
 
-    def get_table(table_name):
-        # need to extract the whole compressed file from zip reader, as it
-        # doesn't support .tell() on the filelike, which gzip requires.
-        data = zfh.open(table_name, 'r').read()
-        unpacker = Unpacker(file_like=BytesIO(data))
-        source = table_sources[table_name]
-        return Table(source, unpacker)
 
-    return get_table
+class _S3RangeFile(object):
+
+    """Read-only, seekable file-like view of an S3 object
+
+    The bytes are fetched as they're read, with ranged GETs of at least
+    block_size bytes, and only the most recently fetched block is kept.
+    This lets zipfile read the central directory from the end of the
+    object, and then only the members which are opened. Each GET is
+    conditional on the ETag, so that a concurrent overwrite of the object
+    fails the read rather than mixing two versions. If fetch_policy is
+    given, each GET is made through it.
+    """
+
+    def __init__(self, s3_client, bucket, key, size, etag,
+                 block_size=4 << 20, fetch_policy=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.block_size = block_size
+        self.fetch_policy = fetch_policy
+        self.pos = 0
+        self.buf = b''
+        self.buf_start = 0
+        self.n_requests = 0
+        self.n_bytes = 0
+
+    def _fetch(self, start, length):
+        length = max(length, self.block_size)
+        # a read near the end, e.g: of the zip's end of central directory
+        # record, fetches the whole last block, as the central directory
+        # will be read next.
+        start = max(0, min(start, self.size - length))
+        end = min(start + length, self.size) - 1
+
+        def fetch():
+            response = self.s3_client.get_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Range='bytes=%d-%d' % (start, end),
+                IfMatch=self.etag,
+            )
+            with closing(response['Body']) as body_fp:
+                return body_fp.read()
+        if self.fetch_policy is None:
+            self.buf = fetch()
+        else:
+            self.buf = self.fetch_policy(fetch, 'range')
+        self.buf_start = start
+        self.n_requests += 1
+        self.n_bytes += len(self.buf)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        n = min(n, self.size - self.pos)
+        if n <= 0:
+            return b''
+
+        offset = self.pos - self.buf_start
+        if 0 <= offset < len(self.buf):
+            data = self.buf[offset:offset + n]
+        else:
+            data = b''
+        if len(data) < n:
+            self._fetch(self.pos + len(data), n - len(data))
+            offset = self.pos + len(data) - self.buf_start
+            data += self.buf[offset:offset + n - len(data)]
+
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        elif whence == 2:
+            self.pos = self.size + offset
+        else:
+            raise ValueError('Unknown whence %r' % (whence,))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.buf = b''
 
 
 def make_rawr_s3_path(tile, prefix, suffix):
@@ -580,14 +1069,15 @@ class RawrS3Sink(object):
 
     """Rawr sink to write to s3"""
 
-    def __init__(self, s3_client, bucket, prefix, suffix):
+    def __init__(self, s3_client, bucket, prefix, suffix, columnar=False):
         self.s3_client = s3_client
         self.bucket = bucket
         self.prefix = prefix
         self.suffix = suffix
+        self.columnar = columnar
 
     def __call__(self, rawr_tile):
-        payload = make_rawr_zip_payload(rawr_tile)
+        payload = make_rawr_zip_payload(rawr_tile, columnar=self.columnar)
         location = make_rawr_s3_path(rawr_tile.tile, self.prefix, self.suffix)
         self.s3_client.put_object(
                 Body=payload,
@@ -602,11 +1092,12 @@ class RawrStoreSink(object):
 
     """Rawr sink to write to tilequeue store."""
 
-    def __init__(self, store):
+    def __init__(self, store, columnar=False):
         self.store = store
+        self.columnar = columnar
 
     def __call__(self, rawr_tile):
-        payload = make_rawr_zip_payload(rawr_tile)
+        payload = make_rawr_zip_payload(rawr_tile, columnar=self.columnar)
         coord = unconvert_coord_object(rawr_tile.tile)
         format = zip_format
         layer = 'rawr'
@@ -619,28 +1110,601 @@ def _empty_table(table_name):
     return []
 
 
+# returned by RawrS3Source._get_object when the tile hasn't changed since
+# the version given.
+_NOT_MODIFIED = object()
+
+
+class _MmapFile(object):
+
+    """File-like wrapper of an mmap, which zipfile can read from"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self.data) - self.data.tell()
+        return self.data.read(n)
+
+    def seek(self, offset, whence=0):
+        self.data.seek(offset, whence)
+
+    def tell(self):
+        return self.data.tell()
+
+    def close(self):
+        self.data.close()
+
+
+# ETags which can be stored in a RawrDiskCache file name as they are.
+_SAFE_ETAG = re.compile('^"[0-9A-Za-z-]+"$')
+
+
+class RawrDiskCache(object):
+
+    """Cache of RAWR tile payloads on local disk, shared between processes
+
+    Each payload is stored in a file named for its tile and ETag:
+
+      <path>/<z>/<x>/<y>.<etag>.zip
+
+    so that any process on the host can check which version it has before
+    revalidating it with a conditional GET. Files are written to a
+    temporary name and renamed into place, so readers never see a partial
+    payload, and are read back by mmap, so several processes reading the
+    same tile share the page cache rather than each holding a copy.
+
+    A payload whose ETag isn't a plain quoted digest isn't cached, as it
+    couldn't be told apart from another in the file name.
+
+    Reading an entry updates its modification time, and when a new entry
+    takes the total size over max_bytes, the least recently used entries
+    are removed.
+
+    The total size is kept up to date with this process's own writes, and
+    the directory is only scanned again when that goes over max_bytes or
+    after every scan_interval puts, to pick up other processes' writes.
+    """
+
+    scan_interval = 100
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, stale=0, writes=0,
+                           evictions=0, unsafe=0)
+        # total size of the entries as of the last scan, plus any written
+        # since, or None before the first scan.
+        self._bytes = None
+        self._puts_since_scan = 0
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self._stats[name] += n
+
+    def _tile_dir(self, tile):
+        return os.path.join(self.path, str(tile.z), str(tile.x))
+
+    def _entries(self, tile):
+        # returns the (etag, path) of the tile's entries, newest first.
+        tile_dir = self._tile_dir(tile)
+        try:
+            names = os.listdir(tile_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        prefix = '%d.' % tile.y
+        entries = []
+        for name in names:
+            if name.startswith(prefix) and name.endswith('.zip'):
+                path = os.path.join(tile_dir, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                etag = '"%s"' % name[len(prefix):-len('.zip')]
+                entries.append((mtime, etag, path))
+        entries.sort(reverse=True)
+        return [entry[1:] for entry in entries]
+
+    def get(self, tile):
+        """
+        Returns the ETag and a read-only file-like mmap of the newest cached
+        payload for the tile, or None if there isn't one.
+        """
+
+        for etag, path in self._entries(tile):
+            try:
+                with open(path, 'rb') as fh:
+                    if os.fstat(fh.fileno()).st_size == 0:
+                        continue
+                    data = _MmapFile(mmap.mmap(
+                        fh.fileno(), 0, access=mmap.ACCESS_READ))
+                os.utime(path, None)
+            except (IOError, OSError) as e:
+                # removed by another process since it was listed.
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            self._count('hits')
+            return etag, data
+
+        self._count('misses')
+        return None
+
+    def stale(self):
+        """
+        Record that the payload returned by get() had been replaced in S3.
+        """
+
+        with self.lock:
+            self._stats['hits'] -= 1
+            self._stats['stale'] += 1
+
+    def put(self, tile, etag, payload):
+        tile_dir = self._tile_dir(tile)
+        try:
+            os.makedirs(tile_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # ETags are quoted hex digests, with a part count for multipart
+        # uploads. anything else can't be used in the name and read back as
+        # the same ETag, so the payload isn't cached.
+        if not _SAFE_ETAG.match(etag):
+            n_bytes = 0
+            for _, old_path in self._entries(tile):
+                n_bytes -= self._remove(old_path)
+            with self.lock:
+                self._stats['unsafe'] += 1
+                if self._bytes is not None:
+                    self._bytes += n_bytes
+            return
+
+        path = os.path.join(tile_dir, '%d.%s.zip' % (tile.y, etag[1:-1]))
+        fd, tmp_path = tempfile.mkstemp(dir=tile_dir, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(payload)
+            replaced = self._size(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        n_bytes = len(payload) - replaced
+
+        # older versions of the tile won't be asked for again.
+        for _, old_path in self._entries(tile):
+            if old_path != path:
+                n_bytes -= self._remove(old_path)
+
+        with self.lock:
+            self._stats['writes'] += 1
+            self._puts_since_scan += 1
+            if self._bytes is not None:
+                self._bytes += n_bytes
+            scan = self._bytes is None or \
+                self._bytes > self.max_bytes or \
+                self._puts_since_scan >= self.scan_interval
+        if scan:
+            self._cleanup()
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def _remove(self, path):
+        # returns the number of bytes removed, zero if the file had already
+        # gone.
+        size = self._size(path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        return size
+
+    def _cleanup(self):
+        entries = []
+        total = 0
+        for dir_path, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith('.zip'):
+                    continue
+                path = os.path.join(dir_path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total > self.max_bytes:
+            # removing a file which another process has mapped is safe, it
+            # keeps the data until it's unmapped.
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+                self._count('evictions')
+
+        with self.lock:
+            self._bytes = total
+            self._puts_since_scan = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self._stats)
+
+
+def make_rawr_disk_cache(disk_cache_yaml):
+    path = disk_cache_yaml.get('path')
+    assert path, 'Missing rawr disk-cache path'
+    max_bytes = disk_cache_yaml.get('max-bytes')
+    assert max_bytes, 'Missing rawr disk-cache max-bytes'
+    return RawrDiskCache(path, int(max_bytes))
+
+
+class RawrFetchTimeout(Exception):
+    pass
+
+
+# S3 error codes which another attempt might not get.
+_RETRYABLE_CODES = frozenset((
+    'RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException',
+    'InternalError', 'ServiceUnavailable'))
+
+
+def _is_retryable(e):
+    # server errors and throttling might be transient, but other client
+    # errors, e.g: access denied, would only fail again. anything else is
+    # most likely a connection or read error, which is worth retrying.
+    if isinstance(e, ClientError):
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        code = e.response.get('Error', {}).get('Code')
+        return (status is not None and status >= 500) or \
+            code in _RETRYABLE_CODES
+    return True
+
+
+class _Attempts(object):
+
+    # the requests started for one attempt. any still running when the
+    # attempt times out, or is answered by another, are abandoned.
+
+    def __init__(self):
+        self.results = Queue.Queue()
+        self.n_running = 0
+        self.abandoned = False
+
+
+class RawrFetchPolicy(object):
+
+    """Run RAWR fetches with per-attempt deadlines, retries and hedging
+
+    Each attempt is abandoned if it hasn't finished within attempt_timeout
+    seconds of starting, not counting any time waiting for a thread.
+    Attempts which time out, or fail with an error which might be transient,
+    are retried up to max_attempts in total, after a random backoff of up
+    to backoff seconds, doubling each time up to max_backoff.
+
+    If hedge_percentile is set, then once an attempt has taken longer than
+    that percentile of the latencies of recent requests of the same kind,
+    e.g: 'get' or 'head', a second, hedged request is started and whichever
+    answers first is used. There's no hedging until hedge_min_samples
+    latencies have been seen. An attempt which times out counts as taking
+    attempt_timeout.
+
+    Attempts with a deadline or hedging run on a pool of n_threads threads.
+    A running request can't be interrupted, so an abandoned one keeps its
+    thread until it finishes, and its result is discarded. While
+    max_abandoned are running, no more hedges are started and new attempts
+    wait for one to finish. The client used by fetch should time out its
+    own requests, so that abandoned ones do finish, and not retry them,
+    which would multiply max_attempts.
+    """
+
+    def __init__(self, attempt_timeout=None, max_attempts=1, backoff=0.1,
+                 max_backoff=5.0, hedge_percentile=None,
+                 hedge_min_samples=20, latency_window=500, n_threads=16,
+                 max_abandoned=8, stats_handler=None):
+        assert max_attempts >= 1, 'Invalid max_attempts'
+        assert 0 <= max_abandoned < n_threads, 'Invalid max_abandoned'
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_window = latency_window
+        self.n_threads = n_threads
+        self.max_abandoned = max_abandoned
+        self.stats_handler = stats_handler
+        self.lock = threading.Lock()
+        self.abandoned_done = threading.Condition(self.lock)
+        # started when an attempt first needs it.
+        self.pool = None
+        # number of abandoned requests which are still running.
+        self.abandoned = 0
+        # latencies, in seconds, of the most recent requests of each kind.
+        self.latencies = {}
+        self._stats = dict(fetches=0, attempts=0, retries=0, timeouts=0,
+                           hedges=0, hedge_wins=0, failures=0)
+
+    def _count(self, name):
+        with self.lock:
+            self._stats[name] += 1
+
+    def _record(self, kind, latency):
+        with self.lock:
+            latencies = self.latencies.get(kind)
+            if latencies is None:
+                latencies = self.latencies[kind] = deque(
+                    maxlen=self.latency_window)
+            latencies.append(latency)
+
+    def latency_percentile(self, percentile, kind='get'):
+        """
+        Returns the latency, in seconds, at the percentile of recent
+        requests of the kind, or None if there haven't been any.
+        """
+
+        with self.lock:
+            latencies = sorted(self.latencies.get(kind, ()))
+        if not latencies:
+            return None
+        i = int(len(latencies) * percentile / 100.0)
+        return latencies[min(i, len(latencies) - 1)]
+
+    def _hedge_delay(self, kind):
+        if self.hedge_percentile is None:
+            return None
+        with self.lock:
+            n_samples = len(self.latencies.get(kind, ()))
+        if n_samples < self.hedge_min_samples:
+            return None
+        return self.latency_percentile(self.hedge_percentile, kind)
+
+    def _start(self, fetch, attempts, is_hedge):
+        def run():
+            start = time.time()
+            # the attempt's deadline runs from here, rather than from when
+            # it was queued for a thread.
+            attempts.results.put((is_hedge, None, start, 0))
+            try:
+                value = fetch()
+            except Exception:
+                result = (is_hedge, False, sys.exc_info(), 0)
+            else:
+                result = (is_hedge, True, value, time.time() - start)
+            with self.lock:
+                attempts.n_running -= 1
+                if attempts.abandoned:
+                    self.abandoned -= 1
+                    self.abandoned_done.notify_all()
+                    return
+            attempts.results.put(result)
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.n_threads)
+            attempts.n_running += 1
+        self.pool.apply_async(run)
+
+    def _wait_for_abandoned(self):
+        with self.lock:
+            while self.abandoned >= self.max_abandoned:
+                self.abandoned_done.wait()
+
+    def _can_hedge(self):
+        with self.lock:
+            return self.abandoned < self.max_abandoned
+
+    def _abandon(self, attempts):
+        with self.lock:
+            attempts.abandoned = True
+            self.abandoned += attempts.n_running
+
+    def _success(self, kind, latency, is_hedge):
+        self._record(kind, latency)
+        if is_hedge:
+            self._count('hedge_wins')
+            if self.stats_handler:
+                self.stats_handler.hedge_won()
+
+    def _attempt(self, fetch, kind):
+        self._count('attempts')
+        hedge_delay = self._hedge_delay(kind)
+        if self.attempt_timeout is None and hedge_delay is None:
+            # nothing to wait for, so there's no need for another thread.
+            start = time.time()
+            value = fetch()
+            self._success(kind, time.time() - start, False)
+            return value
+
+        self._wait_for_abandoned()
+        attempts = _Attempts()
+        self._start(fetch, attempts, False)
+        try:
+            return self._wait(fetch, kind, attempts, hedge_delay)
+        finally:
+            self._abandon(attempts)
+
+    def _wait(self, fetch, kind, attempts, hedge_delay):
+        n_running = 1
+        error = None
+        # set once the first request has started running.
+        deadline = None
+        hedge_at = None
+        while True:
+            wake_times = [t for t in (deadline, hedge_at) if t is not None]
+            timeout = None
+            if wake_times:
+                timeout = max(min(wake_times) - time.time(), 0)
+            try:
+                is_hedge, ok, value, latency = attempts.results.get(
+                    True, timeout)
+            except Queue.Empty:
+                now = time.time()
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self._can_hedge():
+                        self._count('hedges')
+                        if self.stats_handler:
+                            self.stats_handler.hedged()
+                        self._start(fetch, attempts, True)
+                        n_running += 1
+                elif deadline is not None and now >= deadline:
+                    self._count('timeouts')
+                    self._record(kind, self.attempt_timeout)
+                    if self.stats_handler:
+                        self.stats_handler.timed_out()
+                    raise RawrFetchTimeout(
+                        'RAWR fetch attempt took longer than %rs' %
+                        self.attempt_timeout)
+                continue
+
+            if ok is None:
+                # a request has started, at the time given.
+                if not is_hedge:
+                    if self.attempt_timeout is not None:
+                        deadline = value + self.attempt_timeout
+                    if hedge_delay is not None:
+                        hedge_at = value + hedge_delay
+                continue
+
+            n_running -= 1
+            if ok:
+                self._success(kind, latency, is_hedge)
+                return value
+            # wait for the other request, if there is one, before giving up.
+            if error is None:
+                error = value
+            if n_running == 0:
+                raise error[0], error[1], error[2]
+
+    def __call__(self, fetch, kind='get'):
+        """
+        Returns the result of calling fetch, which is retried and hedged
+        according to the policy, so should be safe to call more than once.
+        The kind of request picks the latencies it's hedged by.
+        """
+
+        start = time.time()
+        n_attempts = 0
+        while True:
+            n_attempts += 1
+            try:
+                value = self._attempt(fetch, kind)
+                break
+            except Exception as e:
+                if n_attempts >= self.max_attempts or not _is_retryable(e):
+                    self._count('failures')
+                    if self.stats_handler:
+                        self.stats_handler.failed()
+                    raise
+
+            self._count('retries')
+            if self.stats_handler:
+                self.stats_handler.retried()
+            max_sleep = min(self.max_backoff,
+                            self.backoff * 2 ** (n_attempts - 1))
+            time.sleep(random.uniform(0, max_sleep))
+
+        self._count('fetches')
+        if self.stats_handler:
+            self.stats_handler.fetched(time.time() - start, n_attempts)
+        return value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self._stats)
+            stats['abandoned'] = self.abandoned
+            kinds = list(self.latencies)
+        for kind in kinds:
+            for percentile in (50, 95, 99):
+                stats['%s_p%d' % (kind, percentile)] = \
+                    self.latency_percentile(percentile, kind)
+        return stats
+
+
+def make_rawr_fetch_policy(fetch_yaml, stats_handler=None):
+    hedge_percentile = fetch_yaml.get('hedge-percentile')
+    if hedge_percentile is not None:
+        assert 0 < hedge_percentile < 100, \
+            'Invalid rawr fetch hedge-percentile'
+    return RawrFetchPolicy(
+        attempt_timeout=fetch_yaml.get('attempt-timeout'),
+        max_attempts=int(fetch_yaml.get('max-attempts', 1)),
+        backoff=fetch_yaml.get('backoff', 0.1),
+        max_backoff=fetch_yaml.get('max-backoff', 5.0),
+        hedge_percentile=hedge_percentile,
+        hedge_min_samples=int(fetch_yaml.get('hedge-min-samples', 20)),
+        n_threads=int(fetch_yaml.get('threads', 16)),
+        max_abandoned=int(fetch_yaml.get('max-abandoned', 8)),
+        stats_handler=stats_handler)
+
+
 class RawrS3Source(object):
 
     """Rawr source to read from S3."""
 
+    # minimum size of each ranged GET, if range_reads is set.
+    range_block_size = 4 << 20
+
     def __init__(self, s3_client, bucket, prefix, suffix, table_sources,
-                 allow_missing_tiles=False):
+                 allow_missing_tiles=False, range_reads=False,
+                 disk_cache=None, fetch_policy=None):
         self.s3_client = s3_client
         self.bucket = bucket
         self.prefix = prefix
         self.suffix = suffix
         self.table_sources = table_sources
         self.allow_missing_tiles = allow_missing_tiles
-
-    def _get_object(self, tile):
+        # if set, read the zip's directory and then only the tables which
+        # are used with ranged GETs, rather than downloading the whole tile.
+        self.range_reads = range_reads
+        # optional RawrDiskCache of whole payloads, which is used instead
+        # of range reads.
+        self.disk_cache = disk_cache
+        # optional RawrFetchPolicy for the requests for whole tiles and
+        # their metadata.
+        self.fetch_policy = fetch_policy
+
+    def _fetch(self, fetch, kind):
+        if self.fetch_policy is None:
+            return fetch()
+        return self.fetch_policy(fetch, kind)
+
+    def _get_object(self, tile, if_none_match=None):
         location = make_rawr_s3_path(tile, self.prefix, self.suffix)
 
+        extra_args = {}
+        if if_none_match is not None:
+            extra_args['IfNoneMatch'] = if_none_match
+
         try:
             response = self.s3_client.get_object(
                 Bucket=self.bucket,
                 Key=location,
+                **extra_args
             )
         except Exception, e:
+            # boto reports a 304 for a conditional GET as an error.
+            if if_none_match is not None and isinstance(e, ClientError):
+                if e.response['ResponseMetadata']['HTTPStatusCode'] == 304:
+                    return _NOT_MODIFIED
             # if we allow missing tiles, then translate a 404 exception into a
             # value response. this is useful for local or dev environments
             # where we might not have a global build, but don't want the lack
@@ -652,19 +1716,112 @@ class RawrS3Source(object):
 
         return response
 
-    def __call__(self, tile):
+    def _get_payload(self, tile, if_none_match=None):
+        # returns the response and the whole body read from it, as the body
+        # is streamed, so a slow read should count against the attempt too.
+        def fetch():
+            response = self._get_object(tile, if_none_match)
+            if response is None or response is _NOT_MODIFIED:
+                return response, None
+            with closing(response['Body']) as body_fp:
+                return response, body_fp.read()
+        # a conditional GET is usually answered with a quick 304.
+        kind = 'get' if if_none_match is None else 'revalidate'
+        return self._fetch(fetch, kind)
+
+    def _head_object(self, tile):
+        location = make_rawr_s3_path(tile, self.prefix, self.suffix)
+
+        def fetch():
+            try:
+                return self.s3_client.head_object(
+                    Bucket=self.bucket,
+                    Key=location,
+                )
+            except ClientError as e:
+                if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                    return None
+                raise
+        return self._fetch(fetch, 'head')
+
+    def _ranged_tables(self, tile, version):
+        response = self._head_object(tile)
+        if response is None:
+            if self.allow_missing_tiles:
+                return _empty_table
+            raise KeyError('Missing RAWR tile %r' % (tile,))
+        if response['ETag'] == version:
+            return None
+
+        location = make_rawr_s3_path(tile, self.prefix, self.suffix)
+        range_file = _S3RangeFile(
+            self.s3_client, self.bucket, location,
+            response['ContentLength'], response['ETag'],
+            self.range_block_size, self.fetch_policy)
+        zfh = zipfile.ZipFile(range_file, 'r')
+        return RawrTables(
+            _zip_tables(self.table_sources, zfh), response['ETag'])
+
+    def _cached_tables(self, tile, version):
+        cached = self.disk_cache.get(tile)
+        if cached is None:
+            etag = version
+        else:
+            etag, data = cached
+
+        response, body = self._get_payload(tile, etag)
+        if response is _NOT_MODIFIED:
+            if etag == version:
+                if cached is not None:
+                    data.close()
+                return None
+            zfh = zipfile.ZipFile(data, 'r')
+            return RawrTables(
+                _zip_tables(self.table_sources, zfh), etag, data.close)
+
+        if cached is not None:
+            data.close()
+            self.disk_cache.stale()
+        if response is None:
+            return _empty_table
+        assert 'DeleteMarker' not in response
+
+        self.disk_cache.put(tile, response['ETag'], body)
+        return RawrTables(
+            unpack_rawr_zip_payload(self.table_sources, body),
+            response['ETag'])
+
+    def _tables(self, tile, version=None):
+        if self.disk_cache is not None:
+            return self._cached_tables(tile, version)
+        if self.range_reads:
+            return self._ranged_tables(tile, version)
+
         # throws an exception if the object is missing - RAWR tiles
-        response = self._get_object(tile)
+        response, body = self._get_payload(tile, version)
 
+        if response is _NOT_MODIFIED:
+            return None
         if response is None:
             return _empty_table
 
         # check that the response isn't a delete marker.
         assert 'DeleteMarker' not in response
 
-        with closing(response['Body']) as body_fp:
-            body = body_fp.read()
-        return unpack_rawr_zip_payload(self.table_sources, body)
+        return RawrTables(
+            unpack_rawr_zip_payload(self.table_sources, body),
+            response['ETag'])
+
+    def if_changed(self, tile, version):
+        """
+        Returns the tables for the tile, or None if the RAWR tile object is
+        still the version given, i.e: its ETag, without downloading it again.
+        """
+
+        return self._tables(tile, version)
+
+    def __call__(self, tile):
+        return self._tables(tile)
 
 
 class RawrStoreSource(object):
@@ -687,7 +1844,7 @@ class RawrStoreSource(object):
         return unpack_rawr_zip_payload(self.table_sources, payload)
 
 
-def make_rawr_queue(name, region, wait_time_secs):
+def make_rawr_queue(name, region, wait_time_secs, visibility_mgr=None):
     import boto3
     sqs_client = boto3.client('sqs', region_name=region)
     resp = sqs_client.get_queue_url(QueueName=name)
@@ -695,7 +1852,8 @@ def make_rawr_queue(name, region, wait_time_secs):
         'Failed to get queue url for: %s' % name
     queue_url = resp['QueueUrl']
     from tilequeue.rawr import SqsQueue
-    rawr_queue = SqsQueue(sqs_client, queue_url, wait_time_secs)
+    rawr_queue = SqsQueue(sqs_client, queue_url, wait_time_secs,
+                          visibility_mgr)
     return rawr_queue
 
 
@@ -725,11 +1883,18 @@ class RawrFileQueue(object):
             import sys
             sys.exit('RawrMemQueue is empty, all work finished!')
 
+    def read_batch(self, max_messages=10):
+        handles = [self.read()]
+        while self.queue and len(handles) < max_messages:
+            handles.append(self.Handle(self.queue.pop()))
+        return handles
+
     def done(self, handle):
         pass
 
 
-def make_rawr_queue_from_yaml(rawr_queue_yaml, msg_marshaller):
+def make_rawr_queue_from_yaml(rawr_queue_yaml, msg_marshaller,
+                              visibility_mgr=None):
     rawr_queue_type = rawr_queue_yaml.get('type', 'sqs')
 
     if rawr_queue_type == 'file':
@@ -744,7 +1909,8 @@ def make_rawr_queue_from_yaml(rawr_queue_yaml, msg_marshaller):
         assert region, 'Missing rawr queue region'
         wait_time_secs = rawr_queue_yaml.get('wait-seconds')
         assert wait_time_secs is not None, 'Missing rawr queue wait-seconds'
-        rawr_queue = make_rawr_queue(name, region, wait_time_secs)
+        rawr_queue = make_rawr_queue(
+            name, region, wait_time_secs, visibility_mgr)
 
     return rawr_queue
 
@@ -1,3 +1,6 @@
+from tilequeue.utils import convert_seconds_to_millis
+
+
 class TileProcessingStatsHandler(object):
 
     def __init__(self, stats):
@@ -21,6 +24,13 @@ class TileProcessingStatsHandler(object):
             pipe.incr('process.storage.skipped',
                       coord_proc_data.store_info['not_stored'])
 
+            for source_name, query_stats in (
+                    coord_proc_data.queries or {}).items():
+                prefix = 'process.query.%s' % source_name
+                pipe.timing('%s.time' % prefix, query_stats['time'])
+                pipe.incr('%s.rows' % prefix, query_stats['rows'])
+                pipe.incr('%s.bytes' % prefix, query_stats['bytes'])
+
     def processed_pyramid(self, parent_tile,
                           start_time, stop_time):
         duration = stop_time - start_time
@@ -33,6 +43,70 @@ class TileProcessingStatsHandler(object):
         self.stats.incr('process.errors.process', 1)
 
 
+class QueryCacheStatsHandler(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def hit(self, source_name, n_bytes):
+        with self.stats.pipeline() as pipe:
+            pipe.incr('process.query-cache.hits', 1)
+            pipe.incr('process.query-cache.%s.hits' % source_name, 1)
+            pipe.incr('process.query-cache.bytes-saved', n_bytes)
+
+    def miss(self, source_name):
+        with self.stats.pipeline() as pipe:
+            pipe.incr('process.query-cache.misses', 1)
+            pipe.incr('process.query-cache.%s.misses' % source_name, 1)
+
+    def invalidated(self, n_entries):
+        self.stats.incr('process.query-cache.invalidated', n_entries)
+
+
+class RawrTileCacheStatsHandler(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def hit(self):
+        self.stats.incr('process.rawr-tile-cache.hits', 1)
+
+    def miss(self):
+        self.stats.incr('process.rawr-tile-cache.misses', 1)
+
+    def stored(self, n_bytes, n_evicted):
+        with self.stats.pipeline() as pipe:
+            pipe.gauge('process.rawr-tile-cache.tile-bytes', n_bytes)
+            pipe.incr('process.rawr-tile-cache.evictions', n_evicted)
+
+
+class RawrFetchStatsHandler(object):
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def fetched(self, duration, n_attempts):
+        with self.stats.pipeline() as pipe:
+            pipe.timing('process.rawr-fetch.time',
+                        convert_seconds_to_millis(duration))
+            pipe.incr('process.rawr-fetch.attempts', n_attempts)
+
+    def retried(self):
+        self.stats.incr('process.rawr-fetch.retries', 1)
+
+    def timed_out(self):
+        self.stats.incr('process.rawr-fetch.timeouts', 1)
+
+    def hedged(self):
+        self.stats.incr('process.rawr-fetch.hedges', 1)
+
+    def hedge_won(self):
+        self.stats.incr('process.rawr-fetch.hedge-wins', 1)
+
+    def failed(self):
+        self.stats.incr('process.rawr-fetch.failures', 1)
+
+
 def emit_time_dict(pipe, timing, prefix):
     for timing_label, value in timing.items():
         metric_name = '%s.%s' % (prefix, timing_label)
@@ -3,17 +3,36 @@
 from boto import connect_s3
 from boto.s3.bucket import Bucket
 from builtins import range
+from collections import deque
+from collections import OrderedDict
+from contextlib import closing
+import atexit
+import errno
 from future.utils import raise_from
 import md5
 from ModestMaps.Core import Coordinate
+from multiprocessing.pool import ThreadPool
 import os
+import Queue
+from tilequeue.metatile import metatile_contents_hash
 from tilequeue.metatile import metatiles_are_equal
+from tilequeue.format import lookup_format_by_extension
 from tilequeue.format import zip_format
+from tilequeue.tile import coord_marshall_int
+from tilequeue.tile import coord_unmarshall_int
+from tilequeue.utils import grouper
 import random
+import shutil
+import sqlite3
+import tempfile
 import threading
 import time
 
 
+# sentinel for a key which isn't in a cache, as opposed to a cached None.
+_missing = object()
+
+
 def calc_hash(s):
     m = md5.new()
     m.update(s)
@@ -40,6 +59,36 @@ def s3_tile_key(date, path, layer, coord, extension):
     return s3_path
 
 
+def s3_blob_key(date, path, digest, extension):
+    # blobs are sharded by their digest in the same place in the key as
+    # tiles are sharded by their hash.
+    prefix = '/%s' % path if path else ''
+    return '/%(date)s/%(shard)s%(prefix)s/blobs/%(digest)s.%(ext)s' % dict(
+        date=date,
+        shard=digest[:5],
+        prefix=prefix,
+        digest=digest,
+        ext=extension,
+    )
+
+
+def s3_list_prefixes(date_prefix, hash_prefix_len):
+    """
+    Return the key prefixes which shard the listing of a bucket written with
+    s3_tile_key. Each prefix is the date prefix followed by a distinct
+    hex string of length hash_prefix_len, which together cover the whole of
+    the md5 hash prefix space.
+    """
+
+    hash_prefixes = ['']
+    for _ in xrange(hash_prefix_len):
+        hash_prefixes = [p + c for p in hash_prefixes
+                         for c in '0123456789abcdef']
+    if date_prefix:
+        return ['%s/%s' % (date_prefix, p) for p in hash_prefixes]
+    return hash_prefixes
+
+
 def parse_coordinate_from_path(path, extension, layer):
     if path.endswith(extension):
         fields = path.rsplit('/', 4)
@@ -93,17 +142,82 @@ def _backoff_and_retry(ExceptionType, num_tries=5, retry_factor=2,
     return decorator
 
 
+# error codes from a DeleteObjects request which are worth retrying for the
+# individual keys which failed.
+S3_DELETE_RETRY_CODES = set([
+    'InternalError', 'SlowDown', 'ServiceUnavailable'])
+
+
+def _bounded_imap(pool, func, iterable, max_in_flight):
+    """
+    Like pool.imap, but reads at most max_in_flight items from the iterable
+    ahead of the results being consumed, so that a large generator isn't
+    pulled into memory all at once. Results are yielded in order.
+    """
+
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+class DeleteProgress(object):
+    """
+    Periodically logs the number of tiles deleted so far, and the rate at
+    which they are being deleted.
+    """
+
+    def __init__(self, logger, name, report_interval=10):
+        self.logger = logger
+        self.name = name
+        self.report_interval = report_interval
+        self.num_deleted = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def add(self, num_deleted):
+        self.num_deleted += num_deleted
+        now = time.time()
+        if now - self.last_report_time >= self.report_interval:
+            self._report(now)
+
+    def done(self):
+        self._report(time.time())
+
+    def _report(self, now):
+        self.last_report_time = now
+        if self.logger:
+            elapsed = now - self.start_time
+            rate = self.num_deleted / elapsed if elapsed > 0 else 0.0
+            self.logger.info('Removed %d tiles from %s (%.1f tiles/s)',
+                             self.num_deleted, self.name, rate)
+
+
 class S3(object):
 
     def __init__(
             self, bucket, date_prefix, path, reduced_redundancy,
-            delete_retry_interval, logger):
+            delete_retry_interval, logger, list_n_threads=16,
+            list_hash_prefix_len=2, delete_n_threads=8,
+            delete_batch_size=1000, delete_max_tries=10,
+            delete_retry_base_interval=0.1):
         self.bucket = bucket
         self.date_prefix = date_prefix
         self.path = path
         self.reduced_redundancy = reduced_redundancy
         self.delete_retry_interval = delete_retry_interval
         self.logger = logger
+        self.list_n_threads = list_n_threads
+        self.list_hash_prefix_len = list_hash_prefix_len
+        self.delete_n_threads = delete_n_threads
+        # DeleteObjects accepts at most 1000 keys per request.
+        assert 0 < delete_batch_size <= 1000
+        self.delete_batch_size = delete_batch_size
+        self.delete_max_tries = delete_max_tries
+        self.delete_retry_base_interval = delete_retry_base_interval
 
     def write_tile(self, tile_data, coord, format, layer):
         key_name = s3_tile_key(
@@ -130,45 +244,143 @@ class S3(object):
         tile_data = key.get_contents_as_string()
         return tile_data
 
-    def delete_tiles(self, coords, format, layer):
-        key_names = [
-            s3_tile_key(self.date_prefix, self.path, layer, coord,
-                        format.extension).lstrip('/')
-            for coord in coords
-        ]
+    def write_blob(self, blob_data, digest, format):
+        key_name = s3_blob_key(
+            self.date_prefix, self.path, digest, format.extension)
+        key = self.bucket.new_key(key_name)
+
+        @_backoff_and_retry(Exception, logger=self.logger)
+        def write_to_s3():
+            key.set_contents_from_string(
+                blob_data,
+                headers={'Content-Type': format.mimetype},
+                policy='public-read',
+                reduced_redundancy=self.reduced_redundancy,
+            )
+
+        write_to_s3()
+
+    def read_blob(self, digest, format):
+        key_name = s3_blob_key(
+            self.date_prefix, self.path, digest, format.extension)
+        key = self.bucket.get_key(key_name)
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def blob_exists(self, digest, format):
+        key_name = s3_blob_key(
+            self.date_prefix, self.path, digest, format.extension)
+        # get_key only makes a HEAD request.
+        return self.bucket.get_key(key_name) is not None
+
+    def _delete_keys(self, key_names):
+        """
+        Delete a batch of keys, retrying any keys which failed with a
+        transient error after a short, jittered, exponential backoff. The
+        backoff is capped at delete_retry_interval. Returns the number of
+        keys deleted.
+        """
 
         num_deleted = 0
-        while key_names:
+        interval = self.delete_retry_base_interval
+        for _ in xrange(self.delete_max_tries):
             del_result = self.bucket.delete_keys(key_names)
             num_deleted += len(del_result.deleted)
 
-            key_names = []
-            for error in del_result.errors:
-                # retry on internal error. documentation implies that the only
-                # possible two errors are AccessDenied and InternalError.
-                # retrying when access denied seems unlikely to work, but an
-                # internal error might be transient.
-                if error.code == 'InternalError':
-                    key_names.append(error.key)
+            # retrying when access denied seems unlikely to work, but an
+            # internal error or throttling might be transient.
+            key_names = [error.key for error in del_result.errors
+                         if error.code in S3_DELETE_RETRY_CODES]
+            if not key_names:
+                break
+
+            # pause a bit to give transient errors a chance to clear. the
+            # jitter stops all the in-flight batches retrying in lockstep.
+            time.sleep(random.uniform(
+                0, min(interval, self.delete_retry_interval)))
+            interval *= 2
 
-            # pause a bit to give transient errors a chance to clear.
-            if key_names:
-                time.sleep(self.delete_retry_interval)
+        return num_deleted
+
+    def delete_tiles(self, coords, format, layer):
+        """
+        Delete the tiles at coords, which may be any iterable, including a
+        generator.
+
+        Keys are deleted in batches of delete_batch_size, with up to
+        delete_n_threads batches in flight at once. Progress is logged
+        periodically if the store has a logger.
+        """
+
+        def key_names():
+            for coord in coords:
+                yield s3_tile_key(self.date_prefix, self.path, layer, coord,
+                                  format.extension).lstrip('/')
+
+        batches = grouper(key_names(), self.delete_batch_size)
+        progress = DeleteProgress(self.logger, 'S3')
+        num_keys = 0
+        num_deleted = 0
+
+        pool = ThreadPool(self.delete_n_threads)
+        try:
+            for n_keys, n_deleted in _bounded_imap(
+                    pool, lambda batch: (len(batch), self._delete_keys(batch)),
+                    batches, self.delete_n_threads * 2):
+                num_keys += n_keys
+                num_deleted += n_deleted
+                progress.add(n_deleted)
+        finally:
+            pool.terminate()
+        progress.done()
 
         # make sure that we deleted all the tiles - this seems like the
         # expected behaviour from the calling code.
-        assert num_deleted == len(coords), \
+        assert num_deleted == num_keys, \
             "Failed to delete some coordinates from S3."
 
         return num_deleted
 
-    def list_tiles(self, format, layer):
-        ext = '.' + format.extension
-        for key_obj in self.bucket.list(prefix=self.date_prefix):
-            key = key_obj.key
-            coord = parse_coordinate_from_path(key, ext, layer)
+    def _list_tile_ints_with_prefix(self, prefix, ext, layer):
+        coord_ints = []
+        for key_obj in self.bucket.list(prefix=prefix):
+            coord = parse_coordinate_from_path(key_obj.key, ext, layer)
             if coord:
-                yield coord
+                coord_ints.append(coord_marshall_int(coord))
+        return coord_ints
+
+    def list_tile_ints(self, format, layer):
+        """
+        Yield the marshalled integer for each tile coordinate in the store.
+
+        The keyspace is sharded by the md5 hash prefix that s3_tile_key puts
+        after the date prefix, and the shards are listed concurrently. Only
+        a bounded number of shards are listed ahead of the tiles being
+        consumed, so a slow consumer doesn't buffer the whole listing.
+        Tiles are yielded in no particular order.
+        """
+
+        ext = '.' + format.extension
+        prefixes = s3_list_prefixes(
+            self.date_prefix, self.list_hash_prefix_len)
+
+        def list_prefix(prefix):
+            return self._list_tile_ints_with_prefix(prefix, ext, layer)
+
+        n_threads = min(self.list_n_threads, len(prefixes))
+        pool = ThreadPool(n_threads)
+        try:
+            for coord_ints in _bounded_imap(
+                    pool, list_prefix, prefixes, n_threads * 2):
+                for coord_int in coord_ints:
+                    yield coord_int
+        finally:
+            pool.terminate()
+
+    def list_tiles(self, format, layer):
+        for coord_int in self.list_tile_ints(format, layer):
+            yield coord_unmarshall_int(coord_int)
 
 
 def make_dir_path(base_path, coord, layer):
@@ -254,7 +466,7 @@ class TileDirectory(object):
     Writes tiles to individual files in a local directory.
     '''
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, delete_n_threads=8):
         if os.path.exists(base_path):
             if not os.path.isdir(base_path):
                 raise IOError(
@@ -263,16 +475,14 @@ class TileDirectory(object):
             os.makedirs(base_path)
 
         self.base_path = base_path
+        self.delete_n_threads = delete_n_threads
 
-    def write_tile(self, tile_data, coord, format, layer):
-        dir_path = make_dir_path(self.base_path, coord, layer)
+    def _write_file(self, data, dir_path, file_path):
         try:
             os.makedirs(dir_path)
         except OSError:
             pass
 
-        file_path = make_file_path(self.base_path, coord, layer,
-                                   format.extension)
         swap_file_path = '%s.swp-%s-%s-%s' % (
             file_path,
             os.getpid(),
@@ -282,7 +492,7 @@ class TileDirectory(object):
 
         try:
             with open(swap_file_path, 'w') as tile_fp:
-                tile_fp.write(tile_data)
+                tile_fp.write(data)
 
             # write file as atomic operation
             os_replace(swap_file_path, file_path)
@@ -293,9 +503,7 @@ class TileDirectory(object):
                 pass
             raise e
 
-    def read_tile(self, coord, format, layer):
-        file_path = make_file_path(self.base_path, coord, layer,
-                                   format.extension)
+    def _read_file(self, file_path):
         try:
             with open(file_path, 'r') as tile_fp:
                 tile_data = tile_fp.read()
@@ -303,14 +511,62 @@ class TileDirectory(object):
         except IOError:
             return None
 
-    def delete_tiles(self, coords, format, layer):
+    def write_tile(self, tile_data, coord, format, layer):
+        dir_path = make_dir_path(self.base_path, coord, layer)
+        file_path = make_file_path(self.base_path, coord, layer,
+                                   format.extension)
+        self._write_file(tile_data, dir_path, file_path)
+
+    def read_tile(self, coord, format, layer):
+        file_path = make_file_path(self.base_path, coord, layer,
+                                   format.extension)
+        return self._read_file(file_path)
+
+    def _blob_path(self, digest, format):
+        dir_path = os.path.join(self.base_path, 'blobs', digest[:2])
+        file_path = os.path.join(
+            dir_path, '%s.%s' % (digest, format.extension))
+        return dir_path, file_path
+
+    def write_blob(self, blob_data, digest, format):
+        dir_path, file_path = self._blob_path(digest, format)
+        self._write_file(blob_data, dir_path, file_path)
+
+    def read_blob(self, digest, format):
+        _, file_path = self._blob_path(digest, format)
+        return self._read_file(file_path)
+
+    def blob_exists(self, digest, format):
+        _, file_path = self._blob_path(digest, format)
+        return os.path.isfile(file_path)
+
+    def _delete_files(self, file_paths):
         delete_count = 0
-        for coord in coords:
-            file_path = make_file_path(
-                self.base_path, coord, layer, format.extension)
-            if os.path.isfile(file_path):
+        for file_path in file_paths:
+            # removing and ignoring a missing file saves a stat per tile
+            # over checking whether the file exists first.
+            try:
                 os.remove(file_path)
                 delete_count += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return delete_count
+
+    def delete_tiles(self, coords, format, layer):
+        file_paths = (
+            make_file_path(self.base_path, coord, layer, format.extension)
+            for coord in coords)
+
+        delete_count = 0
+        pool = ThreadPool(self.delete_n_threads)
+        try:
+            for n_deleted in _bounded_imap(
+                    pool, self._delete_files, grouper(file_paths, 1000),
+                    self.delete_n_threads * 2):
+                delete_count += n_deleted
+        finally:
+            pool.terminate()
 
         return delete_count
 
@@ -323,11 +579,266 @@ class TileDirectory(object):
                 if coord:
                     yield coord
 
+    def list_tile_ints(self, format, layer):
+        for coord in self.list_tiles(format, layer):
+            yield coord_marshall_int(coord)
+
 
-def make_tile_file_store(base_path=None):
+def make_tile_file_store(base_path=None, delete_n_threads=None):
     if base_path is None:
         base_path = 'tiles'
-    return TileDirectory(base_path)
+    tile_dir = TileDirectory(base_path)
+    if delete_n_threads:
+        tile_dir.delete_n_threads = delete_n_threads
+    return tile_dir
+
+
+class _SqliteWriteRequest(object):
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SqliteStore(object):
+    '''
+    Writes tiles to a single SQLite file, using the MBTiles schema where
+    possible.
+
+    Tile bodies are deduplicated in the `images` table by their md5 hash,
+    and the `map` table points each coordinate at its body. Unlike MBTiles,
+    `map` also has layer and extension columns, so that several layers and
+    formats can share a file. As in MBTiles, tile rows are stored flipped
+    (TMS), and the `tiles` view joins the two tables.
+
+    All writes go through a single writer thread which commits the pending
+    writes from all the storage threads in one transaction. Each caller
+    blocks until the transaction containing its write has been committed.
+    The database is in WAL mode, so readers, each with a connection of its
+    own, aren't blocked by the writer.
+    '''
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._write_queue = Queue.Queue()
+
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (
+                tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE TABLE IF NOT EXISTS map (
+                layer TEXT, extension TEXT, zoom_level INTEGER,
+                tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                PRIMARY KEY (
+                    layer, extension, zoom_level, tile_column, tile_row));
+            CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level,
+                       map.tile_column AS tile_column,
+                       map.tile_row AS tile_row,
+                       images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        ''')
+        conn.execute(
+            'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+            ('name', os.path.basename(path)))
+        # the format isn't known until the first tile is written, so it's
+        # noted then, rather than checked again for every write.
+        self._has_format = conn.execute(
+            "SELECT 1 FROM metadata WHERE name = 'format'").fetchone() \
+            is not None
+
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None,
+            check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            requests = [self._write_queue.get()]
+            while len(requests) < self.batch_size:
+                try:
+                    requests.append(self._write_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in requests:
+                running = False
+                requests = [r for r in requests if r is not None]
+            if requests:
+                self._write_batch(conn, requests)
+        conn.close()
+
+    def _write_batch(self, conn, requests):
+        # tile_ids which might no longer be referenced from the map once
+        # this batch has been applied.
+        orphans = set()
+        has_format = self._has_format
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            for request in requests:
+                try:
+                    request.result = request.fn(
+                        cursor, orphans, *request.args)
+                except Exception as e:
+                    request.error = e
+            for tile_id in orphans:
+                cursor.execute(
+                    'DELETE FROM images WHERE tile_id = ? AND NOT EXISTS '
+                    '(SELECT 1 FROM map WHERE tile_id = ?)',
+                    (tile_id, tile_id))
+            cursor.execute('COMMIT')
+        except Exception as e:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                # the transaction may never have begun.
+                pass
+            self._has_format = has_format
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                request.done.set()
+
+    def _submit(self, fn, *args):
+        request = _SqliteWriteRequest(fn, args)
+        self._write_queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _map_key(self, coord, format, layer):
+        zoom = int(coord.zoom)
+        tms_row = (1 << zoom) - 1 - int(coord.row)
+        return (layer, format.extension, zoom, int(coord.column), tms_row)
+
+    def _write(self, cursor, orphans, tile_data, coord, format, layer):
+        tile_id = md5.new(tile_data).hexdigest()
+        map_key = self._map_key(coord, format, layer)
+        cursor.execute(
+            'SELECT tile_id FROM map WHERE layer = ? AND extension = ? AND '
+            'zoom_level = ? AND tile_column = ? AND tile_row = ?', map_key)
+        row = cursor.fetchone()
+        if row is not None:
+            if row[0] == tile_id:
+                return
+            orphans.add(row[0])
+
+        cursor.execute(
+            'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+            (tile_id, buffer(tile_data)))
+        cursor.execute(
+            'INSERT OR REPLACE INTO map (layer, extension, zoom_level, '
+            'tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?, ?, ?)',
+            map_key + (tile_id,))
+        if not self._has_format:
+            cursor.execute(
+                'INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                ('format', format.extension))
+            self._has_format = True
+
+    def _delete(self, cursor, orphans, coords, format, layer):
+        delete_count = 0
+        for coord in coords:
+            map_key = self._map_key(coord, format, layer)
+            cursor.execute(
+                'SELECT tile_id FROM map WHERE layer = ? AND extension = ? '
+                'AND zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                map_key)
+            row = cursor.fetchone()
+            if row is not None:
+                orphans.add(row[0])
+                cursor.execute(
+                    'DELETE FROM map WHERE layer = ? AND extension = ? AND '
+                    'zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                    map_key)
+                delete_count += 1
+        return delete_count
+
+    def write_tile(self, tile_data, coord, format, layer):
+        self._submit(self._write, tile_data, coord, format, layer)
+
+    def read_tile(self, coord, format, layer):
+        row = self._conn().execute(
+            'SELECT images.tile_data FROM map JOIN images '
+            'ON images.tile_id = map.tile_id WHERE map.layer = ? AND '
+            'map.extension = ? AND map.zoom_level = ? AND '
+            'map.tile_column = ? AND map.tile_row = ?',
+            self._map_key(coord, format, layer)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def delete_tiles(self, coords, format, layer):
+        delete_count = 0
+        # delete in chunks, so that a very large delete doesn't hold up
+        # the writes from the other threads for too long.
+        for chunk in grouper(coords, self.batch_size):
+            delete_count += self._submit(self._delete, chunk, format, layer)
+        return delete_count
+
+    def list_tiles(self, format, layer):
+        # a connection of its own, which is closed when the listing is
+        # finished or abandoned, so that the listing can be consumed while
+        # tiles are being deleted.
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                'SELECT zoom_level, tile_column, tile_row FROM map '
+                'WHERE layer = ? AND extension = ?',
+                (layer, format.extension))
+            for zoom, column, tms_row in cursor:
+                row = (1 << zoom) - 1 - tms_row
+                yield Coordinate(zoom=zoom, column=column, row=row)
+
+    def list_tile_ints(self, format, layer):
+        for coord in self.list_tiles(format, layer):
+            yield coord_marshall_int(coord)
+
+    def close(self):
+        self._write_queue.put(None)
+        self._writer.join()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def make_sqlite_store(path=None, batch_size=None):
+    if path is None:
+        path = 'tiles.mbtiles'
+    sqlite_store = SqliteStore(path)
+    if batch_size:
+        sqlite_store.batch_size = batch_size
+    return sqlite_store
 
 
 class Memory(object):
@@ -350,18 +861,404 @@ class Memory(object):
     def list_tiles(self, format, layer):
         return [self.data] if self.data else []
 
+    def list_tile_ints(self, format, layer):
+        if self.data is None:
+            return []
+        tile_data, coord, format, layer = self.data
+        return [coord_marshall_int(coord)]
+
 
 def make_s3_store(bucket_name,
                   aws_access_key_id=None, aws_secret_access_key=None,
                   path='osm', reduced_redundancy=False, date_prefix='',
-                  delete_retry_interval=60, logger=None):
+                  delete_retry_interval=60, logger=None, list_n_threads=None,
+                  delete_n_threads=None):
     conn = connect_s3(aws_access_key_id, aws_secret_access_key)
     bucket = Bucket(conn, bucket_name)
     s3_store = S3(bucket, date_prefix, path, reduced_redundancy,
                   delete_retry_interval, logger)
+    if list_n_threads:
+        s3_store.list_n_threads = list_n_threads
+    if delete_n_threads:
+        s3_store.delete_n_threads = delete_n_threads
     return s3_store
 
 
+class CachingStore(object):
+    '''
+    Read-through cache in front of another store.
+
+    Recently read or written tiles are kept in memory, in an LRU bounded by
+    max_bytes. Knowing that a tile doesn't exist is cached too. If a
+    disk_store is given, tiles evicted from memory are moved there, in a
+    second LRU bounded by disk_max_bytes, and moved back to memory when
+    they're read. The disk_store's directory belongs to the cache, which
+    expects it to start empty, and close() removes it.
+
+    Writes and deletes go through to the wrapped store, and update the
+    cache once they have succeeded. A tile read from the wrapped store is
+    only cached if it wasn't written or deleted while it was being read.
+    '''
+
+    # rough per-entry cost of the key and bookkeeping, so that caching a
+    # large number of missing tiles is still bounded.
+    entry_overhead = 100
+
+    def __init__(self, store, max_bytes, disk_store=None,
+                 disk_max_bytes=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.disk_store = disk_store
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # size of each tile in the disk tier, in LRU order.
+        self._disk_keys = OrderedDict()
+        self._disk_size = 0
+        # generation and number of reads in flight for each key being read
+        # from the wrapped store. writes and deletes bump the generation.
+        self._fills = {}
+        self._lock = threading.Lock()
+        self._stats = dict(
+            hits=0, disk_hits=0, misses=0, evictions=0, disk_evictions=0,
+            invalidations=0, stale_fills=0)
+
+    def _key(self, coord, format, layer):
+        return coord_marshall_int(coord), format.extension, layer
+
+    def _disk_path(self, key):
+        coord_int, extension, layer = key
+        return make_file_path(self.disk_store.base_path,
+                              coord_unmarshall_int(coord_int), layer,
+                              extension)
+
+    def _entry_size(self, tile_data):
+        size = self.entry_overhead
+        if tile_data is not None:
+            size += len(tile_data)
+        return size
+
+    def _invalidate(self, key, disk_deletes):
+        fill = self._fills.get(key)
+        if fill is not None:
+            fill[0] += 1
+        self._discard(key, disk_deletes)
+
+    def _discard(self, key, disk_deletes):
+        tile_data = self._entries.pop(key, _missing)
+        if tile_data is not _missing:
+            self._size -= self._entry_size(tile_data)
+        self._discard_from_disk(key, disk_deletes)
+
+    def _discard_from_disk(self, key, disk_deletes):
+        # the files are deleted by _delete_from_disk after the lock is
+        # released. if the key is evicted to disk again in the meantime, its
+        # new file might be deleted, but that only makes it a miss.
+        disk_size = self._disk_keys.pop(key, None)
+        if disk_size is not None:
+            self._disk_size -= disk_size
+            disk_deletes.append(self._disk_path(key))
+
+    def _delete_from_disk(self, disk_deletes):
+        for path in disk_deletes:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _put(self, key, tile_data, disk_deletes):
+        self._discard(key, disk_deletes)
+        self._entries[key] = tile_data
+        self._size += self._entry_size(tile_data)
+
+        while self._size > self.max_bytes and self._entries:
+            evicted_key, evicted_data = self._entries.popitem(last=False)
+            self._size -= self._entry_size(evicted_data)
+            self._stats['evictions'] += 1
+            if self.disk_store is not None and evicted_data is not None:
+                self._put_on_disk(evicted_key, evicted_data, disk_deletes)
+
+    def _put_on_disk(self, key, tile_data, disk_deletes):
+        if self.disk_max_bytes is not None and \
+           len(tile_data) > self.disk_max_bytes:
+            return
+        # the disk tier is local, so it's written while holding the lock to
+        # keep it consistent with the memory tier.
+        coord_int, extension, layer = key
+        self.disk_store.write_tile(
+            tile_data, coord_unmarshall_int(coord_int),
+            lookup_format_by_extension(extension), layer)
+        self._disk_keys[key] = len(tile_data)
+        self._disk_size += len(tile_data)
+
+        while self.disk_max_bytes is not None and \
+                self._disk_size > self.disk_max_bytes:
+            evicted_key, _ = next(self._disk_keys.iteritems())
+            self._discard_from_disk(evicted_key, disk_deletes)
+            self._stats['disk_evictions'] += 1
+
+    def _get(self, key, coord, format, layer, disk_deletes):
+        tile_data = self._entries.pop(key, _missing)
+        if tile_data is not _missing:
+            # re-insert to mark as most recently used.
+            self._entries[key] = tile_data
+            self._stats['hits'] += 1
+            return tile_data
+
+        if key in self._disk_keys:
+            tile_data = self.disk_store.read_tile(coord, format, layer)
+            # the tile moves back to memory, or was lost, so either way the
+            # file isn't needed any more.
+            self._discard_from_disk(key, disk_deletes)
+            if tile_data is not None:
+                self._put(key, tile_data, disk_deletes)
+                self._stats['disk_hits'] += 1
+                return tile_data
+
+        return _missing
+
+    def read_tile(self, coord, format, layer):
+        key = self._key(coord, format, layer)
+        disk_deletes = []
+        with self._lock:
+            tile_data = self._get(key, coord, format, layer, disk_deletes)
+            if tile_data is _missing:
+                self._stats['misses'] += 1
+                fill = self._fills.setdefault(key, [0, 0])
+                fill[1] += 1
+                generation = fill[0]
+        self._delete_from_disk(disk_deletes)
+        if tile_data is not _missing:
+            return tile_data
+
+        try:
+            tile_data = self.store.read_tile(coord, format, layer)
+        finally:
+            with self._lock:
+                fill = self._fills[key]
+                fill[1] -= 1
+                if fill[1] == 0:
+                    del self._fills[key]
+                is_stale = fill[0] != generation
+        if is_stale:
+            # a write or delete finished while the tile was being read, so
+            # what was read might be out of date.
+            with self._lock:
+                self._stats['stale_fills'] += 1
+            return tile_data
+
+        with self._lock:
+            self._put(key, tile_data, disk_deletes)
+        self._delete_from_disk(disk_deletes)
+        return tile_data
+
+    def write_tile(self, tile_data, coord, format, layer):
+        key = self._key(coord, format, layer)
+        disk_deletes = []
+        try:
+            self.store.write_tile(tile_data, coord, format, layer)
+        except Exception:
+            with self._lock:
+                self._invalidate(key, disk_deletes)
+            self._delete_from_disk(disk_deletes)
+            raise
+        with self._lock:
+            self._invalidate(key, disk_deletes)
+            self._put(key, tile_data, disk_deletes)
+        self._delete_from_disk(disk_deletes)
+
+    def delete_tiles(self, coords, format, layer):
+        keys = []
+
+        def invalidating_coords():
+            for coord in coords:
+                key = self._key(coord, format, layer)
+                keys.append(key)
+                disk_deletes = []
+                with self._lock:
+                    self._invalidate(key, disk_deletes)
+                self._delete_from_disk(disk_deletes)
+                yield coord
+
+        try:
+            return self.store.delete_tiles(
+                invalidating_coords(), format, layer)
+        finally:
+            # a read could have filled the cache again after the coordinate
+            # went past, but before the tile was deleted.
+            disk_deletes = []
+            with self._lock:
+                for key in keys:
+                    self._invalidate(key, disk_deletes)
+                self._stats['invalidations'] += len(keys)
+            self._delete_from_disk(disk_deletes)
+
+    def list_tiles(self, format, layer):
+        return self.store.list_tiles(format, layer)
+
+    def list_tile_ints(self, format, layer):
+        return self.store.list_tile_ints(format, layer)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._size
+            stats['disk_entries'] = len(self._disk_keys)
+            stats['disk_bytes'] = self._disk_size
+        return stats
+
+    def close(self):
+        if self.disk_store is None:
+            return
+        with self._lock:
+            self._disk_keys.clear()
+            self._disk_size = 0
+            shutil.rmtree(self.disk_store.base_path, ignore_errors=True)
+
+
+def make_caching_store(store, max_bytes=None, disk_path=None,
+                       disk_max_bytes=None):
+    if max_bytes is None:
+        max_bytes = 256 * 1024 * 1024
+    disk_store = None
+    if disk_path:
+        # each process has its own directory under disk_path, so that
+        # processes sharing the config never read or remove each other's
+        # tiles, and nothing else under disk_path is touched.
+        try:
+            os.makedirs(disk_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        disk_store = make_tile_file_store(
+            tempfile.mkdtemp(prefix='tilequeue-cache-', dir=disk_path))
+        if disk_max_bytes is None:
+            disk_max_bytes = 4 * max_bytes
+    caching_store = CachingStore(store, max_bytes, disk_store, disk_max_bytes)
+    if disk_store is not None:
+        atexit.register(caching_store.close)
+    return caching_store
+
+
+# tile bodies written by ContentAddressedStore start with this, followed by
+# the digest of the blob holding the real tile body.
+BLOB_POINTER_PREFIX = 'tqblob:'
+
+
+def tile_content_hash(tile_data, format):
+    """
+    Return a hex digest of the tile data, such that tiles which
+    tiles_are_equal have the same digest.
+    """
+
+    if format and format == zip_format:
+        digest = metatile_contents_hash(tile_data)
+        if digest is not None:
+            return digest
+
+    return md5.new(tile_data).hexdigest()
+
+
+class ContentAddressedStore(object):
+    '''
+    Stores each distinct tile body once, as a blob named by its content
+    hash, and writes only a small pointer to the blob at each coordinate.
+
+    The wrapped store must support write_blob, read_blob and blob_exists,
+    as S3 and TileDirectory do. Reading through this store follows the
+    pointers, but anything reading the wrapped store directly will see
+    the pointers rather than the tiles.
+
+    Blobs are never deleted, as other coordinates may point at them.
+
+    The digests of the blobs known to exist are remembered, up to
+    max_known_digests of the most recently written, so that common tiles
+    don't need a HEAD request each time. The distinct_tiles stat counts the
+    digests which weren't remembered when written, so it can overcount if
+    a tile is forgotten and seen again.
+    '''
+
+    def __init__(self, store, max_known_digests=100000):
+        self.store = store
+        self.max_known_digests = max_known_digests
+        self._known_digests = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict(
+            writes=0, blob_writes=0, bytes_written=0, bytes_stored=0,
+            distinct_tiles=0)
+
+    def _ensure_blob(self, tile_data, digest, format):
+        with self._lock:
+            if self._known_digests.pop(digest, None) is not None:
+                # re-insert to mark as most recently used.
+                self._known_digests[digest] = True
+                return
+        # the blob may have been written by an earlier run, or by another
+        # process, and a HEAD request is cheaper than writing it again.
+        if not self.store.blob_exists(digest, format):
+            self.store.write_blob(tile_data, digest, format)
+            with self._lock:
+                self._stats['blob_writes'] += 1
+                self._stats['bytes_stored'] += len(tile_data)
+        with self._lock:
+            if digest not in self._known_digests:
+                self._stats['distinct_tiles'] += 1
+            self._known_digests[digest] = True
+            while len(self._known_digests) > self.max_known_digests:
+                self._known_digests.popitem(last=False)
+
+    def write_tile(self, tile_data, coord, format, layer):
+        digest = tile_content_hash(tile_data, format)
+        self._ensure_blob(tile_data, digest, format)
+        self.store.write_tile(
+            BLOB_POINTER_PREFIX + digest, coord, format, layer)
+        with self._lock:
+            self._stats['writes'] += 1
+            self._stats['bytes_written'] += len(tile_data)
+
+    def read_tile(self, coord, format, layer):
+        tile_data = self.store.read_tile(coord, format, layer)
+        if tile_data is None or \
+           not tile_data.startswith(BLOB_POINTER_PREFIX):
+            return tile_data
+        digest = tile_data[len(BLOB_POINTER_PREFIX):]
+        return self.store.read_blob(digest, format)
+
+    def delete_tiles(self, coords, format, layer):
+        return self.store.delete_tiles(coords, format, layer)
+
+    def list_tiles(self, format, layer):
+        return self.store.list_tiles(format, layer)
+
+    def list_tile_ints(self, format, layer):
+        return self.store.list_tile_ints(format, layer)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['dedupe_ratio'] = (
+            float(stats['writes']) / stats['distinct_tiles']
+            if stats['distinct_tiles'] else 1.0)
+        return stats
+
+
+def store_stats(store):
+    """
+    Return a dict of the stats of each store wrapper around the given
+    store, keyed by the wrapper's class name.
+    """
+
+    all_stats = {}
+    while store is not None:
+        stats_fn = getattr(store, 'stats', None)
+        if stats_fn is not None:
+            all_stats[type(store).__name__] = stats_fn()
+        store = getattr(store, 'store', None)
+    return all_stats
+
+
 def tiles_are_equal(tile_data_1, tile_data_2, fmt):
     """
     Returns True if the tile data is equal in tile_data_1 and tile_data_2. For
@@ -395,12 +1292,44 @@ def write_tile_if_changed(store, tile_data, coord, format, layer):
 
 
 def make_store(yml, credentials={}, logger=None):
+    store = _make_uncached_store(yml, credentials, logger)
+
+    if yml.get('content-addressed'):
+        for method_name in ('write_blob', 'read_blob', 'blob_exists'):
+            assert callable(getattr(store, method_name, None)), \
+                'content-addressed needs a store type which supports ' \
+                'blobs, such as s3 or directory, not %r' % yml.get('type')
+        max_known_digests = yml.get('content-addressed-max-digests')
+        if max_known_digests is None:
+            store = ContentAddressedStore(store)
+        else:
+            store = ContentAddressedStore(store, int(max_known_digests))
+
+    cache_yml = yml.get('cache')
+    if cache_yml:
+        store = make_caching_store(
+            store, max_bytes=cache_yml.get('max-bytes'),
+            disk_path=cache_yml.get('disk-path'),
+            disk_max_bytes=cache_yml.get('disk-max-bytes'))
+
+    return store
+
+
+def _make_uncached_store(yml, credentials, logger):
     store_type = yml.get('type')
+    delete_n_threads = yml.get('delete-threads')
 
     if store_type == 'directory':
         path = yml.get('path')
         name = yml.get('name')
-        return make_tile_file_store(path or name)
+        return make_tile_file_store(
+            path or name, delete_n_threads=delete_n_threads)
+
+    elif store_type == 'sqlite':
+        path = yml.get('path')
+        name = yml.get('name')
+        batch_size = yml.get('batch-size')
+        return make_sqlite_store(path or name, batch_size=batch_size)
 
     elif store_type == 's3':
         bucket = yml.get('name')
@@ -408,6 +1337,7 @@ def make_store(yml, credentials={}, logger=None):
         reduced_redundancy = yml.get('reduced-redundancy')
         date_prefix = yml.get('date-prefix')
         delete_retry_interval = yml.get('delete-retry-interval')
+        list_n_threads = yml.get('list-threads')
 
         assert credentials, 'S3 store configured, but no AWS credentials ' \
             'provided. AWS credentials are required to use S3.'
@@ -417,7 +1347,8 @@ def make_store(yml, credentials={}, logger=None):
         return make_s3_store(
             bucket, aws_access_key_id, aws_secret_access_key, path=path,
             reduced_redundancy=reduced_redundancy, date_prefix=date_prefix,
-            delete_retry_interval=delete_retry_interval, logger=logger)
+            delete_retry_interval=delete_retry_interval, logger=logger,
+            list_n_threads=list_n_threads, delete_n_threads=delete_n_threads)
 
     else:
         raise ValueError('Unrecognized store type: `{}`'.format(store_type))
@@ -165,7 +165,8 @@ class TileQueueReader(object):
 
     def __init__(
             self, queue_mapper, msg_marshaller, msg_tracker, output_queue,
-            tile_proc_logger, stats_handler, stop, max_zoom, group_by_zoom):
+            tile_proc_logger, stats_handler, stop, max_zoom, group_by_zoom,
+            prefetch=None):
         self.queue_mapper = queue_mapper
         self.msg_marshaller = msg_marshaller
         self.msg_tracker = msg_tracker
@@ -175,6 +176,9 @@ class TileQueueReader(object):
         self.stop = stop
         self.max_zoom = max_zoom
         self.group_by_zoom = group_by_zoom
+        # optional callable to hint the fetcher about upcoming jobs' parent
+        # coordinates, so it can start fetching their data early.
+        self.prefetch = prefetch
 
     def __call__(self):
         while not self.stop.is_set():
@@ -259,6 +263,8 @@ class TileQueueReader(object):
                 # coordinates. in which case, there's nothing to do anyway, as
                 # the _reject_coord method will have marked the job as done.
                 if all_coords_data:
+                    if self.prefetch is not None:
+                        self.prefetch(parent_tile)
                     coord_input_spec = all_coords_data, parent_tile
                     msg = "group of %d tiles below %s" \
                           % (len(all_coords_data),
@@ -346,6 +352,10 @@ class DataFetch(object):
                 stacktrace = format_stacktrace_one_line()
                 self.tile_proc_logger.fetch_error(e, stacktrace, coord, parent)
                 self.stats_handler.fetch_error()
+                # don't keep any data prefetched for the failed job.
+                cancel_fn = getattr(self.fetcher, 'cancel_prefetch', None)
+                if cancel_fn is not None and parent is not None:
+                    cancel_fn(parent)
 
         if not saw_sentinel:
             _force_empty_queue(self.input_queue)
@@ -367,6 +377,11 @@ class DataFetch(object):
 
         metadata['timing']['fetch'] = convert_seconds_to_millis(
             time.time() - start)
+        # the postgresql fetcher also says how long each source's query took
+        # and how much it returned.
+        query_stats = getattr(source_rows, 'query_stats', None)
+        if query_stats:
+            metadata['queries'] = query_stats
 
         # every tile job that we get from the queue is a "parent" tile
         # and its four children to cut from it. at zoom 15, this may
@@ -570,7 +585,7 @@ class S3Storage(object):
 
 CoordProcessData = namedtuple(
     'CoordProcessData',
-    ('coord', 'timing', 'size', 'store_info',),
+    ('coord', 'timing', 'size', 'store_info', 'queries',),
 )
 
 
@@ -639,6 +654,7 @@ class TileQueueWriter(object):
                 timing,
                 size,
                 store_info,
+                metadata.get('queries'),
             )
             self.tile_proc_logger.log_processed_coord(coord_proc_data)
             self.stats_handler.processed_coord(coord_proc_data)